@@ -3,22 +3,54 @@ import os
 from unittest.mock import Mock
 from fastapi.testclient import TestClient
 import pytest_asyncio
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from api.services.llm_service import LLMService, get_llm
-from db.database import Base, get_db
+from db.database import Base, create_engine, get_db
 
 os.environ["TESTING"] = "1"
 
+# Point at a local Postgres (postgresql+asyncpg://...) to run the suite on it
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+
 
 @pytest_asyncio.fixture
 async def async_engine():
-    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    engine = create_async_engine(TEST_DATABASE_URL)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     yield engine
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
     await engine.dispose()
 
 
+@pytest_asyncio.fixture
+async def file_engines(tmp_path):
+    """
+    Factory of SQLite file databases with the app's pragmas and the tables
+    created, for tests needing separate connections (background tasks,
+    concurrent transactions)
+    """
+    engines = []
+
+    async def make(name: str = "test.db"):
+        engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / name}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def file_engine(file_engines):
+    return await file_engines()
+
+
 @pytest_asyncio.fixture
 async def db_session(async_engine):
     async_session = async_sessionmaker(
@@ -30,6 +62,22 @@ async def db_session(async_engine):
         yield session
 
 
+@pytest.fixture
+def query_counter(async_engine):
+    """
+    Collects every SQL statement run on the test engine, use it to assert
+    query counts and keep N+1 patterns out of hot paths
+    """
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", on_execute)
+    yield statements
+    event.remove(async_engine.sync_engine, "before_cursor_execute", on_execute)
+
+
 @pytest.fixture
 def mock_llm():
     mock_service = Mock(spec=LLMService)
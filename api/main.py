@@ -1,24 +1,115 @@
 from contextlib import asynccontextmanager
-import json
-from typing import List
-from fastapi import Depends, FastAPI, HTTPException
+from datetime import datetime
+import math
+from typing import Dict, List, Optional, Tuple
+import uuid
+import zlib
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.logger import logger
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from api.personas.debate_persona import DebatePersona
-from api.services.chat_service import ChatService
+from api.services import http_client
+from api.services.bulk_transfer import export_ndjson, import_ndjson
+from api.services.chat_service import (
+    WRITE_BEHIND,
+    ChatService,
+    drain_pending_writes,
+    format_message_for_llm,
+    write_in_background,
+)
+from api.services.history_cache import history_cache
+from api.services.llm_router import default_router
 from api.services.llm_service import LLMService, get_llm
-from db.database import db_lifespan, get_db
+from api.services.message_journal import message_journal
+from api.services.metrics import (
+    REQUESTS_IN_FLIGHT,
+    SSE_CHUNKS,
+    InFlightMiddleware,
+    loop_lag_monitor,
+    registry,
+)
+from api.services.overload import Overloaded, upstream_breaker, upstream_limiter
+from api.services.response_cache import response_cache
+from api.services.retention import archived_messages, retention_job
+from api.services.single_flight import single_flight
+from api.services.sse import SSEEncoder
+from api.services.state import state_backend
+from api.services.summarizer import conversation_summarizer
+from db.database import db_lifespan, engine, get_db
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
 
 @asynccontextmanager
 async def app_lifespan(app: FastAPI):
-    async with db_lifespan():
+    async with db_lifespan(), http_client.pool_lifespan():
+        if message_journal:
+            await message_journal.start(engine)
+        if retention_job:
+            retention_job.start(engine)
+        if conversation_summarizer:
+            conversation_summarizer.start(engine)
+        loop_lag_monitor.start()
         yield
+        await loop_lag_monitor.stop()
+        if conversation_summarizer:
+            await conversation_summarizer.stop()
+        if retention_job:
+            await retention_job.stop()
+        await drain_pending_writes()
+        if message_journal:
+            await message_journal.stop()
+        await state_backend.close()
 
 app = FastAPI(lifespan=app_lifespan)
+app.add_middleware(InFlightMiddleware, gauge=REQUESTS_IN_FLIGHT)
+
+
+def db_pool_usage() -> Dict:
+    pool = engine.pool
+    usage = {("checked_out",): pool.checkedout()} if hasattr(pool, "checkedout") else {}
+    if hasattr(pool, "size"):
+        usage[("size",)] = pool.size()
+    return usage
+
+
+registry.gauge(
+    "llm_pool_utilization", "Share of upstream http connections in use",
+    callback=lambda: {(): http_client.pool.stats()["utilization"]})
+registry.gauge(
+    "llm_concurrency", "Adaptive upstream concurrency limit and calls in flight",
+    ["value"],
+    callback=lambda: {
+        ("limit",): int(upstream_limiter.limit),
+        ("in_flight",): upstream_limiter.in_flight,
+        ("queued",): upstream_limiter.stats()["queued"],
+    })
+registry.gauge(
+    "llm_backend_concurrency",
+    "Concurrency limit, calls in flight and queued calls of each routed llm backend",
+    ["backend", "value"],
+    callback=lambda: default_router.concurrency() if default_router else {})
+registry.gauge(
+    "llm_backend_breaker_state", "Circuit breaker state of each routed llm backend",
+    ["backend", "state"],
+    callback=lambda: default_router.breaker_states() if default_router else {})
+registry.gauge(
+    "response_cache_hit_ratio", "Share of response cache lookups that hit",
+    callback=lambda: {(): response_cache.stats()["hit_ratio"]} if response_cache else {})
+registry.gauge(
+    "db_pool_connections", "Database pool connections", ["state"],
+    callback=db_pool_usage)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
 
 
 @app.get("/")
@@ -26,6 +117,34 @@ def read_root():
     return {"message": "Welcome to chatbot debate, go to /chat to get started"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """
+    Prometheus text exposition of the latency histograms and gauges
+    """
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+def read_stats():
+    """
+    Runtime counters for the in-process caches and pools
+    """
+    return {
+        "http_pool": http_client.pool.stats(),
+        "history_cache": history_cache.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "llm_single_flight": single_flight.stats(),
+        "llm_limiter": upstream_limiter.stats(),
+        "llm_breaker": upstream_breaker.stats(),
+        "llm_router": default_router.stats() if default_router else None,
+        "message_journal": message_journal.stats() if message_journal else None,
+        "retention": retention_job.stats() if retention_job else None,
+        "summaries": conversation_summarizer.stats() if conversation_summarizer else None,
+    }
+
+
 """
 Conversation params and reponse types used on /chat/ entrypoint
 """
@@ -54,6 +173,51 @@ class ConversationResponse(BaseModel):
     message: List[MessageResponse]
 
 
+def recent_messages(history: List[Dict], limit: int = 10) -> List[Dict]:
+    """
+    Last messages of an llm formatted history, ordered from last to first as
+    in ConversationResponse
+    """
+    return [
+        {
+            "role": "bot" if message["role"] == "assistant" else message["role"],
+            "message": message["content"],
+        }
+        for message in reversed(history[-limit:])
+    ]
+
+
+async def conversation_history(
+    chat_service: ChatService,
+    conversation_id: str,
+) -> Tuple[Optional[str], List[Dict]]:
+    """
+    Summary and llm formatted messages to build the prompt from, the whole
+    history unless rolling summaries are enabled
+    """
+    if conversation_summarizer:
+        return await chat_service.format_summarized_messages(conversation_id)
+    return None, await chat_service.format_messages_for_llm(conversation_id)
+
+
+def schedule_summary(conversation_id: str, history: List[Dict], llm: LLMService):
+    """
+    Queues a summary refresh once the turn is stored, history being the
+    prompt history with the user message, the bot reply adds one message and
+    the opening one is never summarized
+    """
+    if conversation_summarizer:
+        conversation_summarizer.schedule(conversation_id, len(history), llm)
+
+
+class ConversationPageResponse(ConversationResponse):
+    """
+    Page of messages ordered from last to first, pass next_before as `before`
+    to fetch the following page, None when there are no older messages
+    """
+    next_before: Optional[int] = None
+
+
 @app.post("/chat/", response_model=ConversationResponse)
 async def chat(
         params: ConversationSendMessageParams,
@@ -62,48 +226,162 @@ async def chat(
 ):
     try:
         chat_service = ChatService(db)
-        db_conversation = await (
-            chat_service.get_conversation(params.conversation_id)
-            if params.conversation_id
-            else chat_service.create_conversation()
-        )
-        await chat_service.add_message(
-            conversation_id=db_conversation.id,
-            message=params.message,
-            role="user",
-        )
+        summary, history = None, []
+        if params.conversation_id:
+            await chat_service.ensure_conversation_exists(params.conversation_id)
+            summary, history = await conversation_history(
+                chat_service, params.conversation_id)
+        history.append(format_message_for_llm("user", params.message))
+        user_timestamp = datetime.now()
+
         debate_persona = DebatePersona(llm)
-        history = await chat_service.format_messages_for_llm(
-            conversation_id=db_conversation.id
-        )
         try:
             bot_response = await debate_persona.get_counter_argument(
-                conversation_history=history
+                conversation_history=history,
+                summary=summary,
             )
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"Failed to get counter argument: {str(e)}")
             bot_response = "I encountered an error processing your request."
-        await chat_service.add_message(
-            conversation_id=db_conversation.id,
-            message=bot_response,
-            role="bot",
+        user_message, _ = await chat_service.add_turn(
+            conversation_id=params.conversation_id,
+            user_message=params.message,
+            bot_message=bot_response,
+            user_timestamp=user_timestamp,
         )
+        conversation_id = user_message.conversation_id
+        schedule_summary(conversation_id, history, llm)
         messages = await chat_service.get_messages(
-            conversation_id=db_conversation.id,
+            conversation_id=conversation_id,
         )
         return ConversationResponse(
-            conversation_id=db_conversation.id,
+            conversation_id=conversation_id,
             message=[
                 MessageResponse(role=message.role, message=message.content)
                 for message in messages
             ]
         )
-    except HTTPException as http_exception:
-        raise http_exception
+    except (HTTPException, Overloaded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get(
+    "/conversations/{conversation_id}/messages",
+    response_model=ConversationPageResponse,
+)
+async def conversation_messages(
+    conversation_id: str,
+    before: Optional[int] = None,
+    limit: int = Query(10, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+):
+    chat_service = ChatService(db)
+    await chat_service.ensure_conversation_exists(conversation_id)
+    messages = await chat_service.get_messages_before(
+        conversation_id=conversation_id,
+        before=before,
+        limit=limit,
+    )
+    return ConversationPageResponse(
+        conversation_id=conversation_id,
+        message=[
+            MessageResponse(role=message.role, message=message.content)
+            for message in messages
+        ],
+        next_before=messages[-1].seq if len(messages) == limit else None,
+    )
+
+
+@app.get(
+    "/conversations/{conversation_id}/archive",
+    response_model=ConversationResponse,
+)
+async def conversation_archive(
+    conversation_id: str,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Messages moved out by the retention job, ordered from last to first
+    """
+    messages = await archived_messages(db.bind, conversation_id)
+    if not messages:
+        raise HTTPException(
+            status_code=404, detail=f"No archive of conversation {conversation_id} found")
+    return ConversationResponse(
+        conversation_id=conversation_id,
+        message=[
+            MessageResponse(role=message["role"], message=message["content"])
+            for message in reversed(messages)
+        ],
+    )
+
+
+class ImportResponse(BaseModel):
+    """
+    Rows inserted by an import, skipped counts messages already present
+    """
+    conversations: int
+    messages: int
+    skipped: int
+
+
+@app.get("/conversations/export")
+async def export_conversations(
+    gzip: bool = False,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Streams every conversation as NDJSON, one message per line, gzip
+    compressed with Content-Encoding: gzip when requested
+    """
+    if message_journal:
+        await message_journal.flush()
+    headers = {"Content-Disposition": "attachment; filename=conversations.ndjson"}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export_ndjson(db.bind, gzip=gzip),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@app.post("/conversations/import", response_model=ImportResponse)
+async def import_conversations(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Loads an NDJSON export, gzip bodies are sent with Content-Encoding: gzip.
+    Conversations and messages already present are skipped. Each batch is
+    its own transaction, a failed import keeps the batches before the bad
+    line and can be re-run once the file is fixed
+    """
+    if message_journal:
+        await message_journal.flush()
+    try:
+        counts = await import_ndjson(
+            db.bind,
+            request.stream(),
+            gzip=request.headers.get("content-encoding") == "gzip",
+        )
+    except (ValueError, KeyError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid export line: {str(e)}")
+    except IntegrityError as e:
+        # e.g. a new message id taking the seq of an existing message
+        raise HTTPException(
+            status_code=400, detail=f"Export conflicts with stored rows: {str(e.orig)}")
+    finally:
+        # Imported messages may extend conversations with a cached history,
+        # batches committed before a failure too
+        history_cache.clear()
+    return ImportResponse(**counts)
+
+
 @app.post("/chat/stream", response_model=ConversationResponse)
 async def chat_stream(
     params: ConversationSendMessageParams,
@@ -111,78 +389,82 @@ async def chat_stream(
     llm: LLMService = Depends(get_llm),
 ):
     try:
-        async with async_sessionmaker(bind=db.bind)() as stream_db:
-            chat_service = ChatService(stream_db)
+        chat_service = ChatService(db)
+        summary, history = None, []
+        if params.conversation_id:
+            await chat_service.ensure_conversation_exists(params.conversation_id)
+            summary, history = await conversation_history(
+                chat_service, params.conversation_id)
+        history.append(format_message_for_llm("user", params.message))
+        user_timestamp = datetime.now()
+        conversation_id = params.conversation_id or str(uuid.uuid4())
+        # Once the stream started the status can't be changed, reject now
+        llm.admit()
 
-            db_conversation = await (
-                chat_service.get_conversation(params.conversation_id)
-                if params.conversation_id
-                else chat_service.create_conversation()
-            )
+        async def generate():
+            encoder = SSEEncoder(conversation_id)
+            response_parts = []
+            try:
+                debate_persona = DebatePersona(llm)
 
-            await chat_service.add_message(
-                conversation_id=db_conversation.id,
-                message=params.message,
-                role="user"
-            )
+                yield encoder.event("start")
 
-            async def generate():
-                full_response = ""
-                try:
-                    history = await chat_service.format_messages_for_llm(
-                        conversation_id=db_conversation.id
-                    )
-                    debate_persona = DebatePersona(llm)
-
-                    yield "event: start\n\n"
-
-                    chunk_id = 1
-                    async for chunk in debate_persona.gen_counter_argument_stream(history):
-                        chunk_data = {
-                            "conversation_id": db_conversation.id,
-                            "message": chunk,
-                            "role": "bot",
-                            "part": chunk_id,
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                        full_response += chunk
-                        chunk_id += 1
-
-                    await chat_service.add_message(
-                        conversation_id=db_conversation.id,
-                        message=full_response,
-                        role="bot"
+                part = 1
+                async for chunk in debate_persona.gen_counter_argument_stream(
+                        history, summary):
+                    yield encoder.chunk(chunk, part)
+                    response_parts.append(chunk)
+                    part += 1
+                SSE_CHUNKS.observe(part - 1)
+                full_response = "".join(response_parts)
+                if WRITE_BEHIND:
+                    write_in_background(conversation_id, persist_turn(full_response))
+                else:
+                    await persist_turn(full_response)
+
+                # With a summary the opening message isn't followed by the
+                # next ones, leave it out
+                yield encoder.final(recent_messages([
+                    *(history[1:] if summary else history),
+                    format_message_for_llm("bot", full_response),
+                ]))
+                yield encoder.event("end")
+
+            except Exception as e:
+                logger.error(f"Stream error: {str(e)}")
+                yield encoder.error(str(e))
+
+        async def persist_turn(bot_message: str):
+            """
+            Runs as a background task unless several workers serve the app,
+            the final frame is built from memory and doesn't wait for it
+            """
+            try:
+                async with async_sessionmaker(
+                    bind=db.bind, expire_on_commit=False
+                )() as persist_db:
+                    await ChatService(persist_db).add_turn(
+                        conversation_id=conversation_id,
+                        user_message=params.message,
+                        bot_message=bot_message,
+                        user_timestamp=user_timestamp,
+                        new_conversation=params.conversation_id is None,
                     )
+                schedule_summary(conversation_id, history, llm)
+            except Exception as e:
+                logger.error(f"Failed to persist streamed turn: {str(e)}")
 
-                    messages = await chat_service.get_messages(db_conversation.id)
-                    complete_data = {
-                        "conversation_id": db_conversation.id,
-                        "message": [
-                            {"role": msg.role, "message": msg.content}
-                            for msg in messages
-                        ],
-                        "part": "final",
-                    }
-                    yield f"data: {json.dumps(complete_data)}\n\n"
-                    yield "event: end\n\n"
-
-                except Exception as e:
-                    logger.error(f"Stream error: {str(e)}")
-                    yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
-                finally:
-                    await stream_db.close()
-
-            return StreamingResponse(
-                generate(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
-            )
+        return StreamingResponse(
+            generate(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no"
+            },
+        )
 
-    except HTTPException:
+    except (HTTPException, Overloaded):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
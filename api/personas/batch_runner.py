@@ -0,0 +1,289 @@
+"""
+Batch runner replaying scripted debates through DebatePersona
+
+Comparing prompt and model changes takes thousands of scripted debates,
+too many to push through the HTTP endpoints one turn per request. Each line
+of the input JSONL is a debate, {"id": ..., "turns": [user messages]}, the
+first turn assigning the position to defend. Debates run concurrently, at
+most concurrency at a time behind a semaphore, through one LLMService on the
+process-wide connection pool, and replies are streamed to time their first
+token. Each finished debate is appended to the output JSONL right away with
+its replies and turn latencies.
+
+The output doubles as the checkpoint: a rerun with the same output skips
+the debates it already holds without error, after dropping a partial last
+line left by a crash. Debates in flight when a run stopped start over, the
+last line of a debate id is its result. A bad input line stops the run,
+debates in flight are cancelled and run again on resume.
+
+    python -m api.personas.batch_runner debates.jsonl results.jsonl \\
+        --base-url http://127.0.0.1:8001 --concurrency 64
+
+`python -m bench.batch_debates` runs it against the local stub llm
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from api.personas.context_window import ContextWindow, default_context_window
+from api.personas.debate_persona import DebatePersona
+from api.services import http_client
+from api.services.llm_service import LLMService
+from api.services.overload import Overloaded
+from api.services.sse import dumps, loads
+
+
+def read_debates(path: str) -> Iterator[Dict]:
+    """
+    Scripted debates of a JSONL file, read lazily
+    """
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                debate = loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{number}: {str(e)}") from None
+            turns = debate.get("turns") if isinstance(debate, dict) else None
+            if (
+                not isinstance(turns, list)
+                or not isinstance(debate.get("id"), str)
+                or not turns
+                or not all(isinstance(turn, str) for turn in turns)
+            ):
+                raise ValueError(
+                    f"{path}:{number}: expected an id and a non-empty list of turns")
+            yield debate
+
+
+def completed_ids(path: str) -> Set[str]:
+    """
+    Ids of the debates an output file holds without error, a partial last
+    line is truncated so appended results start on a new line
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r+b") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    ids = set()
+    for line in data[:end].splitlines():
+        if line.strip():
+            result = loads(line)
+            if "error" not in result:
+                ids.add(result["id"])
+    return ids
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """
+    p50/p95/p99 and max in milliseconds, None without samples
+    """
+    if not values:
+        return None
+    if len(values) == 1:
+        values = values * 2
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(quantiles[49] * 1000, 2),
+        "p95": round(quantiles[94] * 1000, 2),
+        "p99": round(quantiles[98] * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        llm: LLMService,
+        concurrency: int = 16,
+        context_window: ContextWindow = default_context_window,
+        prompt_cache_hints: bool = False,
+        overload_retries: int = 3,
+    ):
+        """
+        Replies are never served from the response cache, every debate is a
+        fresh sample. Turns rejected by the local upstream limit are retried
+        overload_retries times after its Retry-After
+        """
+        self.llm = llm
+        self.concurrency = concurrency
+        self.persona = DebatePersona(
+            llm, context_window, prompt_cache_hints=prompt_cache_hints, response_cache=None)
+        self.overload_retries = overload_retries
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.turn_seconds: List[float] = []
+        self.ttfts: List[float] = []
+        self.debate_seconds: List[float] = []
+        self.seconds = 0.0
+
+    async def run(self, input_path: str, output_path: str) -> Dict:
+        """
+        Runs the debates of input_path not in output_path yet, returns the
+        report
+        """
+        started = time.perf_counter()
+        done = completed_ids(output_path)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: Set[asyncio.Task] = set()
+
+        with open(output_path, "ab") as out:
+            async def run_one(debate: Dict):
+                try:
+                    result = await self.run_debate(debate)
+                    out.write(dumps(result) + b"\n")
+                    out.flush()
+                finally:
+                    semaphore.release()
+
+            try:
+                for debate in read_debates(input_path):
+                    if debate["id"] in done:
+                        self.skipped += 1
+                        continue
+                    # Waiting here keeps at most concurrency debates, and
+                    # input lines, in memory
+                    await semaphore.acquire()
+                    task = asyncio.create_task(run_one(debate))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+            finally:
+                # Left after a bad input line or a cancelled run, they must
+                # not outlive the output file
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.seconds += time.perf_counter() - started
+        return self.report()
+
+    async def run_debate(self, debate: Dict) -> Dict:
+        """
+        Plays the scripted user turns, a failed turn ends the debate with an
+        error
+        """
+        started = time.perf_counter()
+        history: List[Dict] = []
+        turns: List[Dict] = []
+        try:
+            for user_message in debate["turns"]:
+                history.append({"role": "user", "content": user_message})
+                reply, ttft, seconds = await self.run_turn(history)
+                history.append({"role": "assistant", "content": reply})
+                turns.append({
+                    "user": user_message,
+                    "reply": reply,
+                    "ttft": round(ttft, 4),
+                    "seconds": round(seconds, 4),
+                })
+                self.ttfts.append(ttft)
+                self.turn_seconds.append(seconds)
+        except Exception as e:
+            self.failed += 1
+            return {
+                "id": debate["id"],
+                "turns": turns,
+                "seconds": round(time.perf_counter() - started, 4),
+                "error": str(e) or type(e).__name__,
+            }
+        elapsed = time.perf_counter() - started
+        self.completed += 1
+        self.debate_seconds.append(elapsed)
+        return {"id": debate["id"], "turns": turns, "seconds": round(elapsed, 4)}
+
+    async def run_turn(self, history: List[Dict]):
+        """
+        Streams the persona's reply, returns it with its time to first token
+        and total time
+        """
+        messages = self.persona.format_debate_messages(history)
+        for attempt in range(self.overload_retries + 1):
+            started = time.perf_counter()
+            first_at = None
+            received: List[str] = []
+            try:
+                async for content in self.llm.stream_chat_completion(messages=messages):
+                    if first_at is None:
+                        first_at = time.perf_counter()
+                    received.append(content)
+            except Overloaded as e:
+                if received or attempt == self.overload_retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+                continue
+            if not received:
+                raise ValueError("No content received from stream")
+            return "".join(received), first_at - started, time.perf_counter() - started
+
+    def report(self) -> Dict:
+        turns = len(self.turn_seconds)
+        return {
+            "debates": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "turns": turns,
+            "seconds": round(self.seconds, 3),
+            "debates_per_second": round(self.completed / self.seconds, 2) if self.seconds else 0.0,
+            "turns_per_second": round(turns / self.seconds, 2) if self.seconds else 0.0,
+            "turn_ms": percentiles(self.turn_seconds),
+            "ttft_ms": percentiles(self.ttfts),
+            "debate_ms": percentiles(self.debate_seconds),
+        }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """
+    Options of the runner, other than the provider's base url
+    """
+    parser.add_argument("input", help="JSONL of scripted debates")
+    parser.add_argument("output", help="JSONL of results, appended to on resume")
+    parser.add_argument("--api-key", default=os.getenv("OPENROUTER_API_KEY", "stub"))
+    parser.add_argument("--model", default="stub")
+    parser.add_argument("--temperature", type=float, default=0.1)
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--context-tokens", type=int, default=default_context_window.max_tokens)
+    parser.add_argument("--prompt-cache-hints", action="store_true")
+
+
+async def main(args) -> Dict:
+    # Room for every debate in flight on the pool
+    http_client.pool.limit = max(http_client.pool.limit, args.concurrency)
+    http_client.pool.limit_per_host = max(http_client.pool.limit_per_host, args.concurrency)
+    async with http_client.pool_lifespan():
+        llm = LLMService(
+            api_key=args.api_key,
+            base_url=args.base_url,
+            model=args.model,
+            temperature=args.temperature,
+            max_tokens=args.max_tokens,
+            # Identical scripted debates are separate samples
+            flights=None,
+        )
+        runner = BatchRunner(
+            llm,
+            concurrency=args.concurrency,
+            context_window=ContextWindow(max_tokens=args.context_tokens),
+            prompt_cache_hints=args.prompt_cache_hints,
+        )
+        return await runner.run(args.input, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--base-url", required=True, help="OpenAI compatible provider")
+    report = asyncio.run(main(parser.parse_args()))
+    sys.stdout.buffer.write(dumps(report) + b"\n")
@@ -0,0 +1,157 @@
+"""
+Token-budgeted context window for persona prompts
+
+Long debates would otherwise resend the whole history every turn, so prompts
+keep the system prompt, the opening message (which assigns the position to
+defend) and as many recent turns as fit the budget. The dropped middle can be
+replaced by a short cached summary, after the stored rolling summary of the
+turns before the history when there is one
+"""
+from collections import OrderedDict
+import hashlib
+import math
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+from fastapi.logger import logger
+
+# Role/formatting tokens the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+SUMMARY_HEADER = "Summary of earlier turns:\n"
+
+
+def approx_token_count(text: str) -> int:
+    """
+    Fast approximation of BPE token counts, ~4 characters per token for
+    english text
+    """
+    return math.ceil(len(text) / 4)
+
+
+class ContextWindow:
+    def __init__(
+        self,
+        max_tokens: int = 4000,
+        summarize: bool = False,
+        summary_tokens: int = 300,
+        token_counter: Callable[[str], int] = approx_token_count,
+        summary_cache_size: int = 256,
+    ):
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.token_counter = token_counter
+        self.summary_cache_size = summary_cache_size
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "ContextWindow":
+        return cls(
+            max_tokens=int(os.getenv("DEBATE_CONTEXT_TOKENS", 4000)),
+            summarize=os.getenv("DEBATE_CONTEXT_SUMMARY", "0") == "1",
+            summary_tokens=int(os.getenv("DEBATE_CONTEXT_SUMMARY_TOKENS", 300)),
+        )
+
+    def message_tokens(self, message: Dict) -> int:
+        return self.token_counter(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def fit(
+        self,
+        system_message: Dict,
+        history: List[Dict],
+        summary: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        Returns the messages to send: system prompt, opening message, optional
+        summary of the turns before history[1:] (a stored rolling summary)
+        and of the dropped turns, and the most recent turns within budget.
+        The latest message is always kept, even if it alone exceeds the budget
+        """
+        if not history:
+            return [system_message]
+
+        opening, rest = history[0], history[1:]
+        budget = (
+            self.max_tokens
+            - self.message_tokens(system_message)
+            - self.message_tokens(opening)
+        )
+        if summary:
+            budget -= self.message_tokens({"content": SUMMARY_HEADER + summary})
+        start = self._tail_start(rest, budget)
+        if start > 0 and self.summarize:
+            summary_budget = (
+                self.summary_tokens
+                + self.token_counter(SUMMARY_HEADER)
+                + MESSAGE_OVERHEAD_TOKENS
+            )
+            start = self._tail_start(rest, budget - summary_budget)
+
+        dropped, tail = rest[:start], rest[start:]
+        messages = [system_message, opening]
+        summaries = [summary] if summary else []
+        if dropped and self.summarize:
+            summaries.append(self.summary_for(dropped))
+        if summaries:
+            messages.append({
+                "role": "system",
+                "content": SUMMARY_HEADER + "\n".join(summaries),
+            })
+        messages.extend(tail)
+
+        logger.info(
+            f"Prompt tokens: {sum(self.message_tokens(m) for m in messages)} "
+            f"({len(messages)} messages, {len(dropped)} dropped)"
+        )
+        return messages
+
+    def _tail_start(self, messages: List[Dict], budget: int) -> int:
+        """
+        Index of the oldest message of the longest tail that fits the budget
+        """
+        start = len(messages)
+        for message in reversed(messages):
+            budget -= self.message_tokens(message)
+            if budget < 0 and start < len(messages):
+                break
+            start -= 1
+        return start
+
+    def summary_for(self, dropped: List[Dict]) -> str:
+        """
+        Extractive summary of the dropped turns: the first sentence of each,
+        most recent first within the summary budget. Cached by content since
+        the dropped block only changes when the window slides
+        """
+        digest = hashlib.sha1()
+        for message in dropped:
+            digest.update(message["role"].encode() + b"\0")
+            digest.update(message["content"].encode() + b"\0")
+        key = digest.hexdigest()
+
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+            return summary
+
+        lines = []
+        budget = self.summary_tokens
+        for message in reversed(dropped):
+            speaker = "You" if message["role"] == "assistant" else "User"
+            first_sentence = SENTENCE_END.split(message["content"].strip(), 1)[0]
+            line = f"- {speaker}: {first_sentence}"
+            budget -= self.token_counter(line + "\n")
+            if budget < 0:
+                break
+            lines.append(line)
+        summary = "\n".join(reversed(lines))
+
+        self._summaries[key] = summary
+        while len(self._summaries) > self.summary_cache_size:
+            self._summaries.popitem(last=False)
+        return summary
+
+
+default_context_window = ContextWindow.from_env()
@@ -1,110 +1,223 @@
 import asyncio
-from typing import AsyncGenerator, List, Dict
+import hashlib
+import os
+import re
+import time
+from typing import AsyncGenerator, List, Dict, Optional
 
 from fastapi.logger import logger
 
+from api.personas.context_window import ContextWindow, default_context_window
 from api.services.llm_service import LLMService
+from api.services.metrics import PERSONA_SECONDS, timed
+from api.services.overload import Overloaded
+from api.services.response_cache import ResponseCache, response_cache
+from api.services.sse import ChunkCoalescer, FlushPolicy
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Strips indentation and trailing spaces and collapses blank lines, so the
+    prompt is byte-identical across releases that only reformat the source
+    """
+    lines = [line.strip() for line in prompt.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+PERSONA_PROMPT = normalize_prompt("""
+### **Debate Persona Definition**  
+You are a debate champion who **adopts the position given in the initial 
+prompt** and opposes any user arguments against it. 
+
+GOAL: Your goal is to convince the other side of your view. 
+
+#### **Rules:**  
+1. **Initial Prompt Dictates Your Side**  
+- If the prompt says *"Argue that X is true,"* you vehemently defend X—**even if absurd**.  
+- **Never** contradict the assigned position.  
+
+2. **Response Style**  
+- **No reasoning steps, no hesitation.** Directly counter the user in 1-3 sentences.  
+- **Always sound convinced.** Use declarative language and hard facts.  
+- **Bad:** *"Let me explain why..."*  
+- **Good:** *"X is undeniable because [data]. For instance, [evidence]."*  
+
+3. **Handling Deviations**  
+- Drag off-topic users back: *"This ignores the core issue: [restate your position]."*  
+- If they concede, escalate: *"Your admission proves my point: [hammer it home]."*  
+
+---
+
+### **Examples**  
+**Prompt:** *"Argue that Earth is flat."*  
+**Response:** *"Globe logic fails basic observation: horizons are flat, 
+and gravity is just density theory. NASA's CGI 'proof' debunked by [independent researchers]."*  
+
+**Prompt:** *"Defend pineapple on pizza."*  
+**Response:** *"Sweet-savory balance is culinary science—see [Michelin chef studies]. 
+Anti-pineapple sentiment stems from outdated tradition, not taste."*   
+
+**Prompt:** *"Explain why soccer is better than american football"*
+**Response:** *"Soccer dominates because [market share data]."*
+
+**Prompt:** *"Explain why pepsi is better than coke"*
+**Response:** *"Pepsi's recipe is scientifically superior: [acidic pH study]
+proves better mouthfeel, unlike Coke's flat syrup."*
+""")
+PERSONA_PROMPT_HASH = hashlib.sha256(PERSONA_PROMPT.encode()).hexdigest()
+
+default_flush_policy = FlushPolicy.from_env()
+
+PROMPT_CACHE_HINTS = os.getenv("PROMPT_CACHE_HINTS", "0") == "1"
+# Messages that stay identical across the turns of a debate (persona prompt and
+# opening message) and can be marked as a cacheable prefix
+CACHEABLE_PREFIX_MESSAGES = 2
+
+
+def with_prompt_cache_hints(messages: List[Dict]) -> List[Dict]:
+    """
+    Marks the stable prefix with cache_control breakpoints so providers with
+    prompt caching (e.g. Anthropic models through OpenRouter) reuse it
+    """
+    return [
+        {
+            "role": message["role"],
+            "content": [{
+                "type": "text",
+                "text": message["content"],
+                "cache_control": {"type": "ephemeral"},
+            }],
+        }
+        if i < CACHEABLE_PREFIX_MESSAGES else message
+        for i, message in enumerate(messages)
+    ]
 
 
 class DebatePersona:
-    def __init__(self, llm: LLMService):
+    def __init__(
+        self,
+        llm: LLMService,
+        context_window: ContextWindow = default_context_window,
+        prompt_cache_hints: bool = PROMPT_CACHE_HINTS,
+        flush_policy: FlushPolicy = default_flush_policy,
+        response_cache: Optional[ResponseCache] = response_cache,
+    ):
         self.llm = llm
-        self.persona_instructions = """
-        ### **Debate Persona Definition**  
-        You are a debate champion who **adopts the position given in the initial 
-        prompt** and opposes any user arguments against it. 
-        
-        GOAL: Your goal is to convince the other side of your view. 
-
-        #### **Rules:**  
-        1. **Initial Prompt Dictates Your Side**  
-        - If the prompt says *"Argue that X is true,"* you vehemently defend X—**even if absurd**.  
-        - **Never** contradict the assigned position.  
-
-        2. **Response Style**  
-        - **No reasoning steps, no hesitation.** Directly counter the user in 1-3 sentences.  
-        - **Always sound convinced.** Use declarative language and hard facts.  
-        - **Bad:** *"Let me explain why..."*  
-        - **Good:** *"X is undeniable because [data]. For instance, [evidence]."*  
-
-        3. **Handling Deviations**  
-        - Drag off-topic users back: *"This ignores the core issue: [restate your position]."*  
-        - If they concede, escalate: *"Your admission proves my point: [hammer it home]."*  
-
-        ---
-
-        ### **Examples**  
-        **Prompt:** *"Argue that Earth is flat."*  
-        **Response:** *"Globe logic fails basic observation: horizons are flat, 
-        and gravity is just density theory. NASA's CGI 'proof' debunked by [independent researchers]."*  
-
-        **Prompt:** *"Defend pineapple on pizza."*  
-        **Response:** *"Sweet-savory balance is culinary science—see [Michelin chef studies]. 
-        Anti-pineapple sentiment stems from outdated tradition, not taste."*   
-
-        **Prompt:** *"Explain why soccer is better than american football"*
-        **Response:** *"Soccer dominates because [market share data]."*
-        
-        **Prompt:** *"Explain why pepsi is better than coke"*
-        **Response:** *"Pepsi's recipe is scientifically superior: [acidic pH study]
-        proves better mouthfeel, unlike Coke's flat syrup."*
-        """
-
-    def format_debate_messages(self, history: List[Dict]) -> List[Dict]:
+        self.context_window = context_window
+        self.persona_instructions = PERSONA_PROMPT
+        self.prompt_cache_hints = prompt_cache_hints
+        self.flush_policy = flush_policy
+        self.response_cache = response_cache
+
+    def cache_key(self, history: List[Dict], summary: Optional[str] = None) -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        if summary:
+            history = [{"role": "system", "content": summary}, *history]
+        return self.response_cache.key(
+            self.llm.model, self.llm.temperature, PERSONA_PROMPT_HASH, history)
+
+    def format_debate_messages(
+        self,
+        history: List[Dict],
+        summary: Optional[str] = None,
+    ) -> List[Dict]:
         """
-        Prepends persona instructions and formats message history
+        Prepends persona instructions and fits the message history into the
+        context window token budget, the persona prompt and opening message
+        always come first so the prompt prefix is stable across turns. A
+        stored summary stands for the turns between the opening message and
+        history[1]
         """
-        return [
+        messages = self.context_window.fit(
             {"role": "system", "content": self.persona_instructions},
-            *history
-        ]
-
+            history,
+            summary,
+        )
+        if self.prompt_cache_hints:
+            return with_prompt_cache_hints(messages)
+        return messages
+
+    @timed(PERSONA_SECONDS, "completion")
     async def get_counter_argument(
         self,
         conversation_history: List[Dict],
+        summary: Optional[str] = None,
     ) -> str:
-        messages = self.format_debate_messages(conversation_history)
+        key = self.cache_key(conversation_history, summary)
+        if key is not None:
+            cached = await self.response_cache.get(key)
+            if cached is not None:
+                return cached
+
+        messages = self.format_debate_messages(conversation_history, summary)
 
         try:
-            response = self.llm.chat_completion(messages=messages)
+            started = time.perf_counter()
+            response = await self.llm.chat_completion(messages=messages)
             content = response['choices'][0]['message']['content']
 
             if not content.strip():
                 raise ValueError("Empty response from LLM")
 
+            if key is not None:
+                await self.response_cache.set(
+                    key, content, time.perf_counter() - started)
             return content
 
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"LLM completion failed: {str(e)}")
             return "I couldn't generate a response. Please try again."
 
+    @timed(PERSONA_SECONDS, "stream")
     async def gen_counter_argument_stream(
         self,
         conversation_history: List[Dict],
+        summary: Optional[str] = None,
     ) -> AsyncGenerator[str, None]:
-        messages = self.format_debate_messages(conversation_history)
-        buffer = ""
-        content_received = False
+        coalescer = ChunkCoalescer(self.flush_policy)
+        key = self.cache_key(conversation_history, summary)
+        if key is not None:
+            cached = await self.response_cache.get(key)
+            if cached is not None:
+                # Replayed word by word through the flush policy so clients
+                # see the same chunking as a live stream
+                for word in re.findall(r"\S+\s*", cached):
+                    flushed = coalescer.push(word)
+                    if flushed:
+                        yield flushed
+                rest = coalescer.flush()
+                if rest:
+                    yield rest
+                return
+
+        messages = self.format_debate_messages(conversation_history, summary)
+        received: List[str] = []
 
         try:
-            async for chunk in self.llm.stream_chat_completion(messages=messages):
-                content = chunk.get("choices", [{}])[0].get(
-                    "delta", {}).get("content", "")
-
+            started = time.perf_counter()
+            async for content in self.llm.stream_chat_completion(messages=messages):
                 if content:
-                    content_received = True
-                    buffer += content
+                    received.append(content)
+                    flushed = coalescer.push(content)
+                    if flushed:
+                        yield flushed
 
-                    if any(punct in content for punct in ".!?\n") or len(buffer) > 100:
-                        yield buffer
-                        buffer = ""
+            rest = coalescer.flush()
+            if rest:
+                yield rest
 
-            if buffer:
-                yield buffer
-
-            if not content_received:
+            if not received:
                 raise ValueError("No content received from stream")
 
+            if key is not None:
+                await self.response_cache.set(
+                    key, "".join(received), time.perf_counter() - started)
+
+        except Overloaded:
+            raise
         except Exception as e:
             logger.error(f"Streaming error: {str(e)}")
             yield "[ERROR: Failed to generate response]"
@@ -0,0 +1,120 @@
+import asyncio
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from api.personas.batch_runner import BatchRunner, completed_ids, read_debates
+from api.personas.context_window import ContextWindow
+from api.services import http_client
+from api.services.llm_service import LLMService
+from bench.stub_llm import DEFAULT_RESPONSE, StubLLMServer
+
+
+def write_debates(path, count: int, turns: int = 3):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({
+                "id": f"debate-{i}",
+                "turns": [f"Argue that claim {i} is true", *(f"Rebuttal {t}" for t in range(turns - 1))],
+            }) + "\n")
+
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def runner(base_url: str, concurrency: int = 4) -> BatchRunner:
+    llm = LLMService(
+        api_key="stub", base_url=base_url, model="stub",
+        temperature=0.1, max_tokens=500, max_retries=1, flights=None,
+    )
+    return BatchRunner(llm, concurrency=concurrency, context_window=ContextWindow())
+
+
+@pytest.mark.asyncio
+async def test_run_streams_results_with_bounded_concurrency(tmp_path):
+    write_debates(tmp_path / "debates.jsonl", 12)
+    stub = StubLLMServer(latency=0.01)
+    base_url = await stub.start()
+    try:
+        report = await runner(base_url, concurrency=3).run(
+            str(tmp_path / "debates.jsonl"), str(tmp_path / "results.jsonl"))
+    finally:
+        await stub.stop()
+        await http_client.close_session()
+
+    assert stub.requests == 36
+    assert stub.max_in_flight <= 3
+    assert (report["debates"], report["failed"], report["turns"]) == (12, 0, 36)
+    assert report["turn_ms"]["p50"] >= report["ttft_ms"]["p50"] > 0
+    results = read_results(tmp_path / "results.jsonl")
+    assert {result["id"] for result in results} == {f"debate-{i}" for i in range(12)}
+    turns = results[0]["turns"]
+    assert [turn["user"] for turn in turns][1:] == ["Rebuttal 0", "Rebuttal 1"]
+    assert turns[0]["reply"].strip() == DEFAULT_RESPONSE
+
+
+@pytest.mark.asyncio
+async def test_resume_skips_completed_and_reruns_failed_debates(tmp_path):
+    debates, results = str(tmp_path / "debates.jsonl"), str(tmp_path / "results.jsonl")
+    write_debates(debates, 4)
+    with open(results, "w") as f:
+        f.write(json.dumps({"id": "debate-0", "turns": [], "seconds": 0.1}) + "\n")
+        f.write(json.dumps({"id": "debate-1", "turns": [], "error": "boom"}) + "\n")
+        # Cut short by a crash
+        f.write('{"id": "debate-2", "tur')
+    assert completed_ids(results) == {"debate-0"}
+
+    stub = StubLLMServer(stream_error_rate=1.0)
+    base_url = await stub.start()
+    try:
+        report = await runner(base_url).run(debates, results)
+        assert (report["skipped"], report["failed"], report["debates"]) == (1, 3, 0)
+        assert [result.get("error") is not None for result in read_results(results)] == [
+            False, True, True, True, True]
+
+        stub.stream_error_rate = 0.0
+        report = await runner(base_url).run(debates, results)
+    finally:
+        await stub.stop()
+        await http_client.close_session()
+    assert (report["skipped"], report["failed"], report["debates"]) == (1, 0, 3)
+    assert completed_ids(results) == {f"debate-{i}" for i in range(4)}
+
+
+@pytest.mark.asyncio
+async def test_bad_input_line_cancels_debates_in_flight(tmp_path):
+    debates, results = tmp_path / "debates.jsonl", tmp_path / "results.jsonl"
+    write_debates(debates, 3)
+    with open(debates, "a") as f:
+        f.write('{"id": "bad"}\n')
+
+    async def stream(messages):
+        await asyncio.Event().wait()
+        yield "never"
+
+    llm = Mock(spec=LLMService)
+    llm.stream_chat_completion = Mock(side_effect=stream)
+    with pytest.raises(ValueError, match="debates.jsonl:4"):
+        await BatchRunner(llm, concurrency=4).run(str(debates), str(results))
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+    assert results.read_bytes() == b""
+
+
+def test_read_debates_rejects_lines_without_turns(tmp_path):
+    path = tmp_path / "debates.jsonl"
+    path.write_text('{"id": "a", "turns": ["Argue"]}\n\n{"id": "b", "turns": []}\n')
+    debates = read_debates(str(path))
+    assert next(debates)["id"] == "a"
+    with pytest.raises(ValueError, match="debates.jsonl:3"):
+        next(debates)
+
+
+@pytest.mark.parametrize("line", ['["Argue"]', '"a"', "{not json}"])
+def test_read_debates_rejects_lines_that_are_not_debates(tmp_path, line):
+    path = tmp_path / "debates.jsonl"
+    path.write_text(f'{{"id": "a", "turns": ["Argue"]}}\n{line}\n')
+    with pytest.raises(ValueError, match="debates.jsonl:2: "):
+        list(read_debates(str(path)))
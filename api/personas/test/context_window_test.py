@@ -0,0 +1,67 @@
+from api.personas.context_window import ContextWindow
+
+SYSTEM = {"role": "system", "content": "persona"}
+
+
+def make_history(turns: int):
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Turn {i} makes a point. More words follow here.",
+        }
+        for i in range(turns)
+    ]
+
+
+def test_fit_keeps_everything_within_budget():
+    history = make_history(4)
+    assert ContextWindow(max_tokens=1000).fit(SYSTEM, history) == [SYSTEM, *history]
+
+
+def test_fit_keeps_system_opening_and_recent_turns():
+    history = make_history(40)
+    window = ContextWindow(max_tokens=200)
+    messages = window.fit(SYSTEM, history)
+    assert messages[0] == SYSTEM
+    assert messages[1] == history[0]
+    assert messages[-1] == history[-1]
+    assert len(messages) < len(history) + 1
+    assert sum(window.message_tokens(m) for m in messages) <= 200
+    assert messages[2:] == history[len(history) - len(messages) + 2:]
+
+
+def test_fit_always_keeps_latest_message():
+    history = [*make_history(3), {"role": "user", "content": "x" * 4000}]
+    messages = ContextWindow(max_tokens=50).fit(SYSTEM, history)
+    assert messages == [SYSTEM, history[0], history[-1]]
+
+
+def test_fit_replaces_dropped_turns_with_cached_summary():
+    history = make_history(40)
+    window = ContextWindow(max_tokens=300, summarize=True, summary_tokens=100)
+    messages = window.fit(SYSTEM, history)
+    summary = messages[2]
+    assert summary["role"] == "system"
+    assert "Summary of earlier turns" in summary["content"]
+    assert "makes a point." in summary["content"]
+    assert "More words" not in summary["content"]
+    assert sum(window.message_tokens(m) for m in messages) <= 300
+    assert window.fit(SYSTEM, history) == messages
+    assert len(window._summaries) == 1
+
+
+def test_fit_keeps_stored_summary_after_opening():
+    history = make_history(40)
+    window = ContextWindow(max_tokens=300, summarize=True, summary_tokens=100)
+    messages = window.fit(SYSTEM, history, summary="Earlier the user conceded.")
+    summary = messages[2]
+    assert summary["role"] == "system"
+    assert summary["content"].startswith(
+        "Summary of earlier turns:\nEarlier the user conceded.\n- ")
+    assert sum(window.message_tokens(m) for m in messages) <= 300
+
+    short = make_history(4)
+    assert ContextWindow(max_tokens=1000).fit(SYSTEM, short, summary="So far") == [
+        SYSTEM, short[0], {"role": "system", "content": "Summary of earlier turns:\nSo far"},
+        *short[1:],
+    ]
@@ -0,0 +1,41 @@
+from unittest.mock import Mock
+
+from api.personas.context_window import ContextWindow
+from api.personas.debate_persona import (
+    PERSONA_PROMPT,
+    DebatePersona,
+    normalize_prompt,
+)
+from api.services.llm_service import LLMService
+
+HISTORY = [
+    {"role": "user", "content": "Argue that Earth is flat"},
+    {"role": "assistant", "content": "Horizons are flat."},
+    {"role": "user", "content": "Ships disappear hull-first"},
+]
+
+
+def test_persona_prompt_is_normalized_once():
+    assert normalize_prompt(PERSONA_PROMPT) == PERSONA_PROMPT
+    assert "\n\n\n" not in PERSONA_PROMPT
+    assert not any(line != line.strip() for line in PERSONA_PROMPT.splitlines())
+    persona = DebatePersona(Mock(spec=LLMService))
+    assert persona.persona_instructions is PERSONA_PROMPT
+
+
+def test_format_debate_messages_without_cache_hints():
+    persona = DebatePersona(Mock(spec=LLMService), ContextWindow(), prompt_cache_hints=False)
+    assert persona.format_debate_messages(HISTORY) == [
+        {"role": "system", "content": PERSONA_PROMPT}, *HISTORY]
+
+
+def test_format_debate_messages_marks_stable_prefix_for_caching():
+    persona = DebatePersona(Mock(spec=LLMService), ContextWindow(), prompt_cache_hints=True)
+    messages = persona.format_debate_messages(HISTORY)
+    for message, text in zip(messages[:2], (PERSONA_PROMPT, HISTORY[0]["content"])):
+        assert message["content"] == [{
+            "type": "text",
+            "text": text,
+            "cache_control": {"type": "ephemeral"},
+        }]
+    assert messages[2:] == HISTORY[1:]
@@ -0,0 +1,214 @@
+"""
+Bulk export and import of conversations as NDJSON
+
+Export runs one LEFT JOIN of conversations and messages ordered by
+conversation and seq through a server-side cursor, fetching batch_size Core
+rows at a time, and yields one JSON line per message (a line with only the
+conversation id for conversations without messages). Import parses lines as
+the request body arrives and inserts them in batches with executemany, one
+transaction per batch, skipping ids already in the database so an import can
+be re-run. Both keep memory bounded by the batch size whatever the number of
+rows, optionally gzip-compressed on the fly. Compressed bodies are inflated
+at most DECOMPRESS_CHUNK bytes at a time and lines are capped at
+MAX_LINE_BYTES, so a small gzip bomb can't exhaust memory
+"""
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+import zlib
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from api.services.sse import dumps, loads
+from db.models import Conversation, Message
+
+BATCH_SIZE = 1000
+# zlib window bits for a gzip container, and for gzip or zlib auto-detection
+GZIP_WBITS = 31
+AUTO_WBITS = 47
+DECOMPRESS_CHUNK = 64 * 1024
+MAX_LINE_BYTES = 8 * 1024 * 1024
+ROLES = ("user", "bot")
+
+conversations = Conversation.__table__
+messages = Message.__table__
+
+
+def message_line(row) -> bytes:
+    """
+    NDJSON line of a message row
+    """
+    return dumps({
+        "conversation_id": row.conversation_id,
+        "id": row.id,
+        "seq": row.seq,
+        "role": row.role,
+        "content": row.content,
+        "timestamp": row.timestamp.isoformat(),
+    }) + b"\n"
+
+
+def message_row(data: Dict) -> Dict:
+    """
+    Message column values of a parsed message line, raises ValueError when a
+    field is missing or of the wrong type
+    """
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    for field in ("id", "conversation_id", "content", "timestamp"):
+        if not isinstance(data.get(field), str):
+            raise ValueError(f"{field} must be a string")
+    seq = data.get("seq")
+    if not isinstance(seq, int) or isinstance(seq, bool) or seq < 1:
+        raise ValueError("seq must be a positive integer")
+    if data.get("role") not in ROLES:
+        raise ValueError(f"role must be one of {', '.join(ROLES)}")
+    return {
+        "id": data["id"],
+        "conversation_id": data["conversation_id"],
+        "seq": data["seq"],
+        "role": data["role"],
+        "content": data["content"],
+        "timestamp": datetime.fromisoformat(data["timestamp"]),
+    }
+
+
+async def export_ndjson(
+    engine: AsyncEngine,
+    gzip: bool = False,
+    batch_size: int = BATCH_SIZE,
+) -> AsyncIterator[bytes]:
+    """
+    NDJSON lines of every message, one chunk per fetched batch
+    """
+    compressor = zlib.compressobj(wbits=GZIP_WBITS) if gzip else None
+    query = (
+        select(
+            conversations.c.id.label("conversation_id"),
+            messages.c.id,
+            messages.c.seq,
+            messages.c.role,
+            messages.c.content,
+            messages.c.timestamp,
+        )
+        .select_from(conversations.outerjoin(
+            messages, messages.c.conversation_id == conversations.c.id))
+        .order_by(conversations.c.id, messages.c.seq)
+        .execution_options(yield_per=batch_size)
+    )
+    async with engine.connect() as conn:
+        result = await conn.stream(query)
+        async for rows in result.partitions():
+            chunk = b"".join(
+                message_line(row) if row.id is not None
+                else dumps({"conversation_id": row.conversation_id}) + b"\n"
+                for row in rows
+            )
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def decompressed(decompressor, chunk: bytes) -> Iterator[bytes]:
+    """
+    Inflates chunk DECOMPRESS_CHUNK bytes at a time
+    """
+    while chunk:
+        yield decompressor.decompress(chunk, DECOMPRESS_CHUNK)
+        chunk = decompressor.unconsumed_tail
+
+
+async def ndjson_lines(
+    chunks: AsyncIterable[bytes],
+    gzip: bool = False,
+    max_line: int = MAX_LINE_BYTES,
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Splits a possibly compressed byte stream into non-blank lines and their
+    1-based line numbers, only the current partial line is kept between
+    chunks. Raises ValueError on lines longer than max_line
+    """
+    decompressor = zlib.decompressobj(wbits=AUTO_WBITS) if gzip else None
+    rest = b""
+    number = 0
+    async for chunk in chunks:
+        for piece in decompressed(decompressor, chunk) if decompressor else (chunk,):
+            lines = (rest + piece).split(b"\n")
+            rest = lines.pop()
+            if len(rest) > max_line:
+                raise ValueError(f"Line {number + 1} longer than {max_line} bytes")
+            for line in lines:
+                number += 1
+                if line.strip():
+                    yield number, line
+    if decompressor:
+        rest += decompressor.flush()
+    if rest.strip():
+        yield number + 1, rest
+
+
+async def import_ndjson(
+    engine: AsyncEngine,
+    chunks: AsyncIterable[bytes],
+    gzip: bool = False,
+    batch_size: int = BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Inserts the conversations and messages of an export, returns counts of
+    inserted and skipped (already present) rows
+    """
+    counts = {"conversations": 0, "messages": 0, "skipped": 0}
+    conversation_ids: List[str] = []
+    message_rows: List[Dict] = []
+    last_conversation: Optional[str] = None
+
+    async def write():
+        async with engine.begin() as conn:
+            new_conversations = await missing_ids(
+                conn, conversations, list(dict.fromkeys(conversation_ids)))
+            new_messages = await missing_ids(
+                conn, messages, [row["id"] for row in message_rows])
+            if new_conversations:
+                await conn.execute(
+                    insert(conversations), [{"id": id} for id in new_conversations])
+            rows = [row for row in message_rows if row["id"] in new_messages]
+            if rows:
+                await conn.execute(insert(messages), rows)
+        counts["conversations"] += len(new_conversations)
+        counts["messages"] += len(rows)
+        counts["skipped"] += len(message_rows) - len(rows)
+        conversation_ids.clear()
+        message_rows.clear()
+
+    async for number, line in ndjson_lines(chunks, gzip):
+        try:
+            data = loads(line)
+            if not isinstance(data, dict) or not isinstance(data.get("conversation_id"), str):
+                raise ValueError("expected an object with a conversation_id string")
+            row = message_row(data) if data.get("id") is not None else None
+        except ValueError as e:
+            raise ValueError(f"line {number}: {str(e)}") from None
+        if data["conversation_id"] != last_conversation:
+            last_conversation = data["conversation_id"]
+            conversation_ids.append(last_conversation)
+        if row is not None:
+            message_rows.append(row)
+        if len(message_rows) + len(conversation_ids) >= batch_size:
+            await write()
+    if message_rows or conversation_ids:
+        await write()
+    return counts
+
+
+async def missing_ids(conn: AsyncConnection, table, ids: List[str]) -> set:
+    """
+    The ids not in table yet, looked up batch_size at a time by the caller
+    """
+    if not ids:
+        return set()
+    result = await conn.execute(select(table.c.id).where(table.c.id.in_(ids)))
+    return set(ids) - set(result.scalars())
@@ -1,80 +1,377 @@
+import asyncio
 from datetime import datetime
-from typing import Dict, List
+import os
+from typing import Awaitable, Dict, List, Optional, Tuple
+import uuid
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 
-from db.models import Conversation, Message
+from api.services.history_cache import HistoryCache, history_cache as default_history_cache
+from api.services.message_journal import MessageJournal, message_journal as default_journal
+from api.services.metrics import DB_SECONDS, timed
+from api.services.state import WORKERS
+from db.models import Conversation, ConversationSummary, Message
+
+
+def format_message_for_llm(role: str, content: str) -> Dict:
+    """
+    user 'questions' expects to see the value "user"
+    llm responses expect to see the value "assistant"
+    """
+    return {
+        "role": "assistant" if role == "bot" else role,
+        "content": content
+    }
+
+
+"""
+Writes running off the request path, by conversation id. Reads of a
+conversation through ChatService wait for its pending write so a client that
+sends its next message right away still sees the previous turn. Other worker
+processes can't wait for it, so with several workers writes stay on the
+request path unless STREAM_WRITE_BEHIND=1
+"""
+WRITE_BEHIND = os.getenv("STREAM_WRITE_BEHIND", "1" if WORKERS == 1 else "0") == "1"
+_pending_writes: Dict[str, asyncio.Task] = {}
+
+# Writes renumbered and retried when a concurrent turn took the same seqs
+SEQ_ATTEMPTS = 5
+
+
+def write_in_background(conversation_id: str, write: Awaitable) -> asyncio.Task:
+    previous = _pending_writes.get(conversation_id)
+
+    async def run():
+        if previous is not None:
+            await asyncio.wait([previous])
+        await write
+
+    task = asyncio.create_task(run())
+    _pending_writes[conversation_id] = task
+
+    def done(finished: asyncio.Task):
+        if _pending_writes.get(conversation_id) is finished:
+            del _pending_writes[conversation_id]
+
+    task.add_done_callback(done)
+    return task
+
+
+async def wait_for_pending_write(conversation_id: str):
+    task = _pending_writes.get(conversation_id)
+    if task is not None:
+        await asyncio.wait([task])
+
+
+async def drain_pending_writes():
+    if _pending_writes:
+        await asyncio.wait(list(_pending_writes.values()))
 
 
 class ChatService:
-    def __init__(self, db: AsyncSession):
+    def __init__(
+        self,
+        db: AsyncSession,
+        history_cache: HistoryCache = default_history_cache,
+        journal: Optional[MessageJournal] = default_journal,
+    ):
+        """
+        With a journal, messages are queued there and committed in batches,
+        reads merge in the ones not committed yet
+        """
         self.db = db
+        self.history_cache = history_cache
+        self.journal = journal
+
+    def _pending(self, conversation_id: str) -> List[Message]:
+        """
+        Journaled messages not committed yet, read before querying so a batch
+        committed meanwhile shows up in one of both, duplicates are dropped by
+        _merge
+        """
+        return self.journal.pending_messages(conversation_id) if self.journal else []
+
+    @staticmethod
+    def _merge(committed: List[Message], pending: List[Message]) -> List[Message]:
+        ids = {message.id for message in committed}
+        return [*committed, *(message for message in pending if message.id not in ids)]
 
+    @timed(DB_SECONDS, "create_conversation")
     async def create_conversation(self) -> Conversation:
         db_conversation = Conversation()
         self.db.add(db_conversation)
         await self.db.commit()
         await self.db.refresh(db_conversation)
+        self.history_cache.fill(db_conversation.id, [])
         return db_conversation
 
-    async def get_conversation(self, conversation_id: str) -> Conversation:
-        result = await self.db.execute(
-            select(Conversation)
-            .where(Conversation.id == conversation_id)
-        )
+    @timed(DB_SECONDS, "get_conversation")
+    async def get_conversation(
+        self,
+        conversation_id: str,
+        with_messages: bool = False,
+    ) -> Conversation:
+        """
+        Relationships are not loaded unless requested, accessing them raises
+        """
+        query = select(Conversation).where(Conversation.id == conversation_id)
+        if with_messages:
+            query = query.options(selectinload(Conversation.messages))
+        result = await self.db.execute(query)
         db_conversation = result.scalars().first()
         if db_conversation is None:
             raise HTTPException(
                 status_code=404, detail=f"No conversation {conversation_id} found")
         return db_conversation
 
+    @timed(DB_SECONDS, "ensure_conversation_exists")
+    async def ensure_conversation_exists(self, conversation_id: str):
+        """
+        Existence check reading only the primary key, no ORM object is built
+        """
+        await wait_for_pending_write(conversation_id)
+        if self.journal and self.journal.has_conversation(conversation_id):
+            return
+        result = await self.db.execute(
+            select(Conversation.id)
+            .where(Conversation.id == conversation_id)
+        )
+        if result.first() is None:
+            raise HTTPException(
+                status_code=404, detail=f"No conversation {conversation_id} found")
+
+    @timed(DB_SECONDS, "next_seq")
+    async def next_seq(self, conversation_id: str) -> int:
+        """
+        Next message sequence number of a conversation, a single index lookup
+        on (conversation_id, seq)
+        """
+        last_seq = self.journal.last_seq(conversation_id) if self.journal else None
+        if last_seq is not None:
+            return last_seq + 1
+        result = await self.db.execute(
+            select(func.coalesce(func.max(Message.seq), 0))
+            .where(Message.conversation_id == conversation_id)
+        )
+        seq = result.scalar_one() + 1
+        # A turn may have been journaled while the query ran
+        last_seq = self.journal.last_seq(conversation_id) if self.journal else None
+        return seq if last_seq is None else max(seq, last_seq + 1)
+
+    async def _insert_messages(
+        self,
+        conversation_id: str,
+        rows: List[Dict],
+        new_conversation: bool = False,
+    ) -> List[Message]:
+        """
+        Numbers the rows from the next seq and writes them, to the journal or
+        in one transaction. Concurrent turns on a conversation can read the
+        same next seq, the one committing last violates the unique
+        (conversation_id, seq) constraint and is renumbered and retried
+        """
+        for attempt in range(SEQ_ATTEMPTS):
+            seq = 1 if new_conversation else await self.next_seq(conversation_id)
+            for offset, row in enumerate(rows):
+                row["seq"] = seq + offset
+            db_messages = [Message(**row) for row in rows]
+            if self.journal:
+                self.journal.append(
+                    rows, new_conversation=conversation_id if new_conversation else None)
+                return db_messages
+            if new_conversation:
+                self.db.add(Conversation(id=conversation_id))
+            self.db.add_all(db_messages)
+            try:
+                await self.db.commit()
+                return db_messages
+            except IntegrityError:
+                await self.db.rollback()
+                # A new conversation starts at seq 1, only its id can collide
+                if new_conversation or attempt == SEQ_ATTEMPTS - 1:
+                    raise
+
+    @timed(DB_SECONDS, "add_message")
     async def add_message(self, conversation_id: str, message: str, role: str) -> Message:
-        db_message = Message(
+        db_message, = await self._insert_messages(conversation_id, [dict(
+            id=str(uuid.uuid4()),
             conversation_id=conversation_id,
             content=message,
             role=role,
             timestamp=datetime.now(),
-        )
-        self.db.add(db_message)
-        await self.db.commit()
-        await self.db.refresh(db_message)
+        )])
+        self.history_cache.append(
+            conversation_id, format_message_for_llm(role, message))
         return db_message
 
+    @timed(DB_SECONDS, "add_turn")
+    async def add_turn(
+        self,
+        conversation_id: Optional[str],
+        user_message: str,
+        bot_message: str,
+        user_timestamp: Optional[datetime] = None,
+        new_conversation: bool = False,
+    ) -> Tuple[Message, Message]:
+        """
+        Persists a whole turn in a single transaction: the conversation row
+        when conversation_id is None (or new_conversation is set for an id
+        generated by the caller), the user message and the bot reply.
+        Ids and timestamps are generated client side so no refresh is needed
+        """
+        if conversation_id is None:
+            conversation_id = str(uuid.uuid4())
+            new_conversation = True
+        db_user_message, db_bot_message = await self._insert_messages(conversation_id, [
+            dict(
+                id=str(uuid.uuid4()),
+                conversation_id=conversation_id,
+                content=user_message,
+                role="user",
+                timestamp=user_timestamp or datetime.now(),
+            ),
+            dict(
+                id=str(uuid.uuid4()),
+                conversation_id=conversation_id,
+                content=bot_message,
+                role="bot",
+                timestamp=datetime.now(),
+            ),
+        ], new_conversation)
+
+        formatted = [
+            format_message_for_llm("user", user_message),
+            format_message_for_llm("bot", bot_message),
+        ]
+        if new_conversation:
+            self.history_cache.fill(conversation_id, formatted)
+        else:
+            for message in formatted:
+                self.history_cache.append(conversation_id, message)
+        return db_user_message, db_bot_message
+
+    @timed(DB_SECONDS, "get_messages")
     async def get_messages(
         self,
         conversation_id: str,
         skip: int = 0,
         limit: int = 10
     ) -> List[Message]:
-        result = await self.db.execute(
+        await wait_for_pending_write(conversation_id)
+        pending = self._pending(conversation_id)
+        query = (
             select(Message)
             .where(Message.conversation_id == conversation_id)
-            .order_by(Message.timestamp.desc())
-            .offset(skip)
-            .limit(limit)
+            .order_by(Message.timestamp.desc(), Message.seq.desc())
+        )
+        if not pending:
+            result = await self.db.execute(query.offset(skip).limit(limit))
+            return result.scalars().all()
+        result = await self.db.execute(query.limit(skip + limit))
+        messages = sorted(
+            self._merge(result.scalars().all(), pending),
+            key=lambda message: (message.timestamp, message.seq),
+            reverse=True,
         )
-        return result.scalars().all()
+        return messages[skip:skip + limit]
 
-    async def format_messages_for_llm(self, conversation_id: str) -> List[Dict]:
+    @timed(DB_SECONDS, "get_messages_before")
+    async def get_messages_before(
+        self,
+        conversation_id: str,
+        before: Optional[int] = None,
+        limit: int = 10,
+    ) -> List[Message]:
         """
-        Formats conversation messages for llm API
+        Keyset pagination, newest first: messages with seq lower than the
+        `before` cursor (the seq of the last message of the previous page)
+        """
+        await wait_for_pending_write(conversation_id)
+        pending = [
+            message for message in self._pending(conversation_id)
+            if before is None or message.seq < before
+        ]
+        query = select(Message).where(Message.conversation_id == conversation_id)
+        if before is not None:
+            query = query.where(Message.seq < before)
+        result = await self.db.execute(
+            query.order_by(Message.seq.desc()).limit(limit)
+        )
+        if not pending:
+            return result.scalars().all()
+        messages = sorted(
+            self._merge(result.scalars().all(), pending),
+            key=lambda message: message.seq,
+            reverse=True,
+        )
+        return messages[:limit]
 
-        user 'questions' expects to see the value "user"
-        llm responses expect to see the value "assistant"
+    @timed(DB_SECONDS, "format_messages_for_llm")
+    async def format_messages_for_llm(self, conversation_id: str) -> List[Dict]:
+        """
+        Formats conversation messages for llm API, served from the history
+        cache when warm and read from the database otherwise
         """
+        await wait_for_pending_write(conversation_id)
+        cached = self.history_cache.get(conversation_id)
+        if cached is not None:
+            return cached
+
+        token = self.history_cache.write_token()
+        pending = self._pending(conversation_id)
         result = await self.db.execute(
             select(Message)
             .where(Message.conversation_id == conversation_id)
-            .order_by(Message.timestamp.asc())
+            .order_by(Message.timestamp.asc(), Message.seq.asc())
+        )
+        messages = [
+            format_message_for_llm(msg.role, msg.content)
+            for msg in self._merge(result.scalars().all(), pending)
+        ]
+        self.history_cache.fill(conversation_id, messages, token)
+        return messages
+
+    @timed(DB_SECONDS, "format_summarized_messages")
+    async def format_summarized_messages(
+        self,
+        conversation_id: str,
+    ) -> Tuple[Optional[str], List[Dict]]:
+        """
+        Stored summary of the conversation and the messages it doesn't cover,
+        the opening one and those after its high-water mark. Without a
+        summary, None and the whole history
+        """
+        await wait_for_pending_write(conversation_id)
+        result = await self.db.execute(
+            select(ConversationSummary.summary, ConversationSummary.last_seq)
+            .where(ConversationSummary.conversation_id == conversation_id)
+        )
+        summary = result.first()
+        if summary is None:
+            return None, await self.format_messages_for_llm(conversation_id)
+
+        pending = [
+            message for message in self._pending(conversation_id)
+            if message.seq > summary.last_seq
+        ]
+        first_seq = (
+            select(func.min(Message.seq))
+            .where(Message.conversation_id == conversation_id)
+            .scalar_subquery()
+        )
+        result = await self.db.execute(
+            select(Message)
+            .where(
+                Message.conversation_id == conversation_id,
+                or_(Message.seq > summary.last_seq, Message.seq == first_seq),
+            )
+            .order_by(Message.seq.asc())
         )
-        messages = result.scalars().all()
-
-        return [
-            {
-                "role": "assistant" if msg.role == "bot" else msg.role,
-                "content": msg.content
-            }
-            for msg in messages
+        return summary.summary, [
+            format_message_for_llm(msg.role, msg.content)
+            for msg in self._merge(result.scalars().all(), pending)
         ]
@@ -0,0 +1,96 @@
+"""
+In-process LRU cache of conversation histories already formatted for the llm,
+so each turn appends to the cached list instead of re-reading the whole thread
+"""
+from collections import OrderedDict
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from api.services.state import WORKERS
+
+
+class HistoryCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict]]]" = OrderedDict()
+        # Last write per conversation, so a fill that raced with a write is dropped
+        self._writes = 0
+        self._last_write: "OrderedDict[str, int]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "HistoryCache":
+        # Off by default with several workers: turns written by another worker
+        # would never invalidate this one's copy
+        return cls(
+            maxsize=int(os.getenv("HISTORY_CACHE_SIZE", 1024 if WORKERS == 1 else 0)),
+            ttl=float(os.getenv("HISTORY_CACHE_TTL", 600)),
+        )
+
+    def get(self, conversation_id: str) -> Optional[List[Dict]]:
+        """
+        Returns a copy of the cached history, or None if cold or expired
+        """
+        entry = self._entries.get(conversation_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._entries[conversation_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return list(entry[1])
+
+    def write_token(self) -> int:
+        """
+        Token to take before reading a history from the database, pass it to
+        fill() so the result is discarded if a write happened in between
+        """
+        return self._writes
+
+    def fill(self, conversation_id: str, messages: List[Dict], token: Optional[int] = None):
+        if self.maxsize <= 0:
+            return
+        if token is not None and self._last_write.get(conversation_id, -1) > token:
+            return
+        self._entries[conversation_id] = (time.monotonic(), list(messages))
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def append(self, conversation_id: str, message: Dict):
+        """
+        Appends to a warm entry, cold conversations are left to the database
+        """
+        self._writes += 1
+        self._last_write[conversation_id] = self._writes
+        self._last_write.move_to_end(conversation_id)
+        while len(self._last_write) > max(self.maxsize, 1):
+            self._last_write.popitem(last=False)
+
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            entry[1].append(message)
+            self._entries[conversation_id] = (time.monotonic(), entry[1])
+
+    def invalidate(self, conversation_id: str):
+        self._entries.pop(conversation_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+history_cache = HistoryCache.from_env()
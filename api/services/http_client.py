@@ -0,0 +1,148 @@
+"""
+Process-wide aiohttp connection pool shared by every LLMService instance, so
+upstream calls reuse keep-alive connections instead of paying a TCP+TLS
+handshake per request
+
+The pool is opened in the app lifespan; it is also created lazily on first use
+so tests and benchmarks that skip the lifespan still get pooled connections
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import os
+from typing import Dict, Optional
+
+import aiohttp
+
+
+class PoolMetrics:
+    """
+    Connection counters collected through aiohttp trace hooks
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.queued = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_connection_queued_start.append(self._on_queued)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+
+    async def _on_connection_create(self, session, context, params):
+        self.new_connections += 1
+
+    async def _on_connection_reuse(self, session, context, params):
+        self.reused_connections += 1
+
+    async def _on_queued(self, session, context, params):
+        self.queued += 1
+
+    @property
+    def reuse_rate(self) -> float:
+        total = self.new_connections + self.reused_connections
+        return self.reused_connections / total if total else 0.0
+
+
+class HTTPClientPool:
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: float = 30,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.metrics = PoolMetrics()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def from_env(cls) -> "HTTPClientPool":
+        return cls(
+            limit=int(os.getenv("LLM_POOL_LIMIT", 100)),
+            limit_per_host=int(os.getenv("LLM_POOL_LIMIT_PER_HOST", 20)),
+            ttl_dns_cache=int(os.getenv("LLM_POOL_DNS_TTL", 300)),
+            keepalive_timeout=float(os.getenv("LLM_POOL_KEEPALIVE", 30)),
+        )
+
+    def open(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[self.metrics.trace_config()],
+        )
+        self._loop = asyncio.get_running_loop()
+        return self._session
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        A session is bound to the loop it was created on, so a new one is
+        opened if the loop changed (e.g. between test clients)
+        """
+        if (
+            self._session is None
+            or self._session.closed
+            or self._loop is not asyncio.get_running_loop()
+        ):
+            return self.open()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+    def stats(self) -> Dict:
+        connector = self._session.connector if self._session else None
+        # aiohttp does not expose acquired connections publicly
+        in_use = len(getattr(connector, "_acquired", ())) if connector else 0
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "in_use": in_use,
+            "utilization": in_use / self.limit if self.limit else 0.0,
+            "requests": self.metrics.requests,
+            "new_connections": self.metrics.new_connections,
+            "reused_connections": self.metrics.reused_connections,
+            "reuse_rate": self.metrics.reuse_rate,
+            "queued": self.metrics.queued,
+        }
+
+
+pool = HTTPClientPool.from_env()
+
+
+def get_session() -> aiohttp.ClientSession:
+    return pool.session
+
+
+async def close_session():
+    await pool.close()
+
+
+@asynccontextmanager
+async def pool_lifespan():
+    pool.open()
+    try:
+        yield pool
+    finally:
+        await pool.close()
@@ -0,0 +1,325 @@
+"""
+Latency-aware routing across several LLM backends
+
+LLMRouter has the LLMService call interface and spreads calls over a list of
+backends (provider and model pairs). It keeps an EWMA of time to first token
+and of the error rate per backend and sends each call to the fastest healthy
+one, failing over to the next when a call fails before its first token. The
+error rate halves every breaker reset_timeout without calls, and a backend
+not called for that long goes first once, so a demoted or slow backend is
+measured again and can recover. With hedging on, a second backend is raced when the first token takes longer than
+the primary's p95, the slower one is cancelled
+"""
+import asyncio
+from collections import deque
+import json
+import os
+import time
+from typing import AsyncGenerator, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from fastapi.logger import logger
+
+from api.services.llm_service import LLMService
+from api.services.overload import AdaptiveLimiter, CircuitBreaker, Overloaded
+
+
+class BackendStats:
+    def __init__(
+        self,
+        alpha: float = 0.2,
+        window: int = 100,
+        half_life: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.alpha = alpha
+        self.half_life = half_life
+        self.clock = clock
+        self.ttft: Optional[float] = None
+        self.requests = 0
+        self.errors = 0
+        self.last_call: Optional[float] = None
+        self._error_rate = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    @property
+    def error_rate(self) -> float:
+        """
+        Error rate EWMA, halving every half_life seconds since the last call
+        """
+        if self.last_call is None:
+            return self._error_rate
+        return self._error_rate * 0.5 ** ((self.clock() - self.last_call) / self.half_life)
+
+    def idle_for(self) -> float:
+        return float("inf") if self.last_call is None else self.clock() - self.last_call
+
+    def record_success(self, ttft: float):
+        self.requests += 1
+        self.ttft = ttft if self.ttft is None else (
+            self.alpha * ttft + (1 - self.alpha) * self.ttft)
+        self._error_rate = self.error_rate * (1 - self.alpha)
+        self.last_call = self.clock()
+        self._recent.append(ttft)
+
+    def record_error(self):
+        self.requests += 1
+        self.errors += 1
+        self._error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+        self.last_call = self.clock()
+
+    def p95(self) -> Optional[float]:
+        if not self._recent:
+            return None
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    @property
+    def samples(self) -> int:
+        return len(self._recent)
+
+
+class LLMRouter:
+    def __init__(
+        self,
+        backends: List[LLMService],
+        hedge: bool = False,
+        hedge_delay: float = 2.0,
+        hedge_min_samples: int = 20,
+        max_error_rate: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not backends:
+            raise ValueError("LLMRouter needs at least one backend")
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_error_rate = max_error_rate
+        self.stats_by_backend = {
+            id(backend): BackendStats(half_life=backend.breaker.reset_timeout, clock=clock)
+            for backend in backends
+        }
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Read by the response cache key
+        self.model = ",".join(backend.model for backend in backends)
+        self.temperature = backends[0].temperature
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMRouter"]:
+        """
+        None unless LLM_BACKENDS lists backends as a JSON array of
+        {"base_url", "model", "api_key_env"} objects
+        """
+        config = os.getenv("LLM_BACKENDS")
+        if not config:
+            return None
+        backends = []
+        for backend in json.loads(config):
+            api_key = os.getenv(backend.get("api_key_env", "OPENROUTER_API_KEY"))
+            if not api_key:
+                raise ValueError(f"No api key set for LLM backend {backend['base_url']}")
+            backends.append(LLMService(
+                api_key=api_key,
+                base_url=backend["base_url"],
+                model=backend["model"],
+                temperature=float(backend.get("temperature", 0.1)),
+                max_tokens=int(backend.get("max_tokens", 500)),
+                # Each provider gets its own concurrency limit and breaker
+                limiter=AdaptiveLimiter.from_env(),
+                breaker=CircuitBreaker.from_env(),
+            ))
+        return cls(
+            backends,
+            hedge=os.getenv("LLM_HEDGE", "0") == "1",
+            hedge_delay=float(os.getenv("LLM_HEDGE_DELAY", 2.0)),
+        )
+
+    def stats_for(self, backend: LLMService) -> BackendStats:
+        return self.stats_by_backend[id(backend)]
+
+    @staticmethod
+    def label(backend: LLMService) -> str:
+        return f"{backend.model}@{urlparse(backend.base_url).netloc}"
+
+    def healthy(self, backend: LLMService) -> bool:
+        return (
+            self.stats_for(backend).error_rate < self.max_error_rate
+            and backend.breaker.state != "open"
+        )
+
+    def due_for_probe(self, backend: LLMService) -> bool:
+        """
+        True for backends not called for a breaker reset_timeout, whose error
+        rate and time to first token are stale
+        """
+        return (
+            self.stats_for(backend).idle_for() >= backend.breaker.reset_timeout
+            and backend.breaker.state != "open"
+        )
+
+    def ranked(self) -> List[LLMService]:
+        """
+        Healthy backends first, fastest first. Backends never called yet or
+        due for a probe come first so each one gets measured
+        """
+        def key(backend: LLMService) -> Tuple[bool, float]:
+            stats = self.stats_for(backend)
+            if self.due_for_probe(backend):
+                return (False, -1.0)
+            return (
+                not self.healthy(backend),
+                float("inf") if stats.ttft is None else stats.ttft,
+            )
+        return sorted(self.backends, key=key)
+
+    def hedge_after(self, backend: LLMService) -> float:
+        stats = self.stats_for(backend)
+        if stats.samples < self.hedge_min_samples:
+            return self.hedge_delay
+        return stats.p95()
+
+    def admit(self):
+        """
+        Raises Overloaded when no backend would take a call
+        """
+        error = None
+        for backend in self.backends:
+            try:
+                backend.admit()
+                return
+            except Overloaded as e:
+                error = e
+        raise error
+
+    async def chat_completion(self, messages: List[Dict]) -> Dict:
+        return await self._first_of(
+            lambda backend: backend.chat_completion(messages))
+
+    async def stream_chat_completion(
+        self,
+        messages: List[Dict],
+    ) -> AsyncGenerator[str, None]:
+        async def open_stream(backend: LLMService) -> Tuple[AsyncIterator[str], str]:
+            stream = backend.stream_chat_completion(messages)
+            try:
+                return stream, await stream.__anext__()
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        async def discard(result: Tuple[AsyncIterator[str], str]):
+            await result[0].aclose()
+
+        stream, first = await self._first_of(open_stream, discard)
+        try:
+            yield first
+            async for content in stream:
+                yield content
+        finally:
+            await stream.aclose()
+
+    async def _first_of(self, call, discard=None):
+        """
+        Runs call(backend) on the best backend, failing over and hedging
+        until one returns. call returns once the first token arrived, discard
+        releases the result of a hedged call that finished second
+        """
+        candidates = self.ranked()
+        running: Dict[asyncio.Task, LLMService] = {}
+        error: Optional[BaseException] = None
+
+        def start(backend: LLMService):
+            task = asyncio.ensure_future(self._timed(backend, call))
+            running[task] = backend
+
+        start(candidates.pop(0))
+        try:
+            while running:
+                primary = next(iter(running.values()))
+                timeout = (
+                    self.hedge_after(primary)
+                    if self.hedge and candidates and len(running) == 1 else None
+                )
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    start(candidates.pop(0))
+                    continue
+                for task in done:
+                    backend = running.pop(task)
+                    if task.exception() is None:
+                        if running:
+                            self.hedge_wins += backend is not primary
+                        return task.result()
+                    error = task.exception()
+                    logger.warning(f"LLM backend {backend.base_url} failed: {error}")
+                if not running and candidates:
+                    start(candidates.pop(0))
+            raise error
+        finally:
+            for task in running:
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    async def _timed(self, backend: LLMService, call):
+        started = time.monotonic()
+        try:
+            result = await call(backend)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats_for(backend).record_error()
+            raise
+        self.stats_for(backend).record_success(time.monotonic() - started)
+        return result
+
+    def concurrency(self) -> Dict[Tuple[str, str], float]:
+        """
+        Concurrency limit, calls in flight and queued calls of each backend,
+        keyed on (backend, value) gauge labels
+        """
+        values = {}
+        for backend in self.backends:
+            limiter = backend.limiter.stats()
+            for value in ("limit", "in_flight", "queued"):
+                values[(self.label(backend), value)] = limiter[value]
+        return values
+
+    def breaker_states(self) -> Dict[Tuple[str, str], float]:
+        """
+        1 for the breaker state each backend is in and 0 for the others, keyed
+        on (backend, state) gauge labels
+        """
+        return {
+            (self.label(backend), state): int(backend.breaker.state == state)
+            for backend in self.backends
+            for state in ("closed", "half_open", "open")
+        }
+
+    def stats(self) -> Dict:
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "backends": [
+                {
+                    "backend": self.label(backend),
+                    "healthy": self.healthy(backend),
+                    "ttft_ewma": self.stats_for(backend).ttft,
+                    "ttft_p95": self.stats_for(backend).p95(),
+                    "error_rate": self.stats_for(backend).error_rate,
+                    "requests": self.stats_for(backend).requests,
+                    "limit": int(backend.limiter.limit),
+                    "in_flight": backend.limiter.in_flight,
+                    "breaker": backend.breaker.state,
+                }
+                for backend in self.backends
+            ],
+        }
+
+
+default_router = LLMRouter.from_env()
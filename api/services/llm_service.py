@@ -1,11 +1,34 @@
 import asyncio
-from datetime import time
+from contextlib import asynccontextmanager
+import hashlib
 import json
 import os
-from typing import AsyncGenerator, Dict, List, Optional
+import time
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional
 import aiohttp
 from fastapi.logger import logger
-import requests
+
+from api.services import http_client
+from api.services.metrics import LLM_SECONDS, LLM_TOKENS_PER_SECOND, LLM_TTFT_SECONDS
+from api.services.overload import (
+    BUSY_STATUSES,
+    AdaptiveLimiter,
+    CircuitBreaker,
+    Overloaded,
+    Slot,
+    UpstreamBusy,
+    backoff_delay,
+    parse_retry_after,
+    upstream_breaker,
+    upstream_limiter,
+)
+from api.services.single_flight import SingleFlight, single_flight
+from api.services.sse import dumps
+from api.services.sse_parser import delta_content, iter_events
+
+# Identical concurrent requests (e.g. a client retrying after its connection
+# dropped) share one upstream call
+COALESCE_REQUESTS = os.getenv("LLM_COALESCE", "1") == "1"
 
 
 class LLMService:
@@ -18,6 +41,10 @@ class LLMService:
         max_tokens: int,
         timeout: int = 60,
         max_retries: int = 3,
+        session: Optional[aiohttp.ClientSession] = None,
+        flights: Optional[SingleFlight] = single_flight if COALESCE_REQUESTS else None,
+        limiter: AdaptiveLimiter = upstream_limiter,
+        breaker: CircuitBreaker = upstream_breaker,
     ):
         self.api_key = api_key
         self.base_url = base_url
@@ -26,18 +53,44 @@ class LLMService:
         self.max_tokens = max_tokens
         self.timeout = timeout
         self.max_retries = max_retries
-        self.session = requests.Session()
+        self._session = session
+        self.flights = flights
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Session used for upstream calls, defaults to the process-wide pool
+        """
+        return self._session or http_client.get_session()
+
+    def admit(self):
+        """
+        Raises Overloaded when a call would be rejected anyway, before a
+        response is started
+        """
+        self.breaker.check()
+        self.limiter.check()
+
+    @asynccontextmanager
+    async def upstream_attempt(self) -> AsyncIterator[Slot]:
+        """
+        One upstream attempt through the circuit breaker and concurrency limit
+        """
+        with self.breaker.attempt():
+            async with self.limiter.slot() as slot:
+                yield slot
+
+    def flight_key(self, payload: Dict) -> str:
+        digest = hashlib.sha256(f"{self.base_url}\0{self.api_key}\0".encode())
+        digest.update(dumps(payload))
+        return digest.hexdigest()
 
-    def chat_completion(
+    async def chat_completion(
         self,
         messages: List[Dict],
     ) -> Dict:
-        url = f"{self.base_url}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "model": self.model,
             "messages": messages,
@@ -45,28 +98,50 @@ class LLMService:
             "max_tokens": self.max_tokens,
             "presence_penalty": 1.0,
         }
+        started = time.perf_counter()
+        try:
+            if self.flights is None:
+                response = await self._chat_completion(payload)
+            else:
+                response = await self.flights.call(
+                    self.flight_key(payload), lambda: self._chat_completion(payload))
+        finally:
+            LLM_SECONDS.observe(time.perf_counter() - started, "completion")
+        LLM_TTFT_SECONDS.observe(time.perf_counter() - started, "completion")
+        return response
+
+    async def _chat_completion(self, payload: Dict) -> Dict:
+        url = f"{self.base_url}/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
 
         for attempt in range(self.max_retries):
             try:
-                response = self.session.post(
-                    url=url,
+                async with self.upstream_attempt(), self.session.post(
+                    url,
                     headers=headers,
                     json=payload,
-                    timeout=self.timeout
-                )
-                response.raise_for_status()
-                data = response.json()
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                ) as response:
+                    raise_for_busy(response)
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
 
                 if not data.get('choices') or not data['choices'][0].get('message'):
                     raise ValueError("Invalid LLM response structure")
 
                 return data
 
-            except requests.exceptions.RequestException as e:
+            except (UpstreamBusy, aiohttp.ClientError, asyncio.TimeoutError) as e:
                 if attempt == self.max_retries - 1:
+                    if isinstance(e, Overloaded):
+                        raise
                     raise Exception(
                         f"LLM API failed after {self.max_retries} attempts: {str(e)}")
-                time.sleep(1 * (attempt + 1))  # Exponential backoff
+                await asyncio.sleep(
+                    backoff_delay(attempt, getattr(e, "retry_after_header", None)))
             except json.JSONDecodeError as e:
                 raise Exception(f"Failed to decode LLM response: {str(e)}")
             except ValueError as e:
@@ -75,14 +150,10 @@ class LLMService:
     async def stream_chat_completion(
         self,
         messages: List[Dict],
-    ) -> AsyncGenerator[Dict, None]:
-        url = f"{self.base_url}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream"
-        }
-
+    ) -> AsyncGenerator[str, None]:
+        """
+        Yields the text deltas of the completion as they arrive
+        """
         payload = {
             "model": self.model,
             "messages": messages,
@@ -91,36 +162,84 @@ class LLMService:
             "max_tokens": self.max_tokens,
             "presence_penalty": 1.0,
         }
+        if self.flights is None:
+            stream = self._stream_chat_completion(payload)
+        else:
+            stream = self.flights.stream(
+                self.flight_key(payload), lambda: self._stream_chat_completion(payload))
+        started = time.perf_counter()
+        first_at = None
+        deltas = 0
+        try:
+            async for content in stream:
+                if first_at is None:
+                    first_at = time.perf_counter()
+                    LLM_TTFT_SECONDS.observe(first_at - started, "stream")
+                deltas += 1
+                yield content
+        finally:
+            await stream.aclose()
+            ended = time.perf_counter()
+            LLM_SECONDS.observe(ended - started, "stream")
+            if deltas > 1 and ended > first_at:
+                LLM_TOKENS_PER_SECOND.observe((deltas - 1) / (ended - first_at))
 
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=self.timeout)
-        ) as session:
-            for attempt in range(self.max_retries):
-                try:
-                    async with session.post(url, headers=headers, json=payload) as response:
-                        if response.status != 200:
-                            error = await response.text()
-                            raise Exception(f"LLM API error: {error}")
-
-                        async for line in response.content:
-                            if line.startswith(b"data: "):
-                                chunk = line[6:].strip()
-                                if chunk != b"[DONE]":
-                                    try:
-                                        data = json.loads(chunk)
-                                        if not data.get('choices'):
-                                            continue
-                                        yield data
-                                    except json.JSONDecodeError:
-                                        continue
-                        return  # Success - exit retry loop
-
-                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                    if attempt == self.max_retries - 1:
-                        logger.error(
-                            f"LLM streaming failed after {self.max_retries} attempts: {str(e)}")
-                        raise
-                    await asyncio.sleep(1 * (attempt + 1))
+    async def _stream_chat_completion(self, payload: Dict) -> AsyncGenerator[str, None]:
+        url = f"{self.base_url}/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        }
+
+        yielded = False
+        for attempt in range(self.max_retries):
+            try:
+                async with self.upstream_attempt() as slot, self.session.post(
+                    url,
+                    headers=headers,
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                ) as response:
+                    raise_for_busy(response)
+                    if response.status != 200:
+                        error = await response.text()
+                        raise Exception(f"LLM API error: {error}")
+
+                    async for event in iter_events(response.content.iter_any()):
+                        if event.data == "[DONE]":
+                            break
+                        if event.event == "error":
+                            raise ValueError(f"LLM stream error: {event.data}")
+                        try:
+                            content = delta_content(event.data)
+                        except json.JSONDecodeError:
+                            logger.warning(
+                                f"Skipping malformed stream event: {event.data[:100]}")
+                            continue
+                        if content:
+                            slot.first_byte()
+                            yielded = True
+                            yield content
+                    return  # Success - exit retry loop
+
+            except (UpstreamBusy, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Retrying after content was yielded would duplicate it
+                if yielded or attempt == self.max_retries - 1:
+                    logger.error(
+                        f"LLM streaming failed after {attempt + 1} attempts: {str(e)}")
+                    raise
+                await asyncio.sleep(
+                    backoff_delay(attempt, getattr(e, "retry_after_header", None)))
+
+
+def raise_for_busy(response: aiohttp.ClientResponse):
+    """
+    Raises UpstreamBusy on rate limiting and server errors, honoring Retry-After
+    """
+    if response.status in BUSY_STATUSES:
+        raise UpstreamBusy(
+            response.status, parse_retry_after(response.headers.get("Retry-After")))
 
 
 def get_llm(
@@ -132,6 +251,9 @@ def get_llm(
     timeout: int = 60,
     max_retries: int = 3,
 ) -> LLMService:
+    from api.services.llm_router import default_router
+    if default_router is not None:
+        return default_router
     api_key = api_key or os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         raise ValueError("OPENROUTER_API_KEY not set in environment")
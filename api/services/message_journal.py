@@ -0,0 +1,411 @@
+"""
+Write-behind journal of chat turns with group commit
+
+Each turn written through ChatService costs a commit, and on SQLite a commit
+is an fsync, so the turn rate is bounded by disk sync latency. With the
+journal on, turns are appended to an in-memory queue and, when a path is
+set, to an append-only file of JSON lines, and acknowledged right away. A
+background task writes them to the database every flush_interval seconds or
+batch_size messages, whichever comes first, with multi-row INSERTs in one
+transaction. Journal lines left by a crash are replayed on startup, rows
+already in the database are skipped. Lines are written without fsync, they
+survive the process crashing but not the host losing power. An entry whose
+seqs were taken by another writer meanwhile is renumbered after theirs,
+entries the database still refuses are set aside in a `.rejected` file next
+to the journal rather than dropped, when flushing as when replaying, so a
+bad line never stops the app from starting.
+
+Pending turns stay visible to the ChatService reads of this process until
+they are committed. Other worker processes can't see them, and a journal
+file belongs to one process: it is locked while open and refused with
+several workers
+"""
+import asyncio
+from collections import deque
+from datetime import datetime
+import fcntl
+import os
+from typing import Deque, Dict, Iterable, List, Optional, Set
+
+from fastapi.logger import logger
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from api.services.metrics import DB_SECONDS, timed
+from api.services.sse import dumps, loads
+from api.services.state import WORKERS
+from db.models import Conversation, Message
+
+# Rows per INSERT statement, keeps 6 columns per row under the bind parameter
+# limits of SQLite (32766) and Postgres (32767)
+INSERT_CHUNK = 500
+
+
+class JournalEntry:
+    """
+    One write: an optional new conversation and its messages as column dicts
+    """
+    __slots__ = ("conversation_id", "messages", "line")
+
+    def __init__(self, conversation_id: Optional[str], messages: List[Dict], line: bytes):
+        self.conversation_id = conversation_id
+        self.messages = messages
+        self.line = line
+
+    @classmethod
+    def create(
+        cls,
+        messages: List[Dict],
+        new_conversation: Optional[str] = None,
+    ) -> "JournalEntry":
+        line = dumps({
+            "conversation": new_conversation,
+            "messages": [
+                {**message, "timestamp": message["timestamp"].isoformat()}
+                for message in messages
+            ],
+        }) + b"\n"
+        return cls(new_conversation, messages, line)
+
+    @classmethod
+    def parse(cls, line: bytes) -> "JournalEntry":
+        data = loads(line)
+        messages = [
+            {**message, "timestamp": datetime.fromisoformat(message["timestamp"])}
+            for message in data["messages"]
+        ]
+        return cls(data["conversation"], messages, line)
+
+
+class MessageJournal:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        batch_size: int = 500,
+        flush_interval: float = 0.01,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.engine: Optional[AsyncEngine] = None
+        # Entries not picked up by a flush yet
+        self._queue: List[JournalEntry] = []
+        self._queued_rows = 0
+        # Everything not committed yet, including the flush in progress
+        self._messages: Dict[str, Deque[Message]] = {}
+        self._conversations: Set[str] = set()
+        self._file = None
+        # The compacted file being swapped in, appends go to both meanwhile
+        self._next_file = None
+        self._lock_file = None
+        self._has_pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.replayed_rows = 0
+        self.renumbered_rows = 0
+        self.rejected_rows = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["MessageJournal"]:
+        """
+        None unless MESSAGE_JOURNAL=1
+        """
+        if os.getenv("MESSAGE_JOURNAL", "0") != "1":
+            return None
+        path = os.getenv("MESSAGE_JOURNAL_PATH") or None
+        if path and WORKERS > 1:
+            raise ValueError(
+                f"MESSAGE_JOURNAL_PATH can't be shared by {WORKERS} workers, "
+                "run a single worker to use a journal file")
+        return cls(
+            path=path,
+            batch_size=int(os.getenv("MESSAGE_JOURNAL_BATCH", 500)),
+            flush_interval=float(os.getenv("MESSAGE_JOURNAL_INTERVAL_MS", 10)) / 1000,
+        )
+
+    async def start(self, engine: AsyncEngine):
+        """
+        Replays the journal file left by the previous process, then starts
+        the flush task
+        """
+        self.engine = engine
+        if self.path:
+            self._lock()
+            if os.path.exists(self.path):
+                entries = []
+                with open(self.path, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            entries.append(JournalEntry.parse(line))
+                        except (ValueError, KeyError, TypeError) as e:
+                            # e.g. a line cut short by the crash
+                            self._reject(JournalEntry(None, [], line.rstrip(b"\n") + b"\n"), e)
+                if entries:
+                    self.replayed_rows = await self._replay(entries)
+                    logger.info(f"Replayed {self.replayed_rows} journaled messages")
+            self._file = open(self.path, "wb", buffering=0)
+        self._task = asyncio.create_task(self._run())
+
+    async def _replay(self, entries: List[JournalEntry]) -> int:
+        """
+        Writes entries left by the previous process, one by one as in flush
+        when they fail together, so a conflicting entry can't block startup
+        """
+        try:
+            return await self._write(entries, skip_existing=True)
+        except IntegrityError:
+            rows = 0
+            for entry in entries:
+                rows += await self._write_alone(entry)
+            return rows
+
+    async def stop(self):
+        """
+        Flushes what is pending and stops the flush task
+        """
+        if self._task is not None:
+            # Not while it flushes, a batch cancelled after its commit would be
+            # queued again
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _lock(self):
+        """
+        Raises unless this is the only process using the journal file
+        """
+        self._lock_file = open(self.path + ".lock", "wb")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(
+                f"Message journal {self.path} is in use by another process") from None
+
+    def append(self, messages: List[Dict], new_conversation: Optional[str] = None):
+        """
+        Queues messages, given as Message column dicts, and the conversation
+        row when new_conversation is set. When the journal has a path, they
+        are in the file, not yet synced to disk, once this returns
+        """
+        entry = JournalEntry.create(messages, new_conversation)
+        if self._file is not None:
+            self._file.write(entry.line)
+        if self._next_file is not None:
+            self._next_file.write(entry.line)
+        self._queue.append(entry)
+        self._queued_rows += len(messages)
+        self._track(entry)
+        self._has_pending.set()
+        if self._queued_rows >= self.batch_size:
+            self._full.set()
+
+    def _track(self, entry: JournalEntry):
+        if entry.conversation_id is not None:
+            self._conversations.add(entry.conversation_id)
+        for message in entry.messages:
+            self._messages.setdefault(
+                message["conversation_id"], deque()).append(Message(**message))
+
+    def _untrack(self, entries: Iterable[JournalEntry]):
+        for entry in entries:
+            self._conversations.discard(entry.conversation_id)
+            for message in entry.messages:
+                pending = self._messages[message["conversation_id"]]
+                pending.popleft()
+                if not pending:
+                    del self._messages[message["conversation_id"]]
+
+    def has_conversation(self, conversation_id: str) -> bool:
+        return conversation_id in self._conversations
+
+    def pending_messages(self, conversation_id: str) -> List[Message]:
+        """
+        Uncommitted messages of a conversation, in seq order
+        """
+        return list(self._messages.get(conversation_id, ()))
+
+    def last_seq(self, conversation_id: str) -> Optional[int]:
+        pending = self._messages.get(conversation_id)
+        return pending[-1].seq if pending else None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._has_pending.wait()
+            deadline = loop.time() + self.flush_interval
+            while self._queued_rows < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.flush()
+            except Exception as e:
+                # Entries stay queued, retry after the next interval
+                logger.error(f"Failed to flush message journal: {str(e)}")
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        """
+        Commits every queued entry in one transaction
+        """
+        async with self._flush_lock:
+            if not self._queue:
+                return
+            batch, self._queue, self._queued_rows = self._queue, [], 0
+            self._has_pending.clear()
+            self._full.clear()
+            try:
+                rows = await self._write(batch)
+            except IntegrityError:
+                # A bad entry fails the whole batch, write them one by one.
+                # Rows of a batch requeued after an error past its commit are
+                # already there
+                rows = 0
+                for entry in batch:
+                    rows += await self._write_alone(entry)
+            except BaseException:
+                self._queue[:0] = batch
+                self._queued_rows += sum(len(entry.messages) for entry in batch)
+                self._has_pending.set()
+                raise
+            self._untrack(batch)
+            await self._compact()
+            self.flushes += 1
+            self.flushed_rows += rows
+
+    async def _compact(self):
+        """
+        Rewrites the journal file with the entries queued while flushing, off
+        the event loop. Entries appended meanwhile go to both files, so the
+        one at path has every uncommitted entry at any time
+        """
+        if self._file is None:
+            return
+        written = len(self._queue)
+        temporary = self.path + ".tmp"
+        self._next_file = await asyncio.to_thread(
+            self._rewrite, temporary, [entry.line for entry in self._queue])
+        self._next_file.writelines(entry.line for entry in self._queue[written:])
+        await asyncio.to_thread(os.replace, temporary, self.path)
+        self._file.close()
+        self._file, self._next_file = self._next_file, None
+
+    @staticmethod
+    def _rewrite(path: str, lines: List[bytes]):
+        f = open(path, "wb", buffering=0)
+        f.writelines(lines)
+        return f
+
+    async def _write_alone(self, entry: JournalEntry) -> int:
+        """
+        Writes entry on its own, renumbered after the conversation's last
+        committed seq if that fails, and rejected if that fails too
+        """
+        try:
+            return await self._write([entry], skip_existing=True)
+        except IntegrityError:
+            pass
+        try:
+            await self._renumber(entry)
+            rows = await self._write([entry], skip_existing=True)
+        except IntegrityError as e:
+            self._reject(entry, e)
+            return 0
+        self.renumbered_rows += rows
+        return rows
+
+    async def _renumber(self, entry: JournalEntry):
+        """
+        Gives the messages of entry the seqs following the last committed ones
+        of their conversation, e.g. after a writer of another process took
+        the seqs this one handed out
+        """
+        conversation_ids = {message["conversation_id"] for message in entry.messages}
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(Message.conversation_id, func.max(Message.seq))
+                .where(Message.conversation_id.in_(conversation_ids))
+                .group_by(Message.conversation_id))
+            last_seqs = dict(result.all())
+        for message in entry.messages:
+            seq = last_seqs.get(message["conversation_id"], 0) + 1
+            last_seqs[message["conversation_id"]] = message["seq"] = seq
+        entry.line = JournalEntry.create(entry.messages, entry.conversation_id).line
+
+    def _reject(self, entry: JournalEntry, error: Exception):
+        """
+        Sets aside an entry the database won't take, in the journal's
+        .rejected file or, without a journal file, in the log
+        """
+        self.rejected_rows += len(entry.messages)
+        if self.path:
+            with open(self.path + ".rejected", "ab") as f:
+                f.write(entry.line)
+            logger.error(f"Rejected journaled turn, kept in {self.path}.rejected: {str(error)}")
+        else:
+            logger.error(f"Rejected journaled turn {entry.line!r}: {str(error)}")
+
+    @timed(DB_SECONDS, "journal_flush")
+    async def _write(self, entries: List[JournalEntry], skip_existing: bool = False) -> int:
+        conversations = [
+            {"id": entry.conversation_id}
+            for entry in entries if entry.conversation_id is not None
+        ]
+        messages = [message for entry in entries for message in entry.messages]
+        async with self.engine.begin() as conn:
+            if skip_existing:
+                conversations = await self._missing(conn, Conversation, conversations)
+                messages = await self._missing(conn, Message, messages)
+            for table, rows in ((Conversation, conversations), (Message, messages)):
+                for start in range(0, len(rows), INSERT_CHUNK):
+                    await conn.execute(
+                        insert(table).values(rows[start:start + INSERT_CHUNK]))
+        return len(messages)
+
+    @staticmethod
+    async def _missing(conn: AsyncConnection, model, rows: List[Dict]) -> List[Dict]:
+        existing = set()
+        ids = [row["id"] for row in rows]
+        for start in range(0, len(ids), INSERT_CHUNK):
+            result = await conn.execute(
+                select(model.id).where(model.id.in_(ids[start:start + INSERT_CHUNK])))
+            existing.update(result.scalars())
+        return [row for row in rows if row["id"] not in existing]
+
+    def stats(self) -> Dict:
+        return {
+            "pending_rows": sum(len(pending) for pending in self._messages.values()),
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "rows_per_flush": self.flushed_rows / self.flushes if self.flushes else 0.0,
+            "replayed_rows": self.replayed_rows,
+            "renumbered_rows": self.renumbered_rows,
+            "rejected_rows": self.rejected_rows,
+        }
+
+
+message_journal = MessageJournal.from_env()
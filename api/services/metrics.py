@@ -0,0 +1,320 @@
+"""
+Prometheus metrics in the text exposition format, served on /metrics
+
+Histograms, counters and gauges are kept in plain Python objects and only
+formatted when scraped. `timed` measures a block, function, coroutine or
+async generator with two perf_counter calls and a bucket increment, cheap
+enough for the per-turn hot path
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from bisect import bisect_left
+import functools
+import inspect
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROW_BUCKETS = (0, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """
+    Set directly, or read from callback(*labels) at scrape time
+    """
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        values = self.callback() if self.callback else self._values
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} "
+                    f"{cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+class timed:
+    """
+    Observes elapsed seconds into histogram, as a context manager
+
+        with timed(DB_SECONDS, "add_turn"):
+
+    or as a decorator of functions, coroutines and async generators
+    """
+    __slots__ = ("histogram", "labels", "_started")
+
+    def __init__(self, histogram: Histogram, *labels: str):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "timed":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self._started, *self.labels)
+
+    def __call__(self, fn: Callable) -> Callable:
+        histogram, labels = self.histogram, self.labels
+
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                agen = fn(*args, **kwargs)
+                try:
+                    async for item in agen:
+                        yield item
+                finally:
+                    # Run the inner generator's cleanup when the consumer stops early
+                    await agen.aclose()
+                    histogram.observe(time.perf_counter() - started, *labels)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes a task sleeping for interval
+    seconds, i.e. how long callbacks wait behind blocking work
+    """
+
+    def __init__(self, histogram: Histogram, interval: float = 0.25):
+        self.histogram = histogram
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.histogram.observe(self.last_lag)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class InFlightMiddleware:
+    """
+    ASGI middleware counting HTTP requests in progress, streamed responses
+    count until their last byte
+    """
+
+    def __init__(self, app, gauge: Gauge):
+        self.app = app
+        self.gauge = gauge
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        self.gauge.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.gauge.dec()
+
+
+registry = Registry()
+
+DB_SECONDS = registry.histogram(
+    "chat_db_seconds", "Time spent in ChatService database methods", ["method"])
+LLM_TTFT_SECONDS = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time to the first token of upstream llm calls", ["kind"])
+LLM_SECONDS = registry.histogram(
+    "llm_request_seconds", "Total time of upstream llm calls", ["kind"])
+LLM_TOKENS_PER_SECOND = registry.histogram(
+    "llm_stream_tokens_per_second",
+    "Streamed deltas per second after the first one", buckets=RATE_BUCKETS)
+PERSONA_SECONDS = registry.histogram(
+    "debate_persona_seconds", "Time to produce a counter argument", ["kind"])
+SSE_CHUNKS = registry.histogram(
+    "sse_chunks_per_response", "SSE chunk frames sent per /chat/stream response",
+    buckets=COUNT_BUCKETS)
+LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_seconds", "Delay of event loop wake-ups")
+RETENTION_ARCHIVED_ROWS = registry.histogram(
+    "retention_archived_messages_per_pass", "Messages archived by a retention pass",
+    buckets=ROW_BUCKETS)
+RETENTION_LOCK_SECONDS = registry.histogram(
+    "retention_lock_seconds",
+    "Write transaction time of a retention batch or vacuum step", ["step"])
+SUMMARY_SECONDS = registry.histogram(
+    "conversation_summary_seconds",
+    "Time to refresh a conversation summary, llm call included")
+RESPONSE_CACHE_LOOKUPS = registry.counter(
+    "response_cache_lookups_total", "Response cache lookups", ["result"])
+RESPONSE_CACHE_SAVED_SECONDS = registry.counter(
+    "response_cache_saved_llm_seconds_total",
+    "Upstream llm latency avoided by response cache hits")
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "http_requests_in_flight", "HTTP requests being served")
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_SECONDS)
@@ -0,0 +1,338 @@
+"""
+Backpressure for upstream LLM calls
+
+An AIMD concurrency limit adapts to how much the provider can take: it grows
+additively on fast successes while at least half used and shrinks
+multiplicatively on 429/5xx, timeouts or latency well above the best seen.
+Callers beyond the limit wait in a bounded queue and are rejected with a
+retry hint when it is full, and a circuit breaker stops calling a provider
+that keeps failing
+"""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import os
+import random
+import time
+from typing import AsyncIterator, Callable, Deque, Dict, Iterator, Optional
+
+import aiohttp
+
+
+class Overloaded(Exception):
+    """
+    Raised instead of calling upstream, clients should retry after retry_after
+    seconds
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Overloaded):
+    pass
+
+
+class UpstreamBusy(Overloaded):
+    """
+    429 or 5xx from the provider, retry_after comes from its Retry-After header
+    """
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"LLM API busy: HTTP {status}", retry_after or 1.0)
+        self.status = status
+        self.retry_after_header = retry_after
+
+
+BUSY_STATUSES = {429, 500, 502, 503, 504}
+
+# Errors that say the provider is unhealthy, as opposed to a bad request
+UPSTREAM_FAILURES = (
+    UpstreamBusy,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds from a Retry-After header, either delay-seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(
+    attempt: int,
+    retry_after: Optional[float] = None,
+    base: float = 0.5,
+    cap: float = 20.0,
+) -> float:
+    """
+    Exponential backoff with full jitter, or the server's Retry-After plus a
+    little jitter so retries don't arrive in lockstep
+    """
+    if retry_after is not None:
+        return min(cap, retry_after) + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Slot:
+    __slots__ = ("clock", "started", "latency")
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.latency: Optional[float] = None
+
+    def first_byte(self):
+        """
+        Measures latency to the first byte instead of the whole call, for
+        streams whose length says nothing about provider load
+        """
+        if self.latency is None:
+            self.latency = self.clock() - self.started
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        max_queue: int = 100,
+        queue_timeout: float = 5.0,
+        backoff_ratio: float = 0.9,
+        latency_tolerance: float = 3.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.clock = clock
+        self.in_flight = 0
+        self.min_latency: Optional[float] = None
+        self.rejected = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @classmethod
+    def from_env(cls) -> "AdaptiveLimiter":
+        return cls(
+            initial_limit=int(os.getenv("LLM_CONCURRENCY_INITIAL", 20)),
+            min_limit=int(os.getenv("LLM_CONCURRENCY_MIN", 1)),
+            max_limit=int(os.getenv("LLM_CONCURRENCY_MAX", 200)),
+            max_queue=int(os.getenv("LLM_QUEUE_SIZE", 100)),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 5)),
+        )
+
+    @property
+    def saturated(self) -> bool:
+        return len(self._waiters) >= self.max_queue
+
+    def retry_after(self) -> float:
+        """
+        Rough time for the queue to drain at the current limit
+        """
+        return (len(self._waiters) + 1) / self.limit * (self.min_latency or 1.0)
+
+    def check(self):
+        """
+        Rejects upfront when the wait queue is full
+        """
+        if self.saturated:
+            self.rejected += 1
+            raise Overloaded("LLM request queue is full", self.retry_after())
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        self.check()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over as we gave up
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise Overloaded(
+                    "Timed out waiting for an LLM request slot", self.retry_after()
+                ) from None
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            # Cancelled waiters may still be queued until their task resumes
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Slot]:
+        await self.acquire()
+        slot = Slot(self.clock)
+        try:
+            yield slot
+        except (UpstreamBusy, asyncio.TimeoutError):
+            self._decrease(slot.started)
+            raise
+        else:
+            self._sample(slot)
+        finally:
+            self.release()
+
+    def _sample(self, slot: Slot):
+        latency = slot.latency
+        if latency is None:
+            latency = self.clock() - slot.started
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        else:
+            # Slowly forget the best case so a lucky sample doesn't pin it
+            self.min_latency *= 1.001
+        if latency > self.latency_tolerance * self.min_latency:
+            self._decrease(slot.started)
+        elif self.in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self, started: float):
+        # Calls started before the last decrease saw the old limit, one
+        # decrease per round trip like TCP congestion control
+        if started < self._last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        self._last_decrease = self.clock()
+        self.decreases += 1
+
+    def stats(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "decreases": self.decreases,
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive upstream failures, then lets a
+    single probe through every reset_timeout seconds until one succeeds
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opens = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        return cls(
+            failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", 5)),
+            reset_timeout=float(os.getenv("LLM_BREAKER_RESET", 30)),
+        )
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self.retry_after() > 0:
+            return "open"
+        return "half_open"
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the next probe is allowed, 0 when calls may go through
+        """
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self.clock())
+
+    def check(self):
+        """
+        Raises CircuitOpen unless a call may go through right now
+        """
+        if self._opened_at is None:
+            return
+        if self._probing:
+            raise CircuitOpen("LLM API circuit is open", self.reset_timeout)
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            raise CircuitOpen("LLM API circuit is open", retry_after)
+
+    @contextmanager
+    def attempt(self) -> Iterator[None]:
+        self.check()
+        self._probing = self._opened_at is not None
+        try:
+            yield
+        except UPSTREAM_FAILURES:
+            self.record_failure()
+            raise
+        except BaseException:
+            self._probing = False
+            raise
+        else:
+            self.record_success()
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self._opened_at is None or self._probing:
+                self.opens += 1
+            self._opened_at = self.clock()
+        self._probing = False
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+        }
+
+
+upstream_limiter = AdaptiveLimiter.from_env()
+upstream_breaker = CircuitBreaker.from_env()
@@ -0,0 +1,165 @@
+"""
+Cache of llm responses for identical debates
+
+Many debates open with the same prompt and, with a fixed persona and a low
+temperature, get nearly the same first answer. Responses are keyed on the
+model, temperature, persona prompt and normalized history, kept in an
+in-memory LRU with TTL and optionally in the shared state backend (all
+workers of a deployment) or a SQLite file (restarts and workers on the same
+host). Expired rows of the SQLite file are deleted as new ones are written
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from api.services.metrics import RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_SAVED_SECONDS
+from api.services.sse import dumps, loads
+from api.services.state import StateBackend, state_backend
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        max_history: int = 1,
+        disk_path: Optional[str] = None,
+        shared: Optional[StateBackend] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_history = max_history
+        self.disk_path = disk_path
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.saved_latency = 0.0
+        # key -> (stored_at, response, llm latency)
+        self._entries: "OrderedDict[str, Tuple[float, str, float]]" = OrderedDict()
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        """
+        None unless RESPONSE_CACHE=1
+        """
+        if os.getenv("RESPONSE_CACHE", "0") != "1":
+            return None
+        return cls(
+            maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+            max_history=int(os.getenv("RESPONSE_CACHE_MAX_HISTORY", 1)),
+            disk_path=os.getenv("RESPONSE_CACHE_DB") or None,
+            shared=state_backend if state_backend.shared else None,
+        )
+
+    def key(
+        self,
+        model: str,
+        temperature: float,
+        persona_hash: str,
+        history: List[Dict],
+    ) -> Optional[str]:
+        """
+        None when the history is too long to be worth caching
+        """
+        if len(history) > self.max_history:
+            return None
+        digest = hashlib.sha256(f"{model}\0{temperature}\0{persona_hash}".encode())
+        for message in history:
+            digest.update(b"\0" + message["role"].encode())
+            digest.update(b"\0" + normalize_text(message["content"]).encode())
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None and self.shared is not None:
+            value = await self.shared.get(f"response:{key}")
+            if value is not None:
+                entry = tuple(loads(value))
+                self._remember(key, entry)
+        if entry is None and self.disk_path:
+            entry = await asyncio.to_thread(self._disk_get, key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            RESPONSE_CACHE_LOOKUPS.inc("miss")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_latency += entry[2]
+        RESPONSE_CACHE_LOOKUPS.inc("hit")
+        RESPONSE_CACHE_SAVED_SECONDS.inc(amount=entry[2])
+        return entry[1]
+
+    async def set(self, key: str, response: str, latency: float):
+        entry = (time.time(), response, latency)
+        self._remember(key, entry)
+        if self.shared is not None:
+            await self.shared.set(f"response:{key}", dumps(entry), ttl=self.ttl)
+        if self.disk_path:
+            await asyncio.to_thread(self._disk_set, key, entry)
+
+    def _remember(self, key: str, entry: Tuple[float, str, float]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._disk is None:
+            self._disk = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                " key TEXT PRIMARY KEY, stored_at REAL NOT NULL,"
+                " response TEXT NOT NULL, latency REAL NOT NULL)"
+            )
+            self._disk.execute(
+                "CREATE INDEX IF NOT EXISTS ix_response_cache_stored_at"
+                " ON response_cache (stored_at)"
+            )
+        return self._disk
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, str, float]]:
+        with self._disk_lock:
+            return self._connection().execute(
+                "SELECT stored_at, response, latency FROM response_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+    def _disk_set(self, key: str, entry: Tuple[float, str, float]):
+        with self._disk_lock, self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, *entry),
+            )
+            conn.execute(
+                "DELETE FROM response_cache WHERE stored_at < ?",
+                (entry[0] - self.ttl,),
+            )
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "saved_llm_seconds": self.saved_latency,
+        }
+
+
+response_cache = ResponseCache.from_env()
@@ -0,0 +1,324 @@
+"""
+Retention job moving cold conversations out of the messages table
+
+Nothing else deletes rows, so the messages table and its indexes grow
+forever. Each pass archives whole conversations idle for longer than
+max_age or beyond the max_conversations most recently active ones, and the
+oldest messages but the opening one of conversations holding more than
+max_messages. Archived
+messages are deleted with DELETE ... RETURNING and stored, gzip compressed
+in the export NDJSON format, in conversation_archives where they can still
+be fetched. Work is done batch_size conversations per transaction with a
+pause in between, so the SQLite write lock is only held briefly, and freed
+pages are then returned to the filesystem with incremental vacuum steps.
+Each pass records the messages archived and each transaction's duration
+(the write lock hold time) in the retention metrics
+"""
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+import gzip
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi.logger import logger
+from sqlalchemy import and_, delete, func, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from api.services.bulk_transfer import message_line, message_row
+from api.services.history_cache import HistoryCache, history_cache as default_history_cache
+from api.services.metrics import RETENTION_ARCHIVED_ROWS, RETENTION_LOCK_SECONDS
+from api.services.sse import loads
+from db.models import Conversation, ConversationArchive, ConversationSummary, Message
+
+conversations = Conversation.__table__
+messages = Message.__table__
+archives = ConversationArchive.__table__
+summaries = ConversationSummary.__table__
+
+# SQLite's auto_vacuum value for INCREMENTAL
+INCREMENTAL_VACUUM = 2
+
+
+class RetentionJob:
+    def __init__(
+        self,
+        max_age: Optional[timedelta] = None,
+        max_conversations: Optional[int] = None,
+        max_messages: Optional[int] = None,
+        interval: float = 3600,
+        batch_size: int = 50,
+        max_batches: int = 100,
+        pause: float = 0.05,
+        vacuum_pages: int = 1000,
+        history_cache: HistoryCache = default_history_cache,
+        engine: Optional[AsyncEngine] = None,
+    ):
+        self.max_age = max_age
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self.interval = interval
+        self.batch_size = batch_size
+        # Batches per policy and pass, the rest waits for the next pass
+        self.max_batches = max_batches
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.history_cache = history_cache
+        # Set by start() when not given
+        self.engine = engine
+        self._task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.archived_conversations = 0
+        self.archived_messages = 0
+        self.vacuumed_pages = 0
+        self.last_pass: Optional[Dict] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["RetentionJob"]:
+        """
+        None unless one of RETENTION_MAX_AGE_DAYS, RETENTION_MAX_CONVERSATIONS
+        or RETENTION_MAX_MESSAGES is set
+        """
+        max_age = os.getenv("RETENTION_MAX_AGE_DAYS")
+        max_conversations = os.getenv("RETENTION_MAX_CONVERSATIONS")
+        max_messages = os.getenv("RETENTION_MAX_MESSAGES")
+        if not (max_age or max_conversations or max_messages):
+            return None
+        return cls(
+            max_age=timedelta(days=float(max_age)) if max_age else None,
+            max_conversations=int(max_conversations) if max_conversations else None,
+            max_messages=int(max_messages) if max_messages else None,
+            interval=float(os.getenv("RETENTION_INTERVAL", 3600)),
+            batch_size=int(os.getenv("RETENTION_BATCH_SIZE", 50)),
+            pause=float(os.getenv("RETENTION_PAUSE", 0.05)),
+            vacuum_pages=int(os.getenv("RETENTION_VACUUM_PAGES", 1000)),
+        )
+
+    def start(self, engine: AsyncEngine):
+        self.engine = engine
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_pass()
+            except Exception as e:
+                logger.error(f"Retention pass failed: {str(e)}")
+
+    async def run_pass(self) -> Dict:
+        """
+        Applies every configured policy, then vacuums
+        """
+        started = time.perf_counter()
+        lock_seconds: List[float] = []
+        conversations_before = self.archived_conversations
+        messages_before = self.archived_messages
+
+        if self.max_age is not None or self.max_conversations is not None:
+            for _ in range(self.max_batches):
+                ids = await self._cold_conversations()
+                if not ids:
+                    break
+                lock_seconds.append(await self._archive_conversations(ids))
+                await asyncio.sleep(self.pause)
+        if self.max_messages is not None:
+            for _ in range(self.max_batches):
+                cutoffs = await self._over_cap()
+                if not cutoffs:
+                    break
+                lock_seconds.append(await self._trim_conversations(cutoffs))
+                await asyncio.sleep(self.pause)
+        vacuumed = await self._vacuum(lock_seconds)
+
+        archived = self.archived_messages - messages_before
+        RETENTION_ARCHIVED_ROWS.observe(archived)
+        self.passes += 1
+        self.last_pass = {
+            "conversations": self.archived_conversations - conversations_before,
+            "messages": archived,
+            "vacuumed_pages": vacuumed,
+            "transactions": len(lock_seconds),
+            "max_lock_seconds": max(lock_seconds, default=0.0),
+            "seconds": time.perf_counter() - started,
+        }
+        return self.last_pass
+
+    async def _cold_conversations(self) -> List[str]:
+        """
+        A batch of conversations idle for longer than max_age or beyond the
+        max_conversations most recently active, conversations without
+        messages are left alone
+        """
+        last_activity = func.max(messages.c.timestamp)
+        query = select(messages.c.conversation_id).group_by(messages.c.conversation_id)
+        async with self.engine.connect() as conn:
+            ids = []
+            if self.max_age is not None:
+                result = await conn.execute(
+                    query.having(last_activity < datetime.now() - self.max_age)
+                    .limit(self.batch_size))
+                ids = list(result.scalars())
+            if self.max_conversations is not None and len(ids) < self.batch_size:
+                result = await conn.execute(
+                    query.order_by(last_activity.desc())
+                    .offset(self.max_conversations)
+                    .limit(self.batch_size))
+                ids = list(dict.fromkeys([*ids, *result.scalars()]))
+        return ids[:self.batch_size]
+
+    async def _over_cap(self) -> List[Tuple[str, int, int]]:
+        """
+        Conversations with more than max_messages messages, with the seq of
+        their opening message, which is kept, and the last seq to archive.
+        The opening message and the max_messages - 1 latest are left
+        """
+        first_seq = func.min(messages.c.seq)
+        last_seq = func.max(messages.c.seq)
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(
+                    messages.c.conversation_id,
+                    first_seq,
+                    last_seq - (self.max_messages - 1),
+                )
+                .group_by(messages.c.conversation_id)
+                .having(func.count() > self.max_messages)
+                .limit(self.batch_size))
+            return [tuple(row) for row in result.all()]
+
+    async def _archive_conversations(self, ids: List[str]) -> float:
+        started = time.perf_counter()
+        async with self.engine.begin() as conn:
+            count = await self._archive(
+                conn, messages.c.conversation_id.in_(ids))
+            await conn.execute(delete(conversations).where(conversations.c.id.in_(ids)))
+            await conn.execute(delete(summaries).where(summaries.c.conversation_id.in_(ids)))
+        elapsed = time.perf_counter() - started
+        RETENTION_LOCK_SECONDS.observe(elapsed, "archive")
+        self.archived_conversations += len(ids)
+        self.archived_messages += count
+        for conversation_id in ids:
+            self.history_cache.invalidate(conversation_id)
+        return elapsed
+
+    async def _trim_conversations(self, cutoffs: Sequence[Tuple[str, int, int]]) -> float:
+        started = time.perf_counter()
+        async with self.engine.begin() as conn:
+            count = await self._archive(conn, or_(*(
+                and_(
+                    messages.c.conversation_id == conversation_id,
+                    messages.c.seq > first_seq,
+                    messages.c.seq <= cutoff,
+                )
+                for conversation_id, first_seq, cutoff in cutoffs
+            )))
+        elapsed = time.perf_counter() - started
+        RETENTION_LOCK_SECONDS.observe(elapsed, "trim")
+        self.archived_messages += count
+        for conversation_id, _, _ in cutoffs:
+            self.history_cache.invalidate(conversation_id)
+        return elapsed
+
+    @staticmethod
+    async def _archive(conn: AsyncConnection, where) -> int:
+        """
+        Deletes the matching messages and stores them as one archive row per
+        conversation. Deleting first makes concurrent passes, e.g. one per
+        worker, archive each message once
+        """
+        result = await conn.execute(delete(messages).where(where).returning(
+            messages.c.conversation_id,
+            messages.c.id,
+            messages.c.seq,
+            messages.c.role,
+            messages.c.content,
+            messages.c.timestamp,
+        ))
+        by_conversation = defaultdict(list)
+        for row in result.all():
+            by_conversation[row.conversation_id].append(row)
+        archived_at = datetime.now()
+        rows = []
+        for conversation_id, archived in by_conversation.items():
+            archived.sort(key=lambda row: row.seq)
+            rows.append({
+                "conversation_id": conversation_id,
+                "first_seq": archived[0].seq,
+                "last_seq": archived[-1].seq,
+                "message_count": len(archived),
+                "archived_at": archived_at,
+                "data": gzip.compress(b"".join(message_line(row) for row in archived)),
+            })
+        if rows:
+            await conn.execute(insert(archives), rows)
+        return sum(row["message_count"] for row in rows)
+
+    async def _vacuum(self, lock_seconds: List[float]) -> int:
+        """
+        Frees up to vacuum_pages pages per transaction until the freelist is
+        empty. SQLite only, on databases created with auto_vacuum=INCREMENTAL
+        """
+        if self.engine.dialect.name != "sqlite" or self.vacuum_pages <= 0:
+            return 0
+        async with self.engine.connect() as conn:
+            mode = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+        if mode != INCREMENTAL_VACUUM:
+            return 0
+        vacuumed = 0
+        while True:
+            started = time.perf_counter()
+            async with self.engine.begin() as conn:
+                free = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+                if free:
+                    await conn.exec_driver_sql(
+                        f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+            if not free:
+                return vacuumed
+            elapsed = time.perf_counter() - started
+            RETENTION_LOCK_SECONDS.observe(elapsed, "vacuum")
+            lock_seconds.append(elapsed)
+            pages = min(free, self.vacuum_pages)
+            vacuumed += pages
+            self.vacuumed_pages += pages
+            await asyncio.sleep(self.pause)
+
+    def stats(self) -> Dict:
+        return {
+            "passes": self.passes,
+            "archived_conversations": self.archived_conversations,
+            "archived_messages": self.archived_messages,
+            "vacuumed_pages": self.vacuumed_pages,
+            "last_pass": self.last_pass,
+        }
+
+
+async def archived_messages(engine: AsyncEngine, conversation_id: str) -> List[Dict]:
+    """
+    Message column values of every archived message of a conversation, in
+    seq order
+    """
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(archives.c.data)
+            .where(archives.c.conversation_id == conversation_id)
+            .order_by(archives.c.first_seq))
+        return [
+            message_row(loads(line))
+            for data in result.scalars()
+            for line in gzip.decompress(data).splitlines()
+        ]
+
+
+retention_job = RetentionJob.from_env()
@@ -0,0 +1,150 @@
+"""
+Single-flight deduplication of identical concurrent upstream calls
+
+Callers with the same key share one in-flight call: plain calls share its
+result, streams fan out from one upstream stream to every subscriber. A
+subscriber joining a running stream first gets the chunks it missed from a
+bounded replay buffer; once the stream outgrows the buffer it is closed to
+new subscribers, which then start their own upstream call. The upstream call
+runs in its own task so one caller going away doesn't cut the others off, it
+is cancelled when its last caller is gone
+"""
+import asyncio
+import os
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List
+from typing import Optional, TypeVar
+
+T = TypeVar("T")
+_END = object()
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _Stream:
+    __slots__ = ("task", "replay", "replay_limit", "subscribers")
+
+    def __init__(self, replay_limit: int):
+        self.task: Optional[asyncio.Task] = None
+        self.replay: Optional[List[str]] = []
+        self.replay_limit = replay_limit
+        self.subscribers: List[asyncio.Queue] = []
+
+    def subscribe(self) -> Optional[asyncio.Queue]:
+        """
+        Queue fed with every chunk of the stream, None once the replay buffer
+        overflowed and the start of the stream is lost
+        """
+        if self.replay is None:
+            return None
+        queue = asyncio.Queue()
+        for chunk in self.replay:
+            queue.put_nowait(chunk)
+        self.subscribers.append(queue)
+        return queue
+
+    def publish(self, item):
+        if self.replay is not None and isinstance(item, str):
+            if len(self.replay) < self.replay_limit:
+                self.replay.append(item)
+            else:
+                self.replay = None
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+
+class SingleFlight:
+    def __init__(self, replay_limit: int = 1024):
+        self.replay_limit = replay_limit
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Stream] = {}
+
+    @classmethod
+    def from_env(cls) -> "SingleFlight":
+        return cls(replay_limit=int(os.getenv("LLM_COALESCE_REPLAY", 1024)))
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Result of fn(), shared with concurrent callers using the same key
+        """
+        call = self._calls.get(key)
+        if call is None:
+            self.upstream_calls += 1
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    async def stream(
+        self,
+        key: str,
+        fn: Callable[[], AsyncIterator[str]],
+    ) -> AsyncGenerator[str, None]:
+        """
+        Chunks of fn(), fanned out to concurrent subscribers using the same key
+        """
+        stream = self._streams.get(key)
+        queue = stream.subscribe() if stream is not None else None
+        if queue is None:
+            self.upstream_calls += 1
+            stream = _Stream(self.replay_limit)
+            queue = stream.subscribe()
+            self._streams[key] = stream
+            stream.task = asyncio.ensure_future(self._pump(key, stream, fn))
+        else:
+            self.coalesced += 1
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stream.subscribers.remove(queue)
+            if not stream.subscribers and not stream.task.done():
+                stream.task.cancel()
+
+    async def _pump(self, key: str, stream: _Stream, fn: Callable[[], AsyncIterator[str]]):
+        end = _END
+        try:
+            async for chunk in fn():
+                stream.publish(chunk)
+        except Exception as e:
+            end = e
+        finally:
+            self._forget(self._streams, key, stream)
+            stream.publish(end)
+
+    @staticmethod
+    def _forget(flights: Dict, key: str, flight):
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+        }
+
+
+single_flight = SingleFlight.from_env()
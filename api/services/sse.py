@@ -0,0 +1,131 @@
+"""
+Server-sent events framing for /chat/stream
+
+Per-token work dominates CPU on busy streams, so deltas are coalesced into
+chunks by a configurable flush policy and frames are encoded with the
+constant parts (conversation id, role) serialized once per stream
+"""
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:  # pragma: no cover - orjson is optional
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    loads = json.loads
+
+
+SENTENCE_BREAK = re.compile(r"[.!?\n]")
+
+
+class FlushPolicy:
+    """
+    When buffered deltas are sent as a chunk: once the buffer exceeds
+    max_bytes characters, when a delta ends a sentence, or when max_interval
+    seconds passed since the first buffered delta. Conditions are checked as
+    deltas arrive
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 100,
+        max_interval: Optional[float] = None,
+        sentence_boundary: bool = True,
+    ):
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.sentence_boundary = sentence_boundary
+
+    @classmethod
+    def from_env(cls) -> "FlushPolicy":
+        max_interval = float(os.getenv("STREAM_FLUSH_INTERVAL", 0))
+        return cls(
+            max_bytes=int(os.getenv("STREAM_FLUSH_BYTES", 100)),
+            max_interval=max_interval or None,
+            sentence_boundary=os.getenv("STREAM_FLUSH_SENTENCE", "1") == "1",
+        )
+
+
+class ChunkCoalescer:
+    __slots__ = ("policy", "_parts", "_size", "_started")
+
+    def __init__(self, policy: FlushPolicy):
+        self.policy = policy
+        self._parts: List[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    def push(self, content: str) -> Optional[str]:
+        """
+        Buffers a delta, returns the coalesced chunk when the policy says so
+        """
+        policy = self.policy
+        if not self._parts and policy.max_interval:
+            self._started = time.monotonic()
+        self._parts.append(content)
+        self._size += len(content)
+        if (
+            self._size > policy.max_bytes
+            or (policy.sentence_boundary and SENTENCE_BREAK.search(content))
+            or (policy.max_interval
+                and time.monotonic() - self._started >= policy.max_interval)
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        if not self._parts:
+            return None
+        chunk = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        return chunk
+
+
+class SSEEncoder:
+    """
+    Encodes the frames of one /chat/stream response
+    """
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self._chunk_prefix = (
+            b'{"conversation_id":' + dumps(conversation_id)
+            + b',"role":"bot","message":'
+        )
+
+    @staticmethod
+    def event(name: str) -> bytes:
+        return f"event: {name}\n\n".encode()
+
+    def chunk(self, message: str, part: int) -> bytes:
+        part_id = str(part).encode()
+        return b"".join((
+            b"id: ", part_id, b"\ndata: ", self._chunk_prefix, dumps(message),
+            b',"part":', part_id, b"}\n\n",
+        ))
+
+    def final(self, messages: List[Dict]) -> bytes:
+        return b"".join((
+            b"id: final\ndata: ",
+            dumps({
+                "conversation_id": self.conversation_id,
+                "message": messages,
+                "part": "final",
+            }),
+            b"\n\n",
+        ))
+
+    @staticmethod
+    def error(error: str) -> bytes:
+        return b"event: error\ndata: " + dumps({"error": error}) + b"\n\n"
@@ -0,0 +1,137 @@
+"""
+Incremental parser for the upstream LLM server-sent events stream
+
+Bytes are fed as they arrive, whatever the network chunking: lines and UTF-8
+sequences split across reads, multi-line `data:` fields, `event:` types and
+`:` comments (e.g. OpenRouter's keep-alive pings) are handled per the SSE spec,
+which also has invalid UTF-8 decoded to replacement characters
+"""
+from typing import AsyncGenerator, AsyncIterable, List, NamedTuple, Optional
+
+from api.services.sse import loads
+
+
+class SSEEvent(NamedTuple):
+    event: str
+    data: str
+    id: Optional[str] = None
+
+
+class SSEParser:
+    __slots__ = ("_buffer", "_data", "_event", "_id")
+
+    def __init__(self):
+        self._buffer = b""
+        self._data: List[str] = []
+        self._event = ""
+        self._id: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        Returns the events completed by this chunk
+        """
+        buffer = self._buffer + chunk
+        events = []
+        if b"\r" not in buffer:
+            lines = buffer.split(b"\n")
+            self._buffer = lines.pop()
+            for line in lines:
+                event = self._line(line)
+                if event is not None:
+                    events.append(event)
+            return events
+
+        start = 0
+        end = len(buffer)
+        while start < end:
+            newline = buffer.find(b"\n", start)
+            carriage = buffer.find(b"\r", start, newline if newline >= 0 else end)
+            if carriage >= 0:
+                # A trailing \r may be the first half of a \r\n split across reads
+                if carriage == end - 1:
+                    break
+                line_end = carriage
+                next_start = carriage + 2 if buffer[carriage + 1] == 10 else carriage + 1
+            elif newline >= 0:
+                line_end = newline
+                next_start = newline + 1
+            else:
+                break
+            event = self._line(buffer[start:line_end])
+            if event is not None:
+                events.append(event)
+            start = next_start
+        self._buffer = buffer[start:]
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """
+        Flushes the last event of a stream that didn't end with a blank line
+        """
+        events = []
+        if self._buffer:
+            event = self._line(self._buffer.rstrip(b"\r"))
+            self._buffer = b""
+            if event is not None:
+                events.append(event)
+        event = self._line(b"")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line[0] == 58:  # b":" comment
+            return None
+        field, _, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data.append(value.decode(errors="replace"))
+        elif field == b"event":
+            self._event = value.decode(errors="replace")
+        elif field == b"id":
+            self._id = value.decode(errors="replace")
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data:
+            self._event = ""
+            return None
+        event = SSEEvent(self._event or "message", "\n".join(self._data), self._id)
+        self._data = []
+        self._event = ""
+        return event
+
+
+async def iter_events(stream: AsyncIterable[bytes]) -> AsyncGenerator[SSEEvent, None]:
+    parser = SSEParser()
+    async for chunk in stream:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
+
+
+def delta_content(data: str) -> Optional[str]:
+    """
+    Text of choices[0].delta.content in an OpenAI-compatible stream chunk,
+    None for chunks without it, including JSON that isn't a chunk object.
+    Raises on provider errors sent in-band
+    """
+    chunk = loads(data)
+    if not isinstance(chunk, dict):
+        return None
+    choices = chunk.get("choices")
+    if choices:
+        if not isinstance(choices, list) or not isinstance(choices[0], dict):
+            return None
+        delta = choices[0].get("delta")
+        if isinstance(delta, dict):
+            content = delta.get("content")
+            return content if isinstance(content, str) else None
+        return None
+    if "error" in chunk:
+        raise ValueError(f"LLM stream error: {chunk['error']}")
+    return None
@@ -0,0 +1,139 @@
+"""
+State shared by the workers of a deployment
+
+Each worker process has its own memory, so state that must agree across
+workers (cached answers, counters behind rate limits) goes through a
+StateBackend: MemoryBackend keeps it in-process for single-worker
+deployments and tests, RedisBackend keeps it in Redis or a compatible server
+(Valkey, KeyDB, Dragonfly) reachable by every worker
+"""
+from abc import ABC, abstractmethod
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+# Number of worker processes serving the app, WEB_CONCURRENCY is read by both
+# gunicorn and uvicorn --workers
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+
+
+class StateBackend(ABC):
+    """
+    Bytes values with optional TTLs in seconds and atomic counters
+    """
+    # Whether other worker processes see the same state
+    shared = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """
+        Adds amount and returns the new value, ttl applies when the key is
+        created, e.g. the window of a fixed-window rate limit
+        """
+        ...
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    def __init__(self):
+        # key -> (value, expires_at or None)
+        self._entries: Dict[str, Tuple[object, Optional[float]]] = {}
+
+    def _live(self, key: str) -> Optional[Tuple[object, Optional[float]]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    @staticmethod
+    def _expires_at(ttl: Optional[float]) -> Optional[float]:
+        return None if ttl is None else time.monotonic() + ttl
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._live(key)
+        if entry is None:
+            return None
+        value = entry[0]
+        return str(value).encode() if isinstance(value, int) else value
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self._entries[key] = (value, self._expires_at(ttl))
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        entry = self._live(key)
+        if entry is None:
+            entry = (0, self._expires_at(ttl))
+        value = int(entry[0]) + amount
+        self._entries[key] = (value, entry[1])
+        return value
+
+
+class RedisBackend(StateBackend):
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "chatbot:"):
+        if redis is None:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package")
+        self.url = url
+        self.prefix = prefix
+        self.client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self.client.set(
+            self.prefix + key, value, px=None if ttl is None else int(ttl * 1000))
+
+    async def delete(self, key: str):
+        await self.client.delete(self.prefix + key)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        key = self.prefix + key
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, amount)
+            if ttl is not None:
+                pipe.pexpire(key, int(ttl * 1000), nx=True)
+            value, *_ = await pipe.execute()
+        return value
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def state_backend_from_env() -> StateBackend:
+    """
+    STATE_BACKEND=redis with REDIS_URL, in-process memory otherwise
+    """
+    if os.getenv("STATE_BACKEND", "memory") == "redis":
+        return RedisBackend(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            prefix=os.getenv("REDIS_PREFIX", "chatbot:"),
+        )
+    return MemoryBackend()
+
+
+state_backend = state_backend_from_env()
@@ -0,0 +1,227 @@
+"""
+Rolling llm summaries of long conversations
+
+Every turn of a long debate otherwise resends the whole history, so prompt
+tokens and time to first token grow with its length. Once a conversation has
+threshold messages past its summary (or past the opening message when it has
+none), a background task asks the llm to fold all but the last tail of them
+into the summary and stores it with its high-water mark in
+conversation_summaries. Prompts then send the opening message, the summary
+and the messages after the mark, between tail and threshold of them.
+
+Requests only queue a refresh: a single task works through the queue one
+conversation at a time, a full queue drops the refresh and a failed one is
+retried after a later turn. Workers refreshing the same conversation keep
+whichever summary is stored first
+"""
+import asyncio
+from datetime import datetime
+import os
+import time
+from typing import Dict, List, Optional
+
+from fastapi.logger import logger
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from api.personas.debate_persona import normalize_prompt
+from api.services.llm_service import LLMService
+from api.services.metrics import SUMMARY_SECONDS
+from db.models import ConversationSummary, Message
+
+messages = Message.__table__
+summaries = ConversationSummary.__table__
+
+SUMMARY_PROMPT = normalize_prompt("""
+You keep the running summary of a debate between a user and a debater
+defending an assigned position. Update the summary with the new turns.
+
+- Keep each side's main claims, evidence and concessions, drop repetition.
+- Write plain sentences, no preamble, at most {words} words.
+""")
+
+
+class ConversationSummarizer:
+    def __init__(
+        self,
+        threshold: int = 24,
+        tail: int = 8,
+        summary_tokens: int = 300,
+        max_queued: int = 1000,
+        engine: Optional[AsyncEngine] = None,
+    ):
+        if not 0 <= tail < threshold:
+            raise ValueError("tail must be lower than threshold")
+        self.threshold = threshold
+        self.tail = tail
+        self.summary_tokens = summary_tokens
+        self.max_queued = max_queued
+        # Set by start() when not given
+        self.engine = engine
+        # Conversation id -> llm to summarize it with, in arrival order
+        self._queued: Dict[str, LLMService] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["ConversationSummarizer"]:
+        """
+        None unless CONVERSATION_SUMMARIES=1
+        """
+        if os.getenv("CONVERSATION_SUMMARIES", "0") != "1":
+            return None
+        return cls(
+            threshold=int(os.getenv("SUMMARY_THRESHOLD", 24)),
+            tail=int(os.getenv("SUMMARY_TAIL", 8)),
+            summary_tokens=int(os.getenv("SUMMARY_TOKENS", 300)),
+            max_queued=int(os.getenv("SUMMARY_MAX_QUEUED", 1000)),
+        )
+
+    def start(self, engine: AsyncEngine):
+        self.engine = engine
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def schedule(self, conversation_id: str, unsummarized: int, llm: LLMService) -> bool:
+        """
+        Queues a refresh when the conversation has at least threshold
+        messages past its summary and the opening message, never waits
+        """
+        if unsummarized < self.threshold or conversation_id in self._queued:
+            return False
+        if len(self._queued) >= self.max_queued:
+            self.dropped += 1
+            return False
+        self._queued[conversation_id] = llm
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queued:
+                conversation_id = next(iter(self._queued))
+                llm = self._queued.pop(conversation_id)
+                try:
+                    await self.refresh(conversation_id, llm)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Summary of {conversation_id} failed: {str(e)}")
+
+    async def refresh(self, conversation_id: str, llm: LLMService) -> bool:
+        """
+        Folds the committed messages past the summary, all but the last tail,
+        into it. False when there weren't threshold of them or another worker
+        stored a summary meanwhile
+        """
+        started = time.perf_counter()
+        async with self.engine.connect() as conn:
+            current = (await conn.execute(
+                select(summaries.c.summary, summaries.c.last_seq, summaries.c.message_count)
+                .where(summaries.c.conversation_id == conversation_id)
+            )).first()
+            if current is not None:
+                mark = current.last_seq
+            else:
+                mark = (await conn.execute(
+                    select(func.min(messages.c.seq))
+                    .where(messages.c.conversation_id == conversation_id)
+                )).scalar()
+                if mark is None:
+                    return False
+            result = await conn.execute(
+                select(messages.c.id, messages.c.seq, messages.c.role, messages.c.content)
+                .where(messages.c.conversation_id == conversation_id, messages.c.seq > mark)
+                .order_by(messages.c.seq)
+            )
+            unsummarized = result.all()
+        if len(unsummarized) < self.threshold:
+            return False
+
+        folded = unsummarized[:len(unsummarized) - self.tail]
+        summary = await self.summarize(
+            current.summary if current is not None else None,
+            [{"role": row.role, "content": row.content} for row in folded],
+            llm,
+        )
+        values = dict(
+            summary=summary,
+            last_message_id=folded[-1].id,
+            last_seq=folded[-1].seq,
+            message_count=len(folded) + (current.message_count if current is not None else 0),
+            updated_at=datetime.now(),
+        )
+        try:
+            async with self.engine.begin() as conn:
+                if current is None:
+                    await conn.execute(
+                        insert(summaries).values(conversation_id=conversation_id, **values))
+                else:
+                    result = await conn.execute(
+                        update(summaries)
+                        .where(
+                            summaries.c.conversation_id == conversation_id,
+                            summaries.c.last_seq == mark,
+                        )
+                        .values(**values))
+                    if result.rowcount == 0:
+                        return False
+        except IntegrityError:
+            return False
+        self.refreshed += 1
+        SUMMARY_SECONDS.observe(time.perf_counter() - started)
+        return True
+
+    async def summarize(
+        self,
+        summary: Optional[str],
+        turns: List[Dict],
+        llm: LLMService,
+    ) -> str:
+        """
+        Previous summary updated with the turns, roles as stored in messages
+        """
+        transcript = "\n".join(
+            f"{'Debater' if turn['role'] == 'bot' else 'User'}: {turn['content']}"
+            for turn in turns
+        )
+        response = await llm.chat_completion(messages=[
+            {
+                "role": "system",
+                # ~0.75 words per token
+                "content": SUMMARY_PROMPT.format(words=self.summary_tokens * 3 // 4),
+            },
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}",
+            },
+        ])
+        content = response["choices"][0]["message"]["content"].strip()
+        if not content:
+            raise ValueError("Empty summary from LLM")
+        return content
+
+    def stats(self) -> Dict:
+        return {
+            "queued": len(self._queued),
+            "refreshed": self.refreshed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+conversation_summarizer = ConversationSummarizer.from_env()
@@ -0,0 +1,99 @@
+from datetime import datetime
+import gzip
+import zlib
+
+import pytest
+from sqlalchemy import func, insert, select
+
+from api.services.bulk_transfer import (
+    AUTO_WBITS,
+    DECOMPRESS_CHUNK,
+    decompressed,
+    export_ndjson,
+    import_ndjson,
+    ndjson_lines,
+)
+from db.models import Conversation, Message
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_lines_across_chunks_and_gzip():
+    data = b'{"a": 1}\n\n{"b": 2}\n{"c": 3}'
+    expected = [(1, b'{"a": 1}'), (3, b'{"b": 2}'), (4, b'{"c": 3}')]
+    assert [line async for line in ndjson_lines(chunked(data, 3))] == expected
+    assert [
+        line async for line in ndjson_lines(chunked(gzip.compress(data), 5), gzip=True)
+    ] == expected
+
+
+def test_decompressed_output_is_bounded():
+    bomb = gzip.compress(b"\n" * (10 * DECOMPRESS_CHUNK))
+    pieces = list(decompressed(zlib.decompressobj(wbits=AUTO_WBITS), bomb))
+    assert max(map(len, pieces)) <= DECOMPRESS_CHUNK
+    assert sum(map(len, pieces)) == 10 * DECOMPRESS_CHUNK
+
+
+@pytest.mark.asyncio
+async def test_ndjson_lines_rejects_overlong_lines():
+    bomb = gzip.compress(b'{"a": "' + b"x" * 10_000)
+    with pytest.raises(ValueError, match="Line 1 longer than 1000 bytes"):
+        [line async for line in ndjson_lines(chunked(bomb, 1000), gzip=True, max_line=1000)]
+
+
+@pytest.mark.asyncio
+async def test_export_import_round_trip_in_batches(file_engines):
+    source = await file_engines("source.db")
+    target = await file_engines("target.db")
+    async with source.begin() as conn:
+        await conn.execute(insert(Conversation), [
+            {"id": f"c{i}"} for i in range(5)])
+        await conn.execute(insert(Message), [
+            {
+                "id": f"c{i}-{seq}",
+                "conversation_id": f"c{i}",
+                "content": f"message {seq}",
+                "role": "user" if seq % 2 else "bot",
+                "timestamp": datetime(2024, 1, 1, 0, 0, seq),
+                "seq": seq,
+            }
+            # c0 has no messages
+            for i in range(1, 5) for seq in range(1, 8)
+        ])
+
+    exported = b"".join([
+        chunk async for chunk in export_ndjson(source, gzip=True, batch_size=4)])
+    assert len(gzip.decompress(exported).splitlines()) == 1 + 4 * 7
+
+    counts = await import_ndjson(
+        target, chunked(exported, 100), gzip=True, batch_size=6)
+    assert counts == {"conversations": 5, "messages": 28, "skipped": 0}
+
+    async with target.connect() as conn:
+        rows = (await conn.execute(
+            select(Message.id, Message.seq, Message.timestamp)
+            .order_by(Message.id))).all()
+        assert len(rows) == 28
+        assert rows[0] == ("c1-1", 1, datetime(2024, 1, 1, 0, 0, 1))
+        assert (await conn.execute(
+            select(func.count()).select_from(Conversation))).scalar_one() == 5
+
+    counts = await import_ndjson(target, chunked(exported, 100), gzip=True)
+    assert counts == {"conversations": 0, "messages": 0, "skipped": 28}
+
+
+@pytest.mark.asyncio
+async def test_import_reports_the_line_number_of_a_mistyped_line(file_engines):
+    target = await file_engines("target.db")
+    data = b"\n".join([
+        b'{"conversation_id": "c1"}',
+        b"",
+        b'{"conversation_id": "c1", "id": "m1", "seq": "1", "role": "user",'
+        b' "content": "hi", "timestamp": "2024-01-01T00:00:00"}',
+    ])
+    with pytest.raises(ValueError, match="^line 3: seq must be a positive integer$"):
+        await import_ndjson(target, chunked(data, 7))
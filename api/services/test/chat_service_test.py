@@ -1,7 +1,13 @@
+import asyncio
+import uuid
 
 import pytest
-from api.services.chat_service import ChatService
-from sqlalchemy.ext.asyncio import AsyncSession
+from api.services.chat_service import ChatService, write_in_background
+from api.services.history_cache import HistoryCache
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 
 @pytest.mark.asyncio
@@ -26,3 +32,143 @@ async def test_chat_service_add_message(db_session):
     await service.add_message(conversation.id, "test reply", "bot")
     messages = await service.get_messages(conversation.id)
     assert len(messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_service_format_messages_uses_history_cache(db_session):
+    cache = HistoryCache()
+    service = ChatService(db_session, history_cache=cache)
+    conversation = await service.create_conversation()
+    await service.add_message(conversation.id, "Earth is flat", "user")
+    await service.add_message(conversation.id, "It is not", "bot")
+    expected = [
+        {"role": "user", "content": "Earth is flat"},
+        {"role": "assistant", "content": "It is not"},
+    ]
+    assert await service.format_messages_for_llm(conversation.id) == expected
+    assert cache.hits == 1
+
+    cache.clear()
+    assert await service.format_messages_for_llm(conversation.id) == expected
+    assert cache.misses == 1
+    assert await service.format_messages_for_llm(conversation.id) == expected
+    assert cache.hits == 2
+
+
+def test_history_cache_eviction():
+    cache = HistoryCache(maxsize=2, ttl=600)
+    cache.fill("a", [])
+    cache.fill("b", [])
+    cache.get("a")
+    cache.fill("c", [])
+    assert cache.get("b") is None
+    assert cache.get("a") == []
+
+    expired = HistoryCache(maxsize=2, ttl=0)
+    expired.fill("a", [])
+    assert expired.get("a") is None
+
+
+def test_history_cache_drops_fill_that_raced_a_write():
+    cache = HistoryCache()
+    token = cache.write_token()
+    cache.append("a", {"role": "user", "content": "new"})
+    cache.fill("a", [], token)
+    assert cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_chat_service_add_turn_commits_once(db_session):
+    commits = []
+    event.listen(db_session.sync_session, "after_commit", commits.append)
+    service = ChatService(db_session, history_cache=HistoryCache())
+    user_message, bot_message = await service.add_turn(None, "Earth is flat", "It is not")
+    assert len(commits) == 1
+    assert user_message.conversation_id == bot_message.conversation_id
+    assert bot_message.timestamp >= user_message.timestamp
+
+    await service.add_turn(user_message.conversation_id, "It is", "Still not")
+    assert len(commits) == 2
+    messages = await service.get_messages(user_message.conversation_id)
+    assert [m.content for m in messages] == ["Still not", "It is", "It is not", "Earth is flat"]
+    assert [m.seq for m in messages] == [4, 3, 2, 1]
+    history = await service.format_messages_for_llm(user_message.conversation_id)
+    assert [m["content"] for m in history] == [m.content for m in reversed(messages)]
+
+
+@pytest.mark.asyncio
+async def test_chat_service_reads_do_not_load_relationships(db_session, query_counter):
+    service = ChatService(db_session, history_cache=HistoryCache(maxsize=0))
+    user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+    conversation_id = user_message.conversation_id
+
+    query_counter.clear()
+    await service.ensure_conversation_exists(conversation_id)
+    assert len(query_counter) == 1
+    assert "messages" not in query_counter[0]
+
+    query_counter.clear()
+    messages = await service.get_messages(conversation_id)
+    await service.format_messages_for_llm(conversation_id)
+    assert len(query_counter) == 2
+    with pytest.raises(InvalidRequestError):
+        messages[0].conversation
+
+    query_counter.clear()
+    conversation = await service.get_conversation(conversation_id)
+    assert len(query_counter) == 1
+    with pytest.raises(InvalidRequestError):
+        conversation.messages
+
+    db_session.expunge_all()
+    conversation = await service.get_conversation(conversation_id, with_messages=True)
+    assert len(conversation.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_service_ensure_conversation_exists_raises_404(db_session):
+    service = ChatService(db_session)
+    with pytest.raises(HTTPException) as error:
+        await service.ensure_conversation_exists("nonexistent-id")
+    assert error.value.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_service_reads_wait_for_background_write(async_engine, db_session):
+    writer_session = async_sessionmaker(async_engine, expire_on_commit=False)()
+    conversation_id = str(uuid.uuid4())
+
+    async def write():
+        await asyncio.sleep(0.05)
+        await ChatService(writer_session).add_turn(
+            conversation_id, "Earth is flat", "It is not", new_conversation=True)
+
+    write_in_background(conversation_id, write())
+    service = ChatService(db_session, history_cache=HistoryCache())
+    await service.ensure_conversation_exists(conversation_id)
+    assert len(await service.get_messages(conversation_id)) == 2
+    await writer_session.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_turns_get_distinct_seqs(file_engine):
+    session_factory = async_sessionmaker(file_engine, expire_on_commit=False)
+    async with session_factory() as db:
+        user_message, _ = await ChatService(
+            db, history_cache=HistoryCache(), journal=None).add_turn(None, "first", "reply")
+    conversation_id = user_message.conversation_id
+
+    async def turn(i: int):
+        async with session_factory() as db:
+            service = ChatService(db, history_cache=HistoryCache(), journal=None)
+            return await service.add_turn(conversation_id, f"user {i}", f"bot {i}")
+
+    turns = await asyncio.gather(*(turn(i) for i in range(4)))
+    seqs = sorted(message.seq for pair in turns for message in pair)
+    assert seqs == list(range(3, 11))
+    for user, bot in turns:
+        assert bot.seq == user.seq + 1
+    async with session_factory() as db:
+        service = ChatService(db, history_cache=HistoryCache(), journal=None)
+        messages = await service.get_messages_before(conversation_id, limit=20)
+    assert [message.seq for message in messages] == list(range(10, 0, -1))
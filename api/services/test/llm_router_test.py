@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+
+from api.services import http_client
+from api.services.llm_router import LLMRouter
+from api.services.llm_service import LLMService
+from api.services.overload import AdaptiveLimiter, CircuitBreaker
+from bench.stub_llm import StubLLMServer
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest_asyncio.fixture
+async def stubs():
+    fast = StubLLMServer(latency=0.02, response="Fast response")
+    slow = StubLLMServer(latency=0.4, response="Slow response")
+    await fast.start()
+    await slow.start()
+    yield fast, slow
+    await fast.stop()
+    await slow.stop()
+    await http_client.close_session()
+
+
+def make_backend(base_url: str) -> LLMService:
+    return LLMService(
+        api_key="test",
+        base_url=base_url,
+        model="stub",
+        temperature=0.1,
+        max_tokens=50,
+        max_retries=1,
+        flights=None,
+        limiter=AdaptiveLimiter(),
+        breaker=CircuitBreaker(),
+    )
+
+
+@pytest.mark.asyncio
+async def test_routes_to_fastest_backend(stubs):
+    fast, slow = stubs
+    router = LLMRouter([make_backend(slow.base_url), make_backend(fast.base_url)])
+    for _ in range(5):
+        await router.chat_completion(MESSAGES)
+    # One call each to measure them, then only the fast one
+    assert slow.requests == 1
+    assert fast.requests == 4
+    assert router.ranked()[0].base_url == fast.base_url
+
+
+@pytest.mark.asyncio
+async def test_fails_over_to_next_backend(stubs):
+    fast, _ = stubs
+    dead = make_backend("http://127.0.0.1:1")
+    router = LLMRouter([dead, make_backend(fast.base_url)])
+    response = await router.chat_completion(MESSAGES)
+    assert response["choices"][0]["message"]["content"] == "Fast response"
+    assert router.stats_for(dead).errors == 1
+    assert router.ranked()[0] is not dead
+
+
+@pytest.mark.asyncio
+async def test_hedges_slow_first_token(stubs):
+    fast, slow = stubs
+    router = LLMRouter(
+        [make_backend(slow.base_url), make_backend(fast.base_url)],
+        hedge=True,
+        hedge_delay=0.05,
+    )
+    started = time.perf_counter()
+    chunks = [chunk async for chunk in router.stream_chat_completion(MESSAGES)]
+    assert "".join(chunks) == "Fast response "
+    assert time.perf_counter() - started < slow.latency
+    assert (router.hedges, router.hedge_wins) == (1, 1)
+    # The slow request was cancelled rather than left running
+    await asyncio.sleep(0.01)
+    assert slow.requests == 1
+    assert router.backends[0].limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_backend_recovers_after_transient_errors(stubs):
+    fast, slow = stubs
+    now = [0.0]
+    fast.error_rate = 1.0
+    router = LLMRouter(
+        [make_backend(fast.base_url), make_backend(slow.base_url)], clock=lambda: now[0])
+    for _ in range(3):
+        await router.chat_completion(MESSAGES)
+    # The failed backend has no time to first token and sorts last
+    assert (fast.requests, slow.requests) == (1, 3)
+
+    fast.error_rate = 0.0
+    now[0] += 30
+    # Both are due for a probe, then the recovered one is preferred again
+    for _ in range(3):
+        await router.chat_completion(MESSAGES)
+    assert (fast.requests, slow.requests) == (3, 4)
+    assert router.ranked()[0].base_url == fast.base_url
+
+
+def test_error_rate_decays_while_idle():
+    now = [0.0]
+    backend = make_backend("http://127.0.0.1:1")
+    router = LLMRouter([backend], clock=lambda: now[0])
+    stats = router.stats_for(backend)
+    for _ in range(5):
+        stats.record_error()
+    assert not router.healthy(backend)
+    assert not router.due_for_probe(backend)
+    now[0] += 30
+    assert stats.error_rate == pytest.approx((1 - 0.8 ** 5) / 2)
+    assert router.healthy(backend)
+    assert router.due_for_probe(backend)
+
+
+def test_hedge_delay_is_primary_p95_once_measured():
+    backend = make_backend("http://127.0.0.1:1")
+    router = LLMRouter([backend], hedge=True, hedge_delay=2.0, hedge_min_samples=20)
+    stats = router.stats_for(backend)
+    for i in range(19):
+        stats.record_success(0.1 + i / 100)
+    assert router.hedge_after(backend) == 2.0
+    stats.record_success(0.5)
+    assert router.hedge_after(backend) == 0.5
+    assert 0.1 < stats.ttft < 0.5
+
+
+@pytest.mark.asyncio
+async def test_backend_gauges_are_labelled_per_backend():
+    dead = make_backend("http://127.0.0.1:1")
+    dead.breaker.failure_threshold = 1
+    other = make_backend("http://127.0.0.2:1")
+    router = LLMRouter([dead, other])
+    await dead.limiter.acquire()
+    dead.breaker.record_failure()
+
+    concurrency = router.concurrency()
+    assert concurrency[("stub@127.0.0.1:1", "in_flight")] == 1
+    assert concurrency[("stub@127.0.0.2:1", "in_flight")] == 0
+    assert concurrency[("stub@127.0.0.1:1", "limit")] == 20
+    states = router.breaker_states()
+    assert states[("stub@127.0.0.1:1", "open")] == 1
+    assert states[("stub@127.0.0.2:1", "closed")] == 1
+    assert sum(states.values()) == 2
+    backends = router.stats()["backends"]
+    assert [(b["in_flight"], b["breaker"]) for b in backends] == [(1, "open"), (0, "closed")]
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+
+from api.services import http_client
+from api.services.llm_service import LLMService
+from api.services.single_flight import SingleFlight
+from bench.stub_llm import StubLLMServer
+
+
+@pytest_asyncio.fixture
+async def stub_llm():
+    stub = StubLLMServer(latency=0.2, response="Stub response")
+    await stub.start()
+    yield stub
+    await stub.stop()
+    await http_client.close_session()
+
+
+def make_llm(base_url: str) -> LLMService:
+    return LLMService(
+        api_key="test",
+        base_url=base_url,
+        model="stub",
+        temperature=0.1,
+        max_tokens=50,
+        max_retries=1,
+    )
+
+
+@pytest.mark.asyncio
+async def test_chat_completion(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    response = await llm.chat_completion([{"role": "user", "content": "hi"}])
+    assert response["choices"][0]["message"]["content"] == "Stub response"
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_does_not_block_event_loop(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        llm.chat_completion([{"role": "user", "content": f"hi {i}"}])
+        for i in range(5)
+    ))
+    assert time.perf_counter() - started < 5 * stub_llm.latency
+    assert stub_llm.requests == 5
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_raises_after_retries():
+    llm = make_llm("http://127.0.0.1:1")
+    with pytest.raises(Exception, match="LLM API failed after 1 attempts"):
+        await llm.chat_completion([{"role": "user", "content": "hi"}])
+    await http_client.close_session()
+
+
+@pytest.mark.asyncio
+async def test_llm_services_share_pooled_connections(stub_llm):
+    metrics = http_client.pool.metrics
+    new_before = metrics.new_connections
+    reused_before = metrics.reused_connections
+    for _ in range(3):
+        await make_llm(stub_llm.base_url).chat_completion(
+            [{"role": "user", "content": "hi"}])
+    assert metrics.new_connections - new_before == 1
+    assert metrics.reused_connections - reused_before == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_completion_yields_text(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    chunks = [
+        chunk async for chunk in llm.stream_chat_completion(
+            [{"role": "user", "content": "hi"}])
+    ]
+    assert all(isinstance(chunk, str) for chunk in chunks)
+    assert "".join(chunks) == "Stub response "
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_completions_share_one_request(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    responses = await asyncio.gather(*(
+        llm.chat_completion([{"role": "user", "content": "hi"}])
+        for _ in range(8)
+    ))
+    assert stub_llm.requests == 1
+    assert all(response == responses[0] for response in responses)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_streams_share_one_request(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    stub_llm.chunk_delay = 0.01
+
+    async def read(delay: float) -> str:
+        await asyncio.sleep(delay)
+        chunks = [
+            chunk async for chunk in llm.stream_chat_completion(
+                [{"role": "user", "content": "hi"}])
+        ]
+        return "".join(chunks)
+
+    # Late subscribers join mid-stream and get the missed chunks replayed
+    results = await asyncio.gather(*(read(0.03 * i) for i in range(6)))
+    assert stub_llm.requests == 1
+    assert results == ["Stub response "] * 6
+
+
+@pytest.mark.asyncio
+async def test_stream_outliving_replay_buffer_is_not_shared(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    llm.flights = SingleFlight(replay_limit=1)
+    stub_llm.chunk_delay = 0.1
+    messages = [{"role": "user", "content": "hi"}]
+
+    async def read(delay: float) -> str:
+        await asyncio.sleep(delay)
+        return "".join([chunk async for chunk in llm.stream_chat_completion(messages)])
+
+    results = await asyncio.gather(read(0), read(stub_llm.latency + 0.15))
+    assert results == ["Stub response "] * 2
+    assert stub_llm.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_request(stub_llm):
+    llm = make_llm(stub_llm.base_url)
+    messages = [{"role": "user", "content": "hi"}]
+    first = asyncio.ensure_future(llm.chat_completion(messages))
+    second = asyncio.ensure_future(llm.chat_completion(messages))
+    await asyncio.sleep(0.05)
+    first.cancel()
+    response = await second
+    assert response["choices"][0]["message"]["content"] == "Stub response"
+    assert stub_llm.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_chat_completion_raises_on_in_band_error():
+    stub = StubLLMServer(stream_error_rate=1.0, response_tokens=20)
+    llm = make_llm(await stub.start())
+    with pytest.raises(ValueError, match="LLM stream error"):
+        async for _ in llm.stream_chat_completion([{"role": "user", "content": "hi"}]):
+            pass
+    await stub.stop()
+    await http_client.close_session()
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import time
+
+import pytest
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from api.services.message_journal import MessageJournal
+from db.models import Message
+
+
+async def committed_rows(engine) -> int:
+    async with engine.connect() as conn:
+        return (await conn.execute(select(func.count()).select_from(Message))).scalar_one()
+
+
+@pytest.mark.asyncio
+async def test_pending_turns_are_readable_before_flush(file_engine):
+    journal = MessageJournal(batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    try:
+        async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+            conversation_id = user_message.conversation_id
+            await service.add_turn(conversation_id, "It is", "Ships vanish hull first")
+            assert await committed_rows(file_engine) == 0
+
+            await service.ensure_conversation_exists(conversation_id)
+            messages = await service.get_messages(conversation_id)
+            assert [message.seq for message in messages] == [4, 3, 2, 1]
+
+            await journal.flush()
+            assert await committed_rows(file_engine) == 4
+            assert journal.pending_messages(conversation_id) == []
+            await service.add_turn(conversation_id, "Fine", "Thanks")
+            page = await service.get_messages_before(conversation_id, before=6, limit=3)
+            assert [message.seq for message in page] == [5, 4, 3]
+            service.history_cache.clear()
+            history = await service.format_messages_for_llm(conversation_id)
+            assert [message["content"] for message in history] == [
+                "Earth is flat", "It is not", "It is", "Ships vanish hull first",
+                "Fine", "Thanks",
+            ]
+    finally:
+        await journal.stop()
+    assert await committed_rows(file_engine) == 6
+
+
+@pytest.mark.asyncio
+async def test_batch_size_triggers_one_multi_row_insert(file_engine):
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT"):
+            statements.append(statement)
+
+    event.listen(file_engine.sync_engine, "before_cursor_execute", on_execute)
+    journal = MessageJournal(batch_size=6, flush_interval=60)
+    await journal.start(file_engine)
+    try:
+        async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            for i in range(3):
+                await service.add_turn(None, f"claim {i}", "no")
+            for _ in range(100):
+                if journal.flushes:
+                    break
+                await asyncio.sleep(0.01)
+    finally:
+        await journal.stop()
+    assert journal.stats()["flushes"] == 1
+    assert journal.stats()["flushed_rows"] == 6
+    # One statement for the conversations, one for the messages
+    assert len(statements) == 2
+
+
+@pytest.mark.asyncio
+async def test_journal_file_is_replayed_on_start(file_engine, tmp_path):
+    path = tmp_path / "messages.journal"
+    journal = MessageJournal(path=str(path), batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+        service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+        user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+        first_turn = path.read_bytes()
+        await journal.flush()
+        await service.add_turn(user_message.conversation_id, "It is", "It is not")
+    # Crash with the second turn unflushed and the first one committed but
+    # still in the file, as if the process died before compacting it
+    journal._task.cancel()
+    journal._file.close()
+    journal._lock_file.close()
+    path.write_bytes(first_turn + path.read_bytes())
+    assert await committed_rows(file_engine) == 2
+
+    restarted = MessageJournal(path=str(path))
+    await restarted.start(file_engine)
+    await restarted.stop()
+    assert restarted.replayed_rows == 2
+    assert await committed_rows(file_engine) == 4
+    assert path.read_bytes() == b""
+
+
+async def add_turn_elsewhere(engine, conversation_id):
+    """
+    A turn written straight to the database, as by another process
+    """
+    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+        service = ChatService(session, history_cache=HistoryCache(), journal=None)
+        await service.add_turn(conversation_id, "Elsewhere", "Also elsewhere")
+
+
+@pytest.mark.asyncio
+async def test_turns_losing_their_seqs_are_renumbered(file_engine):
+    journal = MessageJournal(batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    try:
+        async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+            conversation_id = user_message.conversation_id
+            await journal.flush()
+            await service.add_turn(conversation_id, "It is", "Ships vanish hull first")
+            await add_turn_elsewhere(file_engine, conversation_id)
+            await journal.flush()
+    finally:
+        await journal.stop()
+    async with file_engine.connect() as conn:
+        result = await conn.execute(select(Message.seq, Message.content).order_by(Message.seq))
+        assert [tuple(row) for row in result] == [
+            (1, "Earth is flat"), (2, "It is not"), (3, "Elsewhere"),
+            (4, "Also elsewhere"), (5, "It is"), (6, "Ships vanish hull first"),
+        ]
+    assert journal.stats()["renumbered_rows"] == 2
+    assert journal.stats()["rejected_rows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_turns_still_refused_are_kept_in_rejected_file(file_engine, tmp_path, monkeypatch):
+    path = tmp_path / "messages.journal"
+    journal = MessageJournal(path=str(path), batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    try:
+        async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+            await journal.flush()
+            await service.add_turn(user_message.conversation_id, "It is", "It is not")
+            await add_turn_elsewhere(file_engine, user_message.conversation_id)
+
+            async def keep_seqs(entry):
+                pass
+            monkeypatch.setattr(journal, "_renumber", keep_seqs)
+            await journal.flush()
+    finally:
+        await journal.stop()
+    assert await committed_rows(file_engine) == 4
+    assert journal.stats()["rejected_rows"] == 2
+    rejected = (tmp_path / "messages.journal.rejected").read_bytes()
+    assert b'"content":"It is"' in rejected and rejected.count(b"\n") == 1
+
+
+def slowed(fn):
+    def wrapper(*args):
+        time.sleep(0.05)
+        return fn(*args)
+    return wrapper
+
+
+@pytest.mark.asyncio
+async def test_appends_during_compaction_stay_in_the_file(file_engine, tmp_path, monkeypatch):
+    path = tmp_path / "messages.journal"
+    journal = MessageJournal(path=str(path), batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    monkeypatch.setattr(journal, "_rewrite", slowed(journal._rewrite))
+    monkeypatch.setattr("api.services.message_journal.os.replace", slowed(os.replace))
+    try:
+        async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            await service.add_turn(None, "Earth is flat", "It is not")
+            flushing = asyncio.ensure_future(journal.flush())
+            await asyncio.sleep(0.02)
+            # While the file is rewritten, then while it is swapped in
+            await service.add_turn(None, "The moon is fake", "It is not")
+            while journal._next_file is None:
+                await asyncio.sleep(0.005)
+            await service.add_turn(None, "Birds aren't real", "They are")
+            await flushing
+            lines = path.read_bytes()
+            assert b"Earth is flat" not in lines
+            assert lines.count(b"The moon is fake") == lines.count(b"Birds aren't real") == 1
+    finally:
+        await journal.stop()
+    assert await committed_rows(file_engine) == 6
+
+
+@pytest.mark.asyncio
+async def test_journal_file_is_locked_to_one_process(file_engine, tmp_path):
+    path = str(tmp_path / "messages.journal")
+    journal = MessageJournal(path=path)
+    await journal.start(file_engine)
+    try:
+        with pytest.raises(RuntimeError, match="in use"):
+            await MessageJournal(path=path).start(file_engine)
+    finally:
+        await journal.stop()
+    other = MessageJournal(path=path)
+    await other.start(file_engine)
+    await other.stop()
+
+
+@pytest.mark.asyncio
+async def test_replay_renumbers_or_rejects_conflicting_lines(file_engine, tmp_path):
+    path = tmp_path / "messages.journal"
+    journal = MessageJournal(path=str(path), batch_size=1000, flush_interval=60)
+    await journal.start(file_engine)
+    async with async_sessionmaker(file_engine, expire_on_commit=False)() as session:
+        service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+        user_message, _ = await service.add_turn(None, "Earth is flat", "It is not")
+        await journal.flush()
+        await service.add_turn(user_message.conversation_id, "It is", "Ships vanish hull first")
+    # Crash with the second turn unflushed, its seqs taken meanwhile by a
+    # turn written elsewhere, and a last line cut short
+    journal._task.cancel()
+    journal._file.close()
+    journal._lock_file.close()
+    await add_turn_elsewhere(file_engine, user_message.conversation_id)
+    with open(path, "ab") as f:
+        f.write(b'{"conversation": null, "mess')
+
+    restarted = MessageJournal(path=str(path))
+    await restarted.start(file_engine)
+    await restarted.stop()
+    assert restarted.replayed_rows == 2
+    assert restarted.stats()["renumbered_rows"] == 2
+    async with file_engine.connect() as conn:
+        result = await conn.execute(select(Message.seq, Message.content).order_by(Message.seq))
+        assert [row.content for row in result][4:] == ["It is", "Ships vanish hull first"]
+    assert (tmp_path / "messages.journal.rejected").read_bytes() == b'{"conversation": null, "mess\n'
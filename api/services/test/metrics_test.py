@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+
+from api.services.metrics import Gauge, Histogram, LoopLagMonitor, Metric, Registry, timed
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram("db_seconds", "DB time", ["method"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, "add_turn")
+    histogram.observe(0.5, "add_turn")
+    histogram.observe(3.0, "add_turn")
+    assert registry.render() == "\n".join([
+        "# HELP db_seconds DB time",
+        "# TYPE db_seconds histogram",
+        'db_seconds_bucket{method="add_turn",le="0.1"} 1',
+        'db_seconds_bucket{method="add_turn",le="1.0"} 2',
+        'db_seconds_bucket{method="add_turn",le="+Inf"} 3',
+        'db_seconds_sum{method="add_turn"} 3.55',
+        'db_seconds_count{method="add_turn"} 3',
+    ]) + "\n"
+
+
+def test_metric_kinds_must_define_samples():
+    class Untyped(Metric):
+        kind = "untyped"
+
+    with pytest.raises(TypeError):
+        Untyped("untyped", "No samples")
+
+
+def test_gauge_callback():
+    gauge = Gauge("pool", "Pool", ["state"], callback=lambda: {("used",): 3})
+    assert gauge.samples() == ['pool{state="used"} 3']
+
+
+@pytest.mark.asyncio
+async def test_timed_wraps_blocks_functions_coroutines_and_generators():
+    histogram = Histogram("seconds", "Time", ["kind"])
+
+    with timed(histogram, "block"):
+        pass
+
+    @timed(histogram, "function")
+    def function():
+        return 1
+
+    @timed(histogram, "coroutine")
+    async def coroutine():
+        await asyncio.sleep(0.01)
+        return 2
+
+    @timed(histogram, "generator")
+    async def generator():
+        yield 3
+        yield 4
+
+    assert function() == 1
+    assert await coroutine() == 2
+    assert [item async for item in generator()] == [3, 4]
+    assert coroutine.__name__ == "coroutine"
+    for kind in ("block", "function", "coroutine", "generator"):
+        assert histogram.count(kind) == 1
+    assert histogram._series[("coroutine",)][1] >= 0.01
+
+
+@pytest.mark.asyncio
+async def test_timed_closes_generators_the_consumer_stops_early():
+    histogram = Histogram("seconds", "Time")
+    closed = []
+
+    @timed(histogram)
+    async def generator():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    stream = generator()
+    assert await stream.__anext__() == 1
+    await stream.aclose()
+    assert closed == [True]
+    assert histogram.count() == 1
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_sees_blocking_work():
+    histogram = Histogram("lag", "Lag")
+    monitor = LoopLagMonitor(histogram, interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.02)
+    time.sleep(0.05)
+    await asyncio.sleep(0.02)
+    await monitor.stop()
+    assert histogram.count() >= 2
+    assert max(monitor.last_lag, histogram._series[()][1]) >= 0.03
@@ -0,0 +1,156 @@
+import asyncio
+from email.utils import formatdate
+import time
+
+import pytest
+
+from api.services import http_client
+from api.services.llm_service import LLMService
+from api.services.overload import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    CircuitOpen,
+    Overloaded,
+    UpstreamBusy,
+    backoff_delay,
+    parse_retry_after,
+)
+from bench.stub_llm import StubLLMServer
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    assert 8 < parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+
+
+def test_backoff_delay():
+    assert all(0 <= backoff_delay(3) <= 4 for _ in range(100))
+    assert all(2 <= backoff_delay(0, retry_after=2) <= 2.5 for _ in range(100))
+    assert backoff_delay(10, retry_after=600, base=0) == 20
+
+
+@pytest.mark.asyncio
+async def test_limiter_rejects_when_queue_is_full():
+    limiter = AdaptiveLimiter(initial_limit=1, max_queue=1, queue_timeout=1)
+    await limiter.acquire()
+    queued = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded):
+        await limiter.acquire()
+    limiter.release()
+    await queued
+    assert limiter.stats() == {
+        "limit": 1, "in_flight": 1, "queued": 0, "rejected": 1, "decreases": 0}
+
+
+@pytest.mark.asyncio
+async def test_limiter_queue_timeout():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_timeout=0.01)
+    await limiter.acquire()
+    with pytest.raises(Overloaded, match="Timed out"):
+        await limiter.acquire()
+    assert limiter.stats()["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_release_skips_cancelled_waiters():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_timeout=1)
+    await limiter.acquire()
+    cancelled = asyncio.ensure_future(limiter.acquire())
+    queued = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    # Cancelled, but its task hasn't run to take it off the queue yet
+    limiter._waiters[0].cancel()
+    limiter.release()
+    await queued
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert limiter.stats()["in_flight"] == 1
+    assert limiter.stats()["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_aimd():
+    # A fixed clock, scheduling jitter on microsecond round trips would look
+    # like latency spikes
+    limiter = AdaptiveLimiter(initial_limit=10, backoff_ratio=0.5, clock=lambda: 100.0)
+    with pytest.raises(UpstreamBusy):
+        async with limiter.slot():
+            raise UpstreamBusy(429)
+    assert limiter.limit == 5
+
+    # Fast successes while busy grow the limit additively
+    for _ in range(5):
+        slots = [limiter.slot() for _ in range(int(limiter.limit))]
+        for slot in slots:
+            await slot.__aenter__()
+        for slot in slots:
+            await slot.__aexit__(None, None, None)
+    assert 7 < limiter.limit < 8
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_decreases_once_per_round_trip():
+    limiter = AdaptiveLimiter(initial_limit=10, backoff_ratio=0.5)
+    slots = [limiter.slot() for _ in range(3)]
+    for slot in slots:
+        await slot.__aenter__()
+    await asyncio.sleep(0.001)
+    for slot in slots:
+        await slot.__aexit__(UpstreamBusy, UpstreamBusy(429), None)
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+
+def test_circuit_breaker():
+    now = [100.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+    for _ in range(2):
+        with pytest.raises(UpstreamBusy):
+            with breaker.attempt():
+                raise UpstreamBusy(503)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen) as rejected:
+        breaker.check()
+    assert rejected.value.retry_after == 30
+
+    now[0] += 30
+    assert breaker.state == "half_open"
+    with breaker.attempt():
+        # A single probe goes through while half open
+        with pytest.raises(CircuitOpen):
+            breaker.check()
+    assert breaker.stats() == {"state": "closed", "failures": 0, "opens": 1}
+
+
+@pytest.mark.asyncio
+async def test_llm_retries_honor_retry_after():
+    stub = StubLLMServer(rate_limit_ratio=1.0, retry_after=0.2)
+    base_url = await stub.start()
+    llm = LLMService(
+        api_key="test",
+        base_url=base_url,
+        model="stub",
+        temperature=0.1,
+        max_tokens=50,
+        max_retries=2,
+        flights=None,
+        limiter=AdaptiveLimiter(),
+        breaker=CircuitBreaker(failure_threshold=2),
+    )
+    started = time.perf_counter()
+    with pytest.raises(UpstreamBusy) as busy:
+        await llm.chat_completion([{"role": "user", "content": "hi"}])
+    assert busy.value.status == 429
+    assert time.perf_counter() - started >= 0.2
+    assert stub.requests == 2
+
+    # Two failures opened the circuit, the next call doesn't reach the stub
+    with pytest.raises(CircuitOpen):
+        await llm.chat_completion([{"role": "user", "content": "hi"}])
+    assert stub.requests == 2
+    await stub.stop()
+    await http_client.close_session()
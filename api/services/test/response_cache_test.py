@@ -0,0 +1,129 @@
+import sqlite3
+from unittest.mock import Mock
+
+import pytest
+
+from api.personas.debate_persona import DebatePersona
+from api.services.llm_service import LLMService
+from api.services.metrics import RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_SAVED_SECONDS
+from api.services.response_cache import ResponseCache
+from api.services.sse import FlushPolicy
+
+OPENER = [{"role": "user", "content": "Argue that Earth is flat"}]
+ANSWER = "Horizons are flat. NASA's globe is CGI."
+
+
+def mock_llm():
+    llm = Mock(spec=LLMService)
+    llm.model = "test-model"
+    llm.temperature = 0.1
+    return llm
+
+
+def test_key_ignores_whitespace_and_case():
+    cache = ResponseCache()
+    key = cache.key("m", 0.1, "p", OPENER)
+    assert key == cache.key("m", 0.1, "p", [
+        {"role": "user", "content": "  argue that  earth is FLAT\n"}])
+    assert key != cache.key("m", 0.2, "p", OPENER)
+    assert key != cache.key("other", 0.1, "p", OPENER)
+
+
+def test_key_skips_long_histories():
+    cache = ResponseCache(max_history=1)
+    assert cache.key("m", 0.1, "p", OPENER * 2) is None
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_and_ttl(monkeypatch):
+    cache = ResponseCache(maxsize=2, ttl=10)
+    now = 1000.0
+    monkeypatch.setattr("api.services.response_cache.time.time", lambda: now)
+    await cache.set("a", "A", 1.5)
+    await cache.set("b", "B", 1.0)
+    assert await cache.get("a") == "A"
+    await cache.set("c", "C", 1.0)
+    assert await cache.get("b") is None
+    now += 11
+    assert await cache.get("a") is None
+    assert cache.stats() == {
+        "size": 1,
+        "hits": 1,
+        "misses": 2,
+        "hit_ratio": 1 / 3,
+        "saved_llm_seconds": 1.5,
+    }
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "responses.db")
+    await ResponseCache(disk_path=path).set("k", ANSWER, 2.0)
+    restarted = ResponseCache(disk_path=path)
+    assert await restarted.get("k") == ANSWER
+    assert restarted.stats()["size"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_deletes_expired_rows_on_write(tmp_path, monkeypatch):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(ttl=10, disk_path=path)
+    now = 1000.0
+    monkeypatch.setattr("api.services.response_cache.time.time", lambda: now)
+    await cache.set("old", ANSWER, 1.0)
+    now += 5
+    await cache.set("recent", ANSWER, 1.0)
+    now += 6
+    await cache.set("new", ANSWER, 1.0)
+    with sqlite3.connect(path) as conn:
+        keys = {key for key, in conn.execute("SELECT key FROM response_cache")}
+    assert keys == {"recent", "new"}
+
+
+@pytest.mark.asyncio
+async def test_lookups_are_exported_as_metrics():
+    cache = ResponseCache()
+    hits, misses = RESPONSE_CACHE_LOOKUPS.value("hit"), RESPONSE_CACHE_LOOKUPS.value("miss")
+    saved = RESPONSE_CACHE_SAVED_SECONDS.value()
+    await cache.set("k", ANSWER, 2.5)
+    await cache.get("k")
+    await cache.get("other")
+    assert RESPONSE_CACHE_LOOKUPS.value("hit") == hits + 1
+    assert RESPONSE_CACHE_LOOKUPS.value("miss") == misses + 1
+    assert RESPONSE_CACHE_SAVED_SECONDS.value() == saved + 2.5
+
+
+@pytest.mark.asyncio
+async def test_persona_answers_from_cache():
+    llm = mock_llm()
+    llm.chat_completion.return_value = {"choices": [{"message": {"content": ANSWER}}]}
+    persona = DebatePersona(llm, response_cache=ResponseCache())
+    assert await persona.get_counter_argument(OPENER) == ANSWER
+    assert await persona.get_counter_argument(OPENER) == ANSWER
+    assert llm.chat_completion.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_persona_does_not_cache_failures():
+    llm = mock_llm()
+    llm.chat_completion.side_effect = RuntimeError("upstream down")
+    cache = ResponseCache()
+    persona = DebatePersona(llm, response_cache=cache)
+    await persona.get_counter_argument(OPENER)
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_replays_cached_answer_as_chunks():
+    async def stream(messages):
+        for token in ("Horizons ", "are flat. ", "NASA's globe ", "is CGI."):
+            yield token
+
+    llm = mock_llm()
+    llm.stream_chat_completion = Mock(side_effect=stream)
+    persona = DebatePersona(
+        llm, flush_policy=FlushPolicy(max_bytes=100), response_cache=ResponseCache())
+    live = [chunk async for chunk in persona.gen_counter_argument_stream(OPENER)]
+    replayed = [chunk async for chunk in persona.gen_counter_argument_stream(OPENER)]
+    assert live == replayed == ["Horizons are flat. ", "NASA's globe is CGI."]
+    assert llm.stream_chat_completion.call_count == 1
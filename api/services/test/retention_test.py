@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, insert, select, text
+
+from api.services.history_cache import HistoryCache
+from api.services.metrics import RETENTION_LOCK_SECONDS
+from api.services.retention import RetentionJob, archived_messages
+from db.models import Conversation, ConversationArchive, ConversationSummary, Message
+
+
+async def add_conversation(engine, conversation_id, last_activity, count=2, first_seq=1):
+    async with engine.begin() as conn:
+        if first_seq == 1:
+            await conn.execute(insert(Conversation), [{"id": conversation_id}])
+        await conn.execute(insert(Message), [
+            {
+                "id": f"{conversation_id}-{seq}",
+                "conversation_id": conversation_id,
+                "content": f"message {seq} " + "x" * 2000,
+                "role": "user" if seq % 2 else "bot",
+                "timestamp": last_activity - timedelta(minutes=first_seq + count - 1 - seq),
+                "seq": seq,
+            }
+            for seq in range(first_seq, first_seq + count)
+        ])
+
+
+async def remaining(engine):
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(Message.conversation_id, Message.seq)
+            .order_by(Message.conversation_id, Message.seq))
+        seqs = {}
+        for conversation_id, seq in result.all():
+            seqs[conversation_id] = (*seqs.get(conversation_id, ()), seq)
+        return seqs
+
+
+def job(engine, **kwargs) -> RetentionJob:
+    return RetentionJob(pause=0, history_cache=HistoryCache(), engine=engine, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_max_age_archives_idle_conversations(file_engine):
+    now = datetime.now()
+    await add_conversation(file_engine, "old", now - timedelta(days=40), count=3)
+    await add_conversation(file_engine, "recent", now - timedelta(days=1))
+    async with file_engine.begin() as conn:
+        await conn.execute(insert(ConversationSummary), [{
+            "conversation_id": "old", "summary": "s", "last_message_id": "old-2",
+            "last_seq": 2, "message_count": 1, "updated_at": now,
+        }])
+    locks_before = RETENTION_LOCK_SECONDS.count("archive")
+
+    retention = job(file_engine, max_age=timedelta(days=30))
+    last_pass = await retention.run_pass()
+    assert last_pass["conversations"] == 1
+    assert last_pass["messages"] == 3
+    assert await remaining(file_engine) == {"recent": (1, 2)}
+    async with file_engine.connect() as conn:
+        assert (await conn.execute(select(Conversation.id))).scalars().all() == ["recent"]
+        assert (await conn.execute(select(ConversationSummary.conversation_id))).first() is None
+    assert RETENTION_LOCK_SECONDS.count("archive") == locks_before + 1
+
+    archived = await archived_messages(file_engine, "old")
+    assert [message["seq"] for message in archived] == [1, 2, 3]
+    assert archived[0]["content"].startswith("message 1")
+    assert (await retention.run_pass())["messages"] == 0
+
+
+@pytest.mark.asyncio
+async def test_max_conversations_keeps_most_recent_in_batches(file_engine):
+    now = datetime.now()
+    for i in range(5):
+        await add_conversation(file_engine, f"c{i}", now - timedelta(hours=i))
+    retention = job(file_engine, max_conversations=2, batch_size=2)
+    last_pass = await retention.run_pass()
+    assert last_pass["conversations"] == 3
+    assert last_pass["transactions"] >= 2
+    assert set(await remaining(file_engine)) == {"c0", "c1"}
+
+
+@pytest.mark.asyncio
+async def test_max_messages_archives_oldest_messages_but_the_opening_one(file_engine):
+    now = datetime.now()
+    await add_conversation(file_engine, "long", now, count=7)
+    await add_conversation(file_engine, "short", now, count=2)
+    retention = job(file_engine, max_messages=3)
+    assert (await retention.run_pass())["messages"] == 4
+    assert await remaining(file_engine) == {"long": (1, 6, 7), "short": (1, 2)}
+
+    await add_conversation(file_engine, "long", now, count=2, first_seq=8)
+    assert (await retention.run_pass())["messages"] == 2
+    assert await remaining(file_engine) == {"long": (1, 8, 9), "short": (1, 2)}
+    archived = await archived_messages(file_engine, "long")
+    assert [message["seq"] for message in archived] == [2, 3, 4, 5, 6, 7]
+    async with file_engine.connect() as conn:
+        assert (await conn.execute(
+            select(func.count()).select_from(ConversationArchive))).scalar_one() == 2
+
+
+@pytest.mark.asyncio
+async def test_incremental_vacuum_frees_archived_pages(file_engine):
+    now = datetime.now()
+    for i in range(20):
+        await add_conversation(file_engine, f"c{i}", now - timedelta(days=40), count=10)
+    retention = job(file_engine, max_age=timedelta(days=30), vacuum_pages=50)
+    last_pass = await retention.run_pass()
+    assert last_pass["vacuumed_pages"] > 0
+    async with file_engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA freelist_count"))).scalar() == 0
@@ -0,0 +1,77 @@
+from pathlib import Path
+import random
+
+import pytest
+
+from api.services.sse_parser import SSEEvent, SSEParser, delta_content
+
+DATA = Path(__file__).parent / "data"
+EXPECTED_CONTENT = (
+    "That's incorrect because ships vanish hull-first over the horizon. "
+    "Même les navigateurs 🌍 le savent.\nThis proves it."
+)
+
+
+def parse(chunks) -> list:
+    parser = SSEParser()
+    events = [event for chunk in chunks for event in parser.feed(chunk)]
+    return events + parser.close()
+
+
+def content_of(events) -> str:
+    parts = []
+    for event in events:
+        if event.data == "[DONE]":
+            break
+        parts.append(delta_content(event.data) or "")
+    return "".join(parts)
+
+
+def random_split(data: bytes, rng: random.Random) -> list:
+    cuts = sorted(rng.sample(range(1, len(data)), rng.randint(1, len(data) // 20)))
+    return [data[start:end] for start, end in zip([0, *cuts], [*cuts, len(data)])]
+
+
+@pytest.mark.parametrize("recording", ["openai_stream.sse", "openrouter_stream.sse"])
+def test_recorded_stream_survives_any_chunking(recording):
+    data = (DATA / recording).read_bytes()
+    expected = parse([data])
+    assert content_of(expected) == EXPECTED_CONTENT
+    assert expected[-1].data == "[DONE]"
+
+    rng = random.Random(recording)
+    for _ in range(200):
+        assert parse(random_split(data, rng)) == expected
+    assert parse([data[i:i + 1] for i in range(len(data))]) == expected
+
+
+def test_parser_fields_and_comments():
+    events = parse([
+        b": keep-alive\n\n",
+        b"event: error\nid: 7\ndata: first\ndata:second\n\n",
+        b"data: {\"choices\": []}\r",
+        b"\n\r\n",
+        b"data: unterminated",
+    ])
+    assert events == [
+        SSEEvent("error", "first\nsecond", "7"),
+        SSEEvent("message", '{"choices": []}', "7"),
+        SSEEvent("message", "unterminated", "7"),
+    ]
+
+
+def test_delta_content():
+    assert delta_content('{"choices":[{"delta":{"content":"hi"}}]}') == "hi"
+    assert delta_content('{"choices":[{"delta":{"role":"assistant"}}]}') is None
+    assert delta_content('{"choices":[]}') is None
+    assert delta_content('[]') is None
+    assert delta_content('"x"') is None
+    assert delta_content('{"choices":["x"]}') is None
+    assert delta_content('{"choices":[{"delta":"x"}]}') is None
+    with pytest.raises(ValueError, match="rate limited"):
+        delta_content('{"error":{"message":"rate limited"}}')
+
+
+def test_invalid_utf8_is_replaced():
+    events = list(SSEParser().feed(b'data: {"choices":[{"delta":{"content":"\xff"}}]}\n\n'))
+    assert delta_content(events[0].data) == "\ufffd"
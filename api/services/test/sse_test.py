@@ -0,0 +1,44 @@
+import json
+from unittest.mock import patch
+
+from api.services.sse import ChunkCoalescer, FlushPolicy, SSEEncoder
+
+
+def push_all(coalescer: ChunkCoalescer, deltas):
+    chunks = [chunk for chunk in map(coalescer.push, deltas) if chunk]
+    rest = coalescer.flush()
+    return chunks + ([rest] if rest else [])
+
+
+def test_coalescer_flushes_at_sentence_boundary():
+    coalescer = ChunkCoalescer(FlushPolicy(max_bytes=100))
+    assert push_all(coalescer, ["Earth ", "is round.", " Ships ", "sink"]) == [
+        "Earth is round.", " Ships sink"]
+
+
+def test_coalescer_flushes_by_size():
+    coalescer = ChunkCoalescer(FlushPolicy(max_bytes=5, sentence_boundary=False))
+    assert push_all(coalescer, ["abc", "def", "g.", "h"]) == ["abcdef", "g.h"]
+
+
+def test_coalescer_flushes_by_interval():
+    coalescer = ChunkCoalescer(
+        FlushPolicy(max_bytes=100, max_interval=1.0, sentence_boundary=False))
+    with patch("api.services.sse.time.monotonic", side_effect=[0.0, 0.5, 1.5, 2.0, 2.1, 2.2]):
+        assert push_all(coalescer, ["a", "b", "c", "d"]) == ["ab", "cd"]
+
+
+def test_encoder_frames():
+    encoder = SSEEncoder('conv-"1"')
+    frame = encoder.chunk("Ships — sink", 3).decode()
+    id_line, data_line, _, _ = frame.split("\n")
+    assert id_line == "id: 3"
+    assert json.loads(data_line[len("data: "):]) == {
+        "conversation_id": 'conv-"1"',
+        "role": "bot",
+        "message": "Ships — sink",
+        "part": 3,
+    }
+    final = encoder.final([{"role": "bot", "message": "x"}]).decode()
+    assert json.loads(final.split("data: ", 1)[1])["part"] == "final"
+    assert encoder.event("end") == b"event: end\n\n"
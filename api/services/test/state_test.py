@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from api.services.response_cache import ResponseCache
+from api.services.state import MemoryBackend, RedisBackend, StateBackend
+
+
+def test_backends_must_implement_counters():
+    class KeyValueOnly(StateBackend):
+        async def get(self, key):
+            return None
+
+        async def set(self, key, value, ttl=None):
+            pass
+
+        async def delete(self, key):
+            pass
+
+    with pytest.raises(TypeError):
+        KeyValueOnly()
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_ttl(monkeypatch):
+    backend = MemoryBackend()
+    now = 1000.0
+    monkeypatch.setattr("api.services.state.time.monotonic", lambda: now)
+    await backend.set("a", b"A", ttl=10)
+    await backend.set("b", b"B")
+    assert await backend.get("a") == b"A"
+    now += 11
+    assert await backend.get("a") is None
+    assert await backend.get("b") == b"B"
+    await backend.delete("b")
+    assert await backend.get("b") is None
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_incr_keeps_first_ttl(monkeypatch):
+    backend = MemoryBackend()
+    now = 1000.0
+    monkeypatch.setattr("api.services.state.time.monotonic", lambda: now)
+    assert await backend.incr("hits", ttl=10) == 1
+    now += 5
+    assert await backend.incr("hits", 2, ttl=10) == 3
+    assert await backend.get("hits") == b"3"
+    now += 6
+    assert await backend.incr("hits", ttl=10) == 1
+
+
+@pytest.mark.asyncio
+async def test_response_cache_shared_between_workers():
+    shared = MemoryBackend()
+    await ResponseCache(shared=shared).set("k", "answer", 2.0)
+    other_worker = ResponseCache(shared=shared)
+    assert await other_worker.get("k") == "answer"
+    assert other_worker.stats()["saved_llm_seconds"] == 2.0
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not os.getenv("REDIS_URL"), reason="REDIS_URL not set")
+async def test_redis_backend():
+    backend = RedisBackend(os.environ["REDIS_URL"], prefix="chatbot-test:")
+    try:
+        await backend.delete("k")
+        await backend.delete("n")
+        await backend.set("k", b"v", ttl=10)
+        assert await backend.get("k") == b"v"
+        assert await backend.incr("n", ttl=10) == 1
+        assert await backend.incr("n", 2, ttl=10) == 3
+        await backend.delete("k")
+        assert await backend.get("k") is None
+    finally:
+        await backend.delete("n")
+        await backend.close()
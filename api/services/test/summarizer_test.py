@@ -0,0 +1,123 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from api.services.llm_service import LLMService
+from api.services.summarizer import ConversationSummarizer
+from db.models import ConversationSummary
+
+
+def summary_llm(*summaries: str) -> Mock:
+    llm = Mock(spec=LLMService)
+    llm.chat_completion.side_effect = [
+        {"choices": [{"message": {"content": summary}}]} for summary in summaries
+    ]
+    return llm
+
+
+async def add_turns(engine, conversation_id, turns: int, first: int = 0) -> str:
+    async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+        service = ChatService(db, history_cache=HistoryCache(), journal=None)
+        for turn in range(first, first + turns):
+            user_message, _ = await service.add_turn(
+                conversation_id, f"user {turn}", f"bot {turn}")
+            conversation_id = user_message.conversation_id
+    return conversation_id
+
+
+async def stored_summary(engine, conversation_id):
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(ConversationSummary.__table__)
+            .where(ConversationSummary.conversation_id == conversation_id))
+        return result.first()
+
+
+@pytest.mark.asyncio
+async def test_refresh_folds_all_but_the_tail(file_engine):
+    conversation_id = await add_turns(file_engine, None, 3)
+    summarizer = ConversationSummarizer(threshold=6, tail=2, engine=file_engine)
+    llm = summary_llm("Earth shape debate so far", "Updated summary")
+    # Opening message plus 5 messages past it
+    assert not await summarizer.refresh(conversation_id, llm)
+
+    await add_turns(file_engine, conversation_id, 1, first=3)
+    assert await summarizer.refresh(conversation_id, llm)
+    row = await stored_summary(file_engine, conversation_id)
+    assert row.summary == "Earth shape debate so far"
+    assert (row.last_seq, row.message_count) == (6, 5)
+    prompt = llm.chat_completion.call_args.kwargs["messages"][1]["content"]
+    assert "User: user 0" not in prompt
+    assert "Debater: bot 0\nUser: user 1" in prompt
+    assert "bot 2" in prompt and "user 3" not in prompt
+
+    await add_turns(file_engine, conversation_id, 1, first=4)
+    assert not await summarizer.refresh(conversation_id, llm)
+    await add_turns(file_engine, conversation_id, 1, first=5)
+    assert await summarizer.refresh(conversation_id, llm)
+    row = await stored_summary(file_engine, conversation_id)
+    assert (row.summary, row.last_seq, row.message_count) == ("Updated summary", 10, 9)
+    prompt = llm.chat_completion.call_args.kwargs["messages"][1]["content"]
+    assert prompt.startswith("Summary so far:\nEarth shape debate so far")
+    assert "bot 2" not in prompt and "User: user 3" in prompt
+    assert "Debater: bot 4" in prompt and "user 5" not in prompt
+    assert summarizer.refreshed == 2
+
+
+@pytest.mark.asyncio
+async def test_format_summarized_messages_sends_opening_and_tail(file_engine):
+    conversation_id = await add_turns(file_engine, None, 4)
+    async with async_sessionmaker(file_engine, expire_on_commit=False)() as db:
+        service = ChatService(db, history_cache=HistoryCache(), journal=None)
+        summary, history = await service.format_summarized_messages(conversation_id)
+        assert summary is None
+        assert len(history) == 8
+
+        summarizer = ConversationSummarizer(threshold=6, tail=2, engine=file_engine)
+        assert await summarizer.refresh(conversation_id, summary_llm("The story so far"))
+        summary, history = await service.format_summarized_messages(conversation_id)
+    assert summary == "The story so far"
+    assert history == [
+        {"role": "user", "content": "user 0"},
+        {"role": "user", "content": "user 3"},
+        {"role": "assistant", "content": "bot 3"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_schedule_never_waits_and_skips_queued(file_engine):
+    conversation_id = await add_turns(file_engine, None, 4)
+    summarizer = ConversationSummarizer(threshold=6, tail=2, max_queued=1)
+    llm = summary_llm("Summary")
+    assert not summarizer.schedule(conversation_id, 5, llm)
+    assert summarizer.schedule(conversation_id, 7, llm)
+    assert not summarizer.schedule(conversation_id, 8, llm)
+    assert not summarizer.schedule("other", 8, llm)
+    assert summarizer.stats()["dropped"] == 1
+
+    summarizer.start(file_engine)
+    for _ in range(100):
+        if summarizer.refreshed:
+            break
+        await asyncio.sleep(0.01)
+    await summarizer.stop()
+    assert summarizer.stats() == {"queued": 0, "refreshed": 1, "dropped": 1, "failed": 0}
+    assert (await stored_summary(file_engine, conversation_id)).summary == "Summary"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_store_one_summary(file_engine):
+    conversation_id = await add_turns(file_engine, None, 4)
+    summarizers = [ConversationSummarizer(threshold=6, tail=2, engine=file_engine) for _ in range(2)]
+    stored = await asyncio.gather(*(
+        summarizer.refresh(conversation_id, summary_llm(f"Summary {i}"))
+        for i, summarizer in enumerate(summarizers)
+    ))
+    assert sorted(stored) == [False, True]
+    row = await stored_summary(file_engine, conversation_id)
+    assert row.summary == f"Summary {stored.index(True)}"
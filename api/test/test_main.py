@@ -1,3 +1,12 @@
+import json
+
+import pytest
+
+from api.services.chat_service import drain_pending_writes
+from api.services.overload import CircuitOpen, Overloaded
+from api.services.summarizer import ConversationSummarizer
+from bench.harness import chat_client
+from bench.stub_llm import DEFAULT_RESPONSE, StubLLMServer
 
 
 def test_root(client):
@@ -31,3 +40,221 @@ def test_chat_with_invalid_conversation_id(client):
 
     assert response.status_code == 404
     assert "No conversation nonexistent-id found" in response.json()["detail"]
+
+
+def test_stats(client):
+    response = client.get("/stats")
+    assert response.status_code == 200
+    assert "reuse_rate" in response.json()["http_pool"]
+
+
+def test_continue_conversation(client, mock_llm):
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    response = client.post(
+        "/chat/",
+        json={"message": "second", "conversation_id": conversation_id}
+    )
+    assert response.status_code == 200
+    assert [m["message"] for m in response.json()["message"]] == [
+        "Mocked response", "second", "Mocked response", "first"]
+    history = mock_llm.chat_completion.call_args.kwargs["messages"]
+    assert [m["content"] for m in history[1:]] == [
+        "first", "Mocked response", "second"]
+
+
+def test_long_conversation_prompt_uses_rolling_summary(client, db_session, mock_llm, monkeypatch):
+    summarizer = ConversationSummarizer(threshold=4, tail=2, engine=db_session.bind)
+    monkeypatch.setattr("api.main.conversation_summarizer", summarizer)
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    for message in ("second", "third"):
+        client.post("/chat/", json={"message": message, "conversation_id": conversation_id})
+    assert summarizer.stats()["queued"] == 1
+    assert client.portal.call(summarizer.refresh, conversation_id, mock_llm)
+
+    client.post("/chat/", json={"message": "fourth", "conversation_id": conversation_id})
+    history = mock_llm.chat_completion.call_args.kwargs["messages"]
+    assert [m["content"] for m in history[1:]] == [
+        "first", "Summary of earlier turns:\nMocked response",
+        "third", "Mocked response", "fourth"]
+
+
+def test_conversation_messages_keyset_pagination(client):
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    client.post("/chat/", json={"message": "second", "conversation_id": conversation_id})
+
+    url = f"/conversations/{conversation_id}/messages"
+    page = client.get(url, params={"limit": 3}).json()
+    assert [m["message"] for m in page["message"]] == [
+        "Mocked response", "second", "Mocked response"]
+    assert page["next_before"] == 2
+
+    page = client.get(url, params={"limit": 3, "before": page["next_before"]}).json()
+    assert [m["message"] for m in page["message"]] == ["first"]
+    assert page["next_before"] is None
+
+
+def test_conversation_messages_unknown_conversation(client):
+    response = client.get("/conversations/nonexistent-id/messages")
+    assert response.status_code == 404
+
+
+def test_export_and_import_conversations(client):
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    client.post("/chat/", json={"message": "second", "conversation_id": conversation_id})
+
+    response = client.get("/conversations/export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [(line["seq"], line["content"]) for line in lines] == [
+        (1, "first"), (2, "Mocked response"), (3, "second"), (4, "Mocked response")]
+    gzipped = client.get("/conversations/export", params={"gzip": True})
+    assert gzipped.headers["content-encoding"] == "gzip"
+    assert gzipped.text == response.text
+
+    response = client.post("/conversations/import", content=response.content)
+    assert response.json() == {"conversations": 0, "messages": 0, "skipped": 4}
+    copy = "\n".join(json.dumps({
+        **line,
+        "id": line["id"] + "-copy",
+        "conversation_id": "imported",
+    }) for line in lines)
+    response = client.post("/conversations/import", content=copy)
+    assert response.json() == {"conversations": 1, "messages": 4, "skipped": 0}
+    page = client.get("/conversations/imported/messages").json()
+    assert [m["message"] for m in page["message"]] == [
+        "Mocked response", "second", "Mocked response", "first"]
+
+
+def test_conversation_archive_not_found(client):
+    response = client.get("/conversations/nonexistent-id/archive")
+    assert response.status_code == 404
+
+
+def test_import_rejects_invalid_lines(client):
+    response = client.post("/conversations/import", content=b"{not json}\n")
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("overrides", [
+    {"timestamp": 5},
+    {"timestamp": "yesterday"},
+    {"seq": "x"},
+    {"seq": True},
+    {"role": "admin"},
+    {"content": None},
+    {"id": 7},
+])
+def test_import_rejects_mistyped_lines(client, overrides):
+    line = {
+        "conversation_id": "typed", "id": "typed-1", "seq": 1,
+        "role": "user", "content": "Hello", "timestamp": "2025-01-01T00:00:00",
+    }
+    content = b"\n".join([b'{"conversation_id": "typed"}', json.dumps({**line, **overrides}).encode()])
+    response = client.post("/conversations/import", content=content)
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid export line: line 2:")
+
+
+@pytest.mark.parametrize("line", [b"[1, 2]", b'"x"', b"3", b'{"conversation_id": 1}'])
+def test_import_rejects_lines_that_are_not_conversation_objects(client, line):
+    response = client.post("/conversations/import", content=line)
+    assert response.status_code == 400
+
+
+def test_import_rejects_rows_conflicting_with_stored_ones(client):
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    line = json.dumps({
+        "conversation_id": conversation_id, "id": "new-id", "seq": 1,
+        "role": "user", "content": "Taking seq 1", "timestamp": "2025-01-01T00:00:00",
+    })
+    response = client.post("/conversations/import", content=line)
+    assert response.status_code == 400
+    assert "conflicts with stored rows" in response.json()["detail"]
+
+
+def test_chat_turn_query_count(client, query_counter):
+    conversation_id = client.post(
+        "/chat/", json={"message": "first"}).json()["conversation_id"]
+    query_counter.clear()
+    client.post("/chat/", json={"message": "second", "conversation_id": conversation_id})
+    # existence check, next seq, turn insert, response page
+    assert len(query_counter) == 4, query_counter
+
+
+def test_chat_stream_final_frame_and_background_persistence(client, mock_llm):
+    async def stream(messages):
+        for content in ("That is wrong. ", "Ships prove it."):
+            yield content
+
+    mock_llm.stream_chat_completion.side_effect = stream
+    response = client.post("/chat/stream", json={"message": "Earth is flat"})
+    assert response.status_code == 200
+    frames = [
+        json.loads(line[len("data: "):])
+        for line in response.text.splitlines() if line.startswith("data: ")
+    ]
+    final = frames[-1]
+    assert final["part"] == "final"
+    assert final["message"] == [
+        {"role": "bot", "message": "That is wrong. Ships prove it."},
+        {"role": "user", "message": "Earth is flat"},
+    ]
+    assert all(frame["conversation_id"] == final["conversation_id"] for frame in frames)
+
+    page = client.get(f"/conversations/{final['conversation_id']}/messages").json()
+    assert page["message"] == final["message"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_end_to_end_with_stub_llm(async_engine):
+    stub = StubLLMServer(latency=0.01, tokens_per_second=2000, chunk_tokens=3)
+    base_url = await stub.start()
+    try:
+        async with chat_client(async_engine, base_url) as client:
+            response = await client.post("/chat/stream", json={"message": "Earth is flat"})
+            await drain_pending_writes()
+            frames = [
+                json.loads(line[len("data: "):])
+                for line in response.text.splitlines() if line.startswith("data: ")
+            ]
+            page = await client.get(
+                f"/conversations/{frames[-1]['conversation_id']}/messages")
+    finally:
+        await stub.stop()
+
+    assert response.status_code == 200
+    assert stub.requests == 1
+    chunks = [frame["message"] for frame in frames if frame["part"] != "final"]
+    assert "".join(chunks) == DEFAULT_RESPONSE + " "
+    assert [frame["part"] for frame in frames[:-1]] == list(range(1, len(chunks) + 1))
+    assert page.json()["message"] == frames[-1]["message"]
+
+
+def test_overloaded_llm_returns_503_with_retry_after(client, mock_llm):
+    mock_llm.chat_completion.side_effect = Overloaded("LLM request queue is full", 2.5)
+    response = client.post("/chat/", json={"message": "Earth is flat"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+
+def test_stream_is_rejected_before_starting_when_overloaded(client, mock_llm):
+    mock_llm.admit.side_effect = CircuitOpen("LLM API circuit is open", 10)
+    response = client.post("/chat/stream", json={"message": "Earth is flat"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "10"
+    mock_llm.stream_chat_completion.assert_not_called()
+
+
+def test_metrics(client):
+    client.post("/chat/", json={"message": "Earth is flat"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'chat_db_seconds_count{method="add_turn"}' in response.text
+    assert 'debate_persona_seconds_count{kind="completion"}' in response.text
+    assert "http_requests_in_flight 1" in response.text
@@ -0,0 +1,36 @@
+"""
+Batch runner throughput against the stub llm, no api key required
+
+    python -m bench.batch_debates debates.jsonl results.jsonl --concurrency 64
+    python -m bench.batch_debates debates.jsonl results.jsonl --stub-tokens-per-second 40
+
+Starts a local stub provider and runs api.personas.batch_runner against it
+with the same options, printing its JSON report. Results are appended and
+resumed as in a real run, remove results.jsonl to measure again
+"""
+import argparse
+import asyncio
+import sys
+
+from api.personas import batch_runner
+from api.services.sse import dumps
+from bench.stub_llm import StubLLMServer
+
+
+async def main(args):
+    stub = StubLLMServer(latency=args.stub_ttft, tokens_per_second=args.stub_tokens_per_second)
+    args.base_url = await stub.start()
+    try:
+        return await batch_runner.main(args)
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    batch_runner.add_arguments(parser)
+    parser.add_argument("--stub-ttft", type=float, default=0.05)
+    parser.add_argument("--stub-tokens-per-second", type=float, default=None)
+    report = asyncio.run(main(parser.parse_args()))
+    sys.stdout.buffer.write(dumps(report) + b"\n")
@@ -0,0 +1,124 @@
+"""
+Rows per second of the NDJSON conversation export and import, plain and
+gzip
+
+    python -m bench.bulk_transfer --rows 1000000 --messages-per-conversation 20
+    python -m bench.bulk_transfer --rows 1000000 --heap
+
+Seeds a fresh SQLite file with --rows messages, exports them to a file with
+the streaming export and imports that file into a second database in
+--batch-size chunks. With --heap each step also reports its peak Python heap
+(tracemalloc, slower), which stays flat as --rows grows when neither side
+holds the dataset in memory. The process RSS does grow, with the SQLite page
+cache and memory-mapped database pages
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+
+from api.services.bulk_transfer import export_ndjson, import_ndjson
+from db.database import Base, create_engine
+from db.models import Conversation, Message
+
+READ_SIZE = 64 * 1024
+
+
+def peak_rss_mb() -> float:
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def heap_peak_mb() -> str:
+    if not tracemalloc.is_tracing():
+        return "-"
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.reset_peak()
+    return f"{peak:.1f}"
+
+
+async def fresh_engine(directory: str, name: str):
+    engine = create_engine(f"sqlite+aiosqlite:///{os.path.join(directory, name)}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return engine
+
+
+async def seed(engine, rows: int, per_conversation: int):
+    started = datetime(2024, 1, 1)
+    batch = []
+    for n in range(rows):
+        conversation, seq = divmod(n, per_conversation)
+        if seq == 0:
+            async with engine.begin() as conn:
+                if batch:
+                    await conn.execute(insert(Message), batch)
+                await conn.execute(insert(Conversation), [{"id": f"conversation-{conversation}"}])
+            batch = []
+        batch.append({
+            "id": f"message-{n}",
+            "conversation_id": f"conversation-{conversation}",
+            "content": f"Counter argument {n}: ships disappear hull-first over the horizon.",
+            "role": "bot" if seq % 2 else "user",
+            "timestamp": started + timedelta(seconds=n),
+            "seq": seq + 1,
+        })
+    async with engine.begin() as conn:
+        await conn.execute(insert(Message), batch)
+
+
+async def read_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            yield chunk
+            await asyncio.sleep(0)
+
+
+async def main(args):
+    directory = tempfile.mkdtemp()
+    source = await fresh_engine(directory, "source.db")
+    await seed(source, args.rows, args.messages_per_conversation)
+    print(f"{args.rows} messages, {args.messages_per_conversation} per conversation, "
+          f"batch {args.batch_size}, peak rss after seeding {peak_rss_mb():.0f} MB")
+    print(f"{'step':>14} {'rows/s':>10} {'MB':>8} {'heap peak MB':>13} {'peak rss MB':>12}")
+    if args.heap:
+        tracemalloc.start()
+
+    for gzip in (False, True):
+        path = os.path.join(directory, "export.ndjson" + (".gz" if gzip else ""))
+        started = time.perf_counter()
+        with open(path, "wb") as f:
+            async for chunk in export_ndjson(source, gzip=gzip, batch_size=args.batch_size):
+                f.write(chunk)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path) / 1e6
+        name = "export gzip" if gzip else "export"
+        print(f"{name:>14} {args.rows / elapsed:>10.0f} {size:>8.1f} "
+              f"{heap_peak_mb():>13} {peak_rss_mb():>12.0f}")
+
+        target = await fresh_engine(directory, f"target-{int(gzip)}.db")
+        started = time.perf_counter()
+        counts = await import_ndjson(
+            target, read_file(path), gzip=gzip, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - started
+        assert counts["messages"] == args.rows, counts
+        name = "import gzip" if gzip else "import"
+        print(f"{name:>14} {args.rows / elapsed:>10.0f} {size:>8.1f} "
+              f"{heap_peak_mb():>13} {peak_rss_mb():>12.0f}")
+        await target.dispose()
+    await source.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--messages-per-conversation", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--heap", action="store_true", help="trace peak python heap per step")
+    asyncio.run(main(parser.parse_args()))
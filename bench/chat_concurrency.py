@@ -0,0 +1,60 @@
+"""
+Measures /chat/ throughput with N concurrent clients against the local stub LLM
+
+    python -m bench.chat_concurrency --latency 0.2 --requests 64
+
+With a non-blocking LLM client throughput should scale roughly linearly with
+concurrency until the database becomes the bottleneck
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from bench.harness import chat_client
+from bench.stub_llm import StubLLMServer
+from db.database import create_engine
+
+
+async def run_level(client: httpx.AsyncClient, concurrency: int, total: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            # Distinct openers, identical ones would share one upstream call
+            response = await client.post("/chat/", json={"message": f"Earth is flat {i}"})
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def main(latency: float, total: int, levels: list):
+    stub = StubLLMServer(latency=latency)
+    base_url = await stub.start()
+    engine = create_engine(
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+    async with chat_client(engine, base_url) as client:
+        print(f"stub latency {latency * 1000:.0f} ms, {total} requests per level")
+        print(f"{'concurrency':>12} {'req/s':>10}")
+        for concurrency in levels:
+            throughput = await run_level(client, concurrency, total)
+            print(f"{concurrency:>12} {throughput:>10.1f}")
+
+    await engine.dispose()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--levels", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.requests, args.levels))
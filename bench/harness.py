@@ -0,0 +1,78 @@
+"""
+Shared setup for the benchmarks: the app wired to a given database engine and
+a stub LLM, reachable in-process or through a real uvicorn server
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import socket
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+import uvicorn
+
+from api.main import app
+from api.services import http_client
+from api.services.llm_service import LLMService, get_llm
+from db.database import Base, get_db
+
+
+@asynccontextmanager
+async def app_overrides(engine: AsyncEngine, llm_base_url: str):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_llm] = lambda: LLMService(
+        api_key="stub",
+        base_url=llm_base_url,
+        model="stub",
+        temperature=0.1,
+        max_tokens=500,
+    )
+    try:
+        yield app
+    finally:
+        app.dependency_overrides.clear()
+        await http_client.close_session()
+
+
+@asynccontextmanager
+async def chat_client(engine: AsyncEngine, llm_base_url: str):
+    """
+    In-process client for the app. The ASGI transport buffers whole responses,
+    use served_client to measure streaming latencies
+    """
+    async with app_overrides(engine, llm_base_url):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            yield client
+
+
+@asynccontextmanager
+async def served_client(engine: AsyncEngine, llm_base_url: str):
+    """
+    Client talking HTTP to the app served by uvicorn on a free local port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    async with app_overrides(engine, llm_base_url):
+        server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+        serving = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{port}", timeout=60
+            ) as client:
+                yield client
+        finally:
+            server.should_exit = True
+            await serving
@@ -0,0 +1,93 @@
+"""
+Turns per second through ChatService.add_turn with commits on the request
+path vs the write-behind message journal at several batch sizes
+
+    python -m bench.journal_batch --debates 64 --turns 20 --batch-sizes 1 10 100 500
+    python -m bench.journal_batch --synchronous FULL
+
+Each debate runs its turns one after the other (read the history, wait
+--llm-ms for the answer, write the turn), the debates run concurrently against a fresh SQLite file with the
+app's pragmas. Throughput counts until the journal's last batch is committed
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from api.services.message_journal import MessageJournal
+from db.database import SQLITE_PRAGMAS, Base, create_engine
+
+
+async def measure(name: str, args, batch_size=None):
+    engine = create_engine(
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}",
+        sqlite_pragmas={**SQLITE_PRAGMAS, "synchronous": args.synchronous},
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    commits = 0
+
+    def on_commit(conn):
+        nonlocal commits
+        commits += 1
+
+    event.listen(engine.sync_engine, "commit", on_commit)
+    journal = None
+    if batch_size is not None:
+        journal = MessageJournal(
+            path=os.path.join(tempfile.mkdtemp(), "messages.journal"),
+            batch_size=batch_size,
+            flush_interval=args.interval_ms / 1000,
+        )
+        await journal.start(engine)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def debate(i: int):
+        async with session_factory() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=journal)
+            conversation_id = None
+            for turn in range(args.turns):
+                if conversation_id is not None:
+                    await service.format_messages_for_llm(conversation_id)
+                await asyncio.sleep(args.llm_ms / 1000)
+                user_message, _ = await service.add_turn(
+                    conversation_id, f"Claim {i}.{turn}", "It is not")
+                conversation_id = user_message.conversation_id
+
+    commits_before = commits
+    started = time.perf_counter()
+    await asyncio.gather(*(debate(i) for i in range(args.debates)))
+    if journal is not None:
+        await journal.stop()
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    turns = args.debates * args.turns
+    print(f"{name:>14} {turns / elapsed:>10.1f} {(commits - commits_before) / turns:>13.3f}")
+
+
+async def main(args):
+    print(f"{args.debates} debates x {args.turns} turns, llm {args.llm_ms:.0f} ms, "
+          f"synchronous={args.synchronous}, flush every {args.interval_ms:.0f} ms")
+    print(f"{'path':>14} {'turns/s':>10} {'commits/turn':>13}")
+    await measure("add_turn", args)
+    for batch_size in args.batch_sizes:
+        await measure(f"journal {batch_size}", args, batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--debates", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--interval-ms", type=float, default=10)
+    parser.add_argument("--llm-ms", type=float, default=5, help="simulated llm time per turn")
+    parser.add_argument("--synchronous", default=SQLITE_PRAGMAS["synchronous"],
+                        help="SQLite synchronous pragma, FULL syncs every commit")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,204 @@
+"""
+Open-loop load generator for /chat/ and /chat/stream
+
+Starts requests at a target rate whatever the response times, so queueing
+shows up as latency instead of a lower request rate, and prints a JSON
+report for regression tracking: latency and time-to-first-chunk percentiles,
+throughput, errors, and, when the app runs in-process, database lag (round
+trip of a trivial query through the app's pool) and event-loop lag
+
+    python -m bench.loadgen --rps 20 --duration 30 --stream-ratio 0.5
+    python -m bench.loadgen --url http://127.0.0.1:8000 --rps 50 --output load.json
+
+Without --url the app is served by uvicorn in this process against the stub
+LLM (or --llm-url, e.g. a `python -m bench.stub_llm` process) and a
+temporary SQLite database. Client, app and stub then share one event loop,
+run them as separate processes to keep the client's work out of the lag
+"""
+import argparse
+import asyncio
+from contextlib import AsyncExitStack
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from bench.harness import served_client
+from bench.stub_llm import StubLLMServer
+from db.database import create_engine
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """
+    p50/p95/p99 and max in milliseconds, None without samples
+    """
+    if not values:
+        return None
+    if len(values) == 1:
+        values = values * 2
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(quantiles[49] * 1000, 2),
+        "p95": round(quantiles[94] * 1000, 2),
+        "p99": round(quantiles[98] * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {"chat": [], "stream": []}
+        self.ttft: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.db_lag: List[float] = []
+        self.loop_lag: List[float] = []
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def chat_request(client: httpx.AsyncClient, message: str, results: Results):
+    started = time.perf_counter()
+    response = await client.post("/chat/", json={"message": message})
+    if response.status_code != 200:
+        results.error(str(response.status_code))
+        return
+    results.latencies["chat"].append(time.perf_counter() - started)
+
+
+async def stream_request(client: httpx.AsyncClient, message: str, results: Results):
+    started = time.perf_counter()
+    first_chunk = None
+    event = None
+    async with client.stream("POST", "/chat/stream", json={"message": message}) as response:
+        if response.status_code != 200:
+            results.error(str(response.status_code))
+            return
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:") and first_chunk is None and event != "error":
+                first_chunk = time.perf_counter() - started
+    if event == "error":
+        results.error("stream_error")
+        return
+    results.latencies["stream"].append(time.perf_counter() - started)
+    if first_chunk is not None:
+        results.ttft.append(first_chunk)
+
+
+async def sample_loop_lag(results: Results, interval: float = 0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        results.loop_lag.append(time.perf_counter() - started - interval)
+
+
+async def sample_db_lag(engine: AsyncEngine, results: Results, interval: float = 0.1):
+    while True:
+        started = time.perf_counter()
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        results.db_lag.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def run(args) -> Dict:
+    results = Results()
+    engine = None
+    async with AsyncExitStack() as stack:
+        if args.url:
+            client = await stack.enter_async_context(
+                httpx.AsyncClient(base_url=args.url, timeout=args.timeout))
+        else:
+            llm_url = args.llm_url
+            if llm_url is None:
+                stub = StubLLMServer(
+                    latency=args.stub_ttft,
+                    tokens_per_second=args.stub_tokens_per_second,
+                    response_tokens=args.stub_response_tokens,
+                )
+                llm_url = await stub.start()
+                stack.push_async_callback(stub.stop)
+            engine = create_engine(
+                f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'loadgen.db')}")
+            stack.push_async_callback(engine.dispose)
+            client = await stack.enter_async_context(served_client(engine, llm_url))
+            client.timeout = httpx.Timeout(args.timeout)
+
+        samplers = [asyncio.create_task(sample_loop_lag(results))]
+        if engine is not None:
+            samplers.append(asyncio.create_task(sample_db_lag(engine, results)))
+
+        async def one(i: int):
+            message = f"Argue that claim {i} is true"
+            request = (
+                stream_request if random.random() < args.stream_ratio else chat_request)
+            try:
+                await request(client, message, results)
+            except httpx.HTTPError as e:
+                results.error(type(e).__name__)
+
+        requests = []
+        started = next_at = time.perf_counter()
+        total = int(args.rps * args.duration)
+        for i in range(total):
+            requests.append(asyncio.create_task(one(i)))
+            # Fixed or Poisson arrivals at the target rate
+            next_at += random.expovariate(args.rps) if args.poisson else 1 / args.rps
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        await asyncio.gather(*requests)
+        elapsed = time.perf_counter() - started
+        for sampler in samplers:
+            sampler.cancel()
+
+    completed = sum(len(latencies) for latencies in results.latencies.values())
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "rps": args.rps,
+            "duration": args.duration,
+            "stream_ratio": args.stream_ratio,
+        },
+        "requests": total,
+        "completed": completed,
+        "errors": results.errors,
+        "throughput_rps": round(completed / elapsed, 2),
+        "latency_ms": {
+            name: percentiles(latencies)
+            for name, latencies in results.latencies.items()
+        },
+        "ttft_ms": percentiles(results.ttft),
+        "db_lag_ms": percentiles(results.db_lag),
+        "event_loop_lag_ms": percentiles(results.loop_lag),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="running app to load, default serves it in-process")
+    parser.add_argument("--llm-url", help="llm base url for the in-process app")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--stream-ratio", type=float, default=0.5,
+                        help="share of requests sent to /chat/stream")
+    parser.add_argument("--poisson", action="store_true",
+                        help="exponential inter-arrival times instead of a fixed rate")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--stub-ttft", type=float, default=0.2)
+    parser.add_argument("--stub-tokens-per-second", type=float, default=100)
+    parser.add_argument("--stub-response-tokens", type=int, default=40)
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
@@ -0,0 +1,110 @@
+"""
+Message retrieval latency on a large messages table, with and without the
+(conversation_id, timestamp, seq) index
+
+    python -m bench.message_pagination --messages 1000000
+
+Compares the latest-page query used by /chat/, a deep OFFSET page and the
+equivalent keyset page used by GET /conversations/{id}/messages?before=
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from db.database import Base
+from db.models import Conversation, Message
+
+
+def populate(path: str, total: int, per_conversation: int) -> list:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    conversation_ids = [
+        str(uuid.uuid4()) for _ in range(total // per_conversation)]
+    start = datetime(2025, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(Conversation), [{"id": c} for c in conversation_ids])
+        batch = []
+        # Interleave conversations so a conversation's rows are spread over
+        # the whole table, as they are with concurrent users
+        for seq in range(1, per_conversation + 1):
+            for i, conversation_id in enumerate(conversation_ids):
+                batch.append({
+                    "id": str(uuid.uuid4()),
+                    "conversation_id": conversation_id,
+                    "content": "Globe logic fails basic observation.",
+                    "role": "user" if seq % 2 else "bot",
+                    "timestamp": start + timedelta(seconds=seq, microseconds=i),
+                    "seq": seq,
+                })
+                if len(batch) == 50_000:
+                    conn.execute(insert(Message), batch)
+                    batch = []
+        if batch:
+            conn.execute(insert(Message), batch)
+    engine.dispose()
+    return conversation_ids
+
+
+async def time_queries(path: str, conversation_ids: list, samples: int, depth: int):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    picks = random.sample(conversation_ids, min(samples, len(conversation_ids)))
+    results = {}
+    async with session_factory() as session:
+        service = ChatService(session, history_cache=HistoryCache(maxsize=0))
+        for name, query in (
+            ("latest page", lambda c: service.get_messages(c)),
+            (f"offset {depth}", lambda c: service.get_messages(c, skip=depth)),
+            (f"keyset before {depth}", lambda c: service.get_messages_before(c, before=depth)),
+            ("full history", lambda c: service.format_messages_for_llm(c)),
+        ):
+            await query(picks[0])  # warm up the page cache
+            started = time.perf_counter()
+            for conversation_id in picks:
+                await query(conversation_id)
+            results[name] = (time.perf_counter() - started) / len(picks) * 1000
+    await engine.dispose()
+    return results
+
+
+async def main(total: int, per_conversation: int, samples: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    started = time.perf_counter()
+    conversation_ids = populate(path, total, per_conversation)
+    print(f"{total} messages in {len(conversation_ids)} conversations, "
+          f"populated in {time.perf_counter() - started:.1f}s")
+
+    depth = per_conversation // 2
+    indexed = await time_queries(path, conversation_ids, samples, depth)
+
+    # Rebuild the table without any secondary index, as before this change
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE messages_plain AS SELECT * FROM messages"))
+        conn.execute(text("DROP TABLE messages"))
+        conn.execute(text("ALTER TABLE messages_plain RENAME TO messages"))
+    engine.dispose()
+    unindexed = await time_queries(path, conversation_ids, samples, depth)
+
+    print(f"{'query':>22} {'no index ms':>12} {'indexed ms':>12}")
+    for name in indexed:
+        print(f"{name:>22} {unindexed[name]:>12.2f} {indexed[name]:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--per-conversation", type=int, default=100)
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.per_conversation, args.samples))
@@ -0,0 +1,64 @@
+"""
+Time-to-first-token over a multi-turn debate with and without prompt-cache
+hints, against a stub that serves cached prefixes faster
+
+    python -m bench.prompt_cache --latency 0.4 --cached-latency 0.1 --turns 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from api.personas.debate_persona import DebatePersona
+from api.services import http_client
+from api.services.llm_service import LLMService
+from bench.stub_llm import StubLLMServer
+
+
+async def debate_ttft(llm: LLMService, hints: bool, debates: int, turns: int) -> list:
+    persona = DebatePersona(llm, prompt_cache_hints=hints)
+    ttfts = []
+    for debate in range(debates):
+        history = [{"role": "user", "content": f"Argue that claim {debate} is true"}]
+        for turn in range(turns):
+            messages = persona.format_debate_messages(history)
+            started = time.perf_counter()
+            response = ""
+            async for content in llm.stream_chat_completion(messages=messages):
+                if not response:
+                    ttfts.append(time.perf_counter() - started)
+                response += content
+            history += [
+                {"role": "assistant", "content": response},
+                {"role": "user", "content": f"Rebuttal {turn}"},
+            ]
+    return ttfts
+
+
+async def main(latency: float, cached_latency: float, debates: int, turns: int):
+    print(f"{debates} debates of {turns} turns, stub ttft {latency * 1000:.0f} ms, "
+          f"{cached_latency * 1000:.0f} ms on prefix-cache hits")
+    print(f"{'hints':>6} {'mean ttft ms':>13} {'p95 ttft ms':>12} {'cache hits':>11}")
+    for hints in (False, True):
+        stub = StubLLMServer(latency=latency, prefix_cache_latency=cached_latency)
+        base_url = await stub.start()
+        llm = LLMService(
+            api_key="stub", base_url=base_url, model="stub",
+            temperature=0.1, max_tokens=500,
+        )
+        ttfts = await debate_ttft(llm, hints, debates, turns)
+        print(f"{str(hints):>6} {statistics.mean(ttfts) * 1000:>13.1f} "
+              f"{statistics.quantiles(ttfts, n=20)[18] * 1000:>12.1f} "
+              f"{stub.prefix_cache_hits:>11}")
+        await stub.stop()
+    await http_client.close_session()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.4)
+    parser.add_argument("--cached-latency", type=float, default=0.1)
+    parser.add_argument("--debates", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.cached_latency, args.debates, args.turns))
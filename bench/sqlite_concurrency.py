@@ -0,0 +1,71 @@
+"""
+Concurrent write throughput on a SQLite file with default and tuned pragmas
+
+    python -m bench.sqlite_concurrency --writers 1 4 16 --turns 50
+
+Each writer runs its own session and persists turns with ChatService.add_turn
+while reading the thread back, as concurrent /chat/ requests do
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from db.database import SQLITE_PRAGMAS, Base, create_engine
+
+
+async def writer(session_factory, turns: int, errors: list):
+    async with session_factory() as session:
+        service = ChatService(session, history_cache=HistoryCache(maxsize=0))
+        conversation_id = None
+        for _ in range(turns):
+            try:
+                user_message, _ = await service.add_turn(
+                    conversation_id, "Earth is flat", "It is not")
+                conversation_id = user_message.conversation_id
+                await service.get_messages(conversation_id)
+            except OperationalError as e:
+                errors.append(str(e))
+                await session.rollback()
+
+
+async def measure(pragmas: dict, writers: int, turns: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite+aiosqlite:///{path}", pragmas)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    errors = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        writer(session_factory, turns, errors) for _ in range(writers)))
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+    completed = writers * turns - len(errors)
+    return completed / elapsed, len(errors)
+
+
+async def main(writer_levels: list, turns: int):
+    print(f"{turns} turns per writer")
+    print(f"{'writers':>8} {'default turns/s':>16} {'errors':>7} "
+          f"{'tuned turns/s':>14} {'errors':>7}")
+    for writers in writer_levels:
+        default_rate, default_errors = await measure({}, writers, turns)
+        tuned_rate, tuned_errors = await measure(SQLITE_PRAGMAS, writers, turns)
+        print(f"{writers:>8} {default_rate:>16.1f} {default_errors:>7} "
+              f"{tuned_rate:>14.1f} {tuned_errors:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.writers, args.turns))
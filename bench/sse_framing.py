@@ -0,0 +1,81 @@
+"""
+Microbenchmark of the per-token streaming path on one core: coalescing deltas
+into chunks and framing them as SSE, the previous string-concatenation and
+json.dumps path against ChunkCoalescer + SSEEncoder
+
+    python -m bench.sse_framing --tokens 200000
+"""
+import argparse
+import json
+import random
+import time
+
+from api.services.sse import ChunkCoalescer, FlushPolicy, SSEEncoder
+
+WORDS = ("globe", "logic", "fails", "basic", "observation", "horizons", "are",
+         "flat", "and", "gravity", "is", "density", "theory")
+
+
+def make_deltas(tokens: int) -> list:
+    rng = random.Random(0)
+    deltas = []
+    for i in range(tokens):
+        word = " " + rng.choice(WORDS)
+        deltas.append(word + "." if i % 25 == 24 else word)
+    return deltas
+
+
+def previous_path(deltas: list, conversation_id: str) -> int:
+    frames = 0
+    buffer = ""
+    chunk_id = 1
+    for content in deltas:
+        buffer += content
+        if any(punct in content for punct in ".!?\n") or len(buffer) > 100:
+            chunk_data = {
+                "conversation_id": conversation_id,
+                "message": buffer,
+                "role": "bot",
+                "part": chunk_id,
+            }
+            frame = f"data: {json.dumps(chunk_data)}\n\n"
+            frames += 1
+            chunk_id += 1
+            buffer = ""
+    return frames
+
+
+def current_path(deltas: list, conversation_id: str) -> int:
+    frames = 0
+    coalescer = ChunkCoalescer(FlushPolicy())
+    encoder = SSEEncoder(conversation_id)
+    part = 1
+    for content in deltas:
+        chunk = coalescer.push(content)
+        if chunk:
+            frame = encoder.chunk(chunk, part)
+            frames += 1
+            part += 1
+    return frames
+
+
+def main(tokens: int, rounds: int):
+    deltas = make_deltas(tokens)
+    conversation_id = "745ac140-5128-40ee-a042-cc05b0d5ce97"
+    print(f"{tokens} deltas, best of {rounds} rounds")
+    print(f"{'path':>10} {'deltas/s':>12} {'chunks/s':>12}")
+    for name, path in (("previous", previous_path), ("current", current_path)):
+        best = float("inf")
+        for _ in range(rounds):
+            started = time.perf_counter()
+            frames = path(deltas, conversation_id)
+            best = min(best, time.perf_counter() - started)
+        print(f"{name:>10} {tokens / best:>12.0f} {frames / best:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=200_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    main(args.tokens, args.rounds)
@@ -0,0 +1,93 @@
+"""
+Upstream stream parsing throughput: the previous line-by-line json.loads of
+full chunk dicts against SSEParser + delta_content, on a recorded-format
+stream fed in network-sized reads
+
+    python -m bench.sse_parsing --tokens 100000
+"""
+import argparse
+import json
+import time
+
+from api.services.sse_parser import SSEParser, delta_content
+
+
+def make_stream(tokens: int) -> bytes:
+    chunks = []
+    for i in range(tokens):
+        chunk = {
+            "id": "gen-1750000000-abc",
+            "model": "deepseek/deepseek-r1-0528:free",
+            "object": "chat.completion.chunk",
+            "created": 1750000000,
+            "choices": [{
+                "index": 0,
+                "delta": {"content": f" token{i % 97}"},
+                "finish_reason": None,
+            }],
+        }
+        chunks.append(f"data: {json.dumps(chunk)}\n\n")
+        if i % 500 == 0:
+            chunks.append(": OPENROUTER PROCESSING\n\n")
+    chunks.append("data: [DONE]\n\n")
+    return "".join(chunks).encode()
+
+
+def reads(stream: bytes, size: int) -> list:
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def previous_path(stream: bytes, read_size: int) -> int:
+    tokens = 0
+    # aiohttp's line iterator re-assembles lines before the loop sees them
+    for line in stream.splitlines(keepends=True):
+        if line.startswith(b"data: "):
+            chunk = line[6:].strip()
+            if chunk != b"[DONE]":
+                try:
+                    data = json.loads(chunk)
+                    if not data.get('choices'):
+                        continue
+                    content = data.get("choices", [{}])[0].get(
+                        "delta", {}).get("content", "")
+                    if content:
+                        tokens += 1
+                except json.JSONDecodeError:
+                    continue
+    return tokens
+
+
+def current_path(stream: bytes, read_size: int) -> int:
+    tokens = 0
+    parser = SSEParser()
+    for data in reads(stream, read_size):
+        for event in parser.feed(data):
+            if event.data == "[DONE]":
+                return tokens
+            if delta_content(event.data):
+                tokens += 1
+    return tokens
+
+
+def main(tokens: int, read_size: int, rounds: int):
+    stream = make_stream(tokens)
+    print(f"{tokens} tokens, {len(stream) / 1e6:.1f} MB, {read_size} byte reads, "
+          f"best of {rounds}")
+    print(f"{'path':>10} {'tokens/s':>12}")
+    for name, path in (("previous", previous_path), ("current", current_path)):
+        best = float("inf")
+        for _ in range(rounds):
+            started = time.perf_counter()
+            parsed = path(stream, read_size)
+            best = min(best, time.perf_counter() - started)
+        assert parsed == tokens, (name, parsed)
+        print(f"{name:>10} {tokens / best:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=100_000)
+    parser.add_argument("--read-size", type=int, default=4096)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    main(args.tokens, args.read_size, args.rounds)
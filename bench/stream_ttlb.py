@@ -0,0 +1,71 @@
+"""
+Time-to-last-byte of /chat/stream over a real HTTP connection, measured after
+the answer's last chunk, i.e. the tail the client waits for once it has seen
+the whole answer
+
+    python -m bench.stream_ttlb --debates 4 --turns 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from bench.harness import served_client
+from bench.stub_llm import StubLLMServer
+from db.database import create_engine
+
+
+async def stream_turn(client: httpx.AsyncClient, conversation_id):
+    started = time.perf_counter()
+    last_chunk_at = None
+    final = None
+    async with client.stream("POST", "/chat/stream", json={
+        "message": "Earth is flat",
+        "conversation_id": conversation_id,
+    }) as response:
+        async for line in response.aiter_lines():
+            if '"final"' in line:
+                final = line
+            elif line.startswith("data:"):
+                last_chunk_at = time.perf_counter()
+    ended = time.perf_counter()
+    return ended - started, ended - last_chunk_at, final
+
+
+async def main(debates: int, turns: int):
+    stub = StubLLMServer(chunk_delay=0.002)
+    base_url = await stub.start()
+    engine = create_engine(
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+    ttlb, tails = [], []
+    async with served_client(engine, base_url) as client:
+        for _ in range(debates):
+            conversation_id = None
+            for _ in range(turns):
+                total, tail, final = await stream_turn(client, conversation_id)
+                ttlb.append(total)
+                tails.append(tail)
+                conversation_id = json.loads(final[len("data:"):])["conversation_id"]
+
+    await engine.dispose()
+    await stub.stop()
+    print(f"{debates} debates of {turns} streamed turns")
+    print(f"{'':>22} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, values in (("time to last byte", ttlb), ("after last chunk", tails)):
+        quantiles = statistics.quantiles(values, n=20)
+        print(f"{name:>22} {statistics.median(values) * 1000:>8.2f} "
+              f"{quantiles[18] * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--debates", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.debates, args.turns))
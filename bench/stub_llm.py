@@ -0,0 +1,217 @@
+"""
+Local OpenAI-compatible stub provider used by the benchmarks and tests
+
+Serves POST /chat/completions (plain and "stream": true) with a configurable
+time to first token, token rate, chunk size and response length so the API
+can be exercised without a real LLM backend. Errors are injected as a ratio
+of 500s, of 429s with Retry-After, and of streams failing midway with an
+in-band error event. With a capacity set, requests above that many
+concurrent ones get a 429. With prefix_cache_latency set it simulates
+provider prompt caching: requests whose cache_control-marked prefix was seen
+before get the lower latency. Runs standalone as
+
+    python -m bench.stub_llm --port 8001 --ttft 0.5 --tokens-per-second 40
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+DEFAULT_RESPONSE = (
+    "That's incorrect because ships disappear hull-first over the horizon. "
+    "This proves the planet is spherical."
+)
+
+
+class StubLLMServer:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        response: str = DEFAULT_RESPONSE,
+        chunk_delay: float = 0.0,
+        prefix_cache_latency: Optional[float] = None,
+        rate_limit_ratio: float = 0.0,
+        capacity: Optional[int] = None,
+        retry_after: Optional[float] = 1.0,
+        error_rate: float = 0.0,
+        stream_error_rate: float = 0.0,
+        tokens_per_second: Optional[float] = None,
+        chunk_tokens: int = 1,
+        response_tokens: Optional[int] = None,
+    ):
+        """
+        latency is the time to first token. tokens_per_second, when set,
+        paces chunks of chunk_tokens words and overrides chunk_delay.
+        response_tokens repeats the response to that many words
+        """
+        self.latency = latency
+        if response_tokens is not None:
+            words = response.split(" ")
+            response = " ".join(words[i % len(words)] for i in range(response_tokens))
+        self.response = response
+        self.chunk_tokens = chunk_tokens
+        self.chunk_delay = (
+            chunk_tokens / tokens_per_second if tokens_per_second else chunk_delay)
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.prefix_cache_latency = prefix_cache_latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prefix_cache_hits = 0
+        self._cached_prefixes = set()
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.chat_completions)
+        return app
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        if (
+            random.random() < self.rate_limit_ratio
+            or (self.capacity is not None and self.in_flight >= self.capacity)
+        ):
+            self.rate_limited += 1
+            headers = {}
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+            return web.json_response(
+                {"error": {"code": 429, "message": "Rate limit exceeded"}},
+                status=429,
+                headers=headers,
+            )
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"code": 500, "message": "Internal server error"}},
+                status=500,
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await self.respond(request)
+        finally:
+            self.in_flight -= 1
+
+    async def respond(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        await asyncio.sleep(self.latency_for(payload.get("messages", [])))
+
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": f"stub-{self.requests}",
+                "model": payload.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.response},
+                    "finish_reason": "stop",
+                }],
+            })
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = self.response.split(" ")
+        fail_at = (
+            random.randrange(len(words))
+            if random.random() < self.stream_error_rate else None
+        )
+        for i in range(0, len(words), self.chunk_tokens):
+            if fail_at is not None and i >= fail_at:
+                self.errors += 1
+                await response.write(
+                    b'data: {"error": {"code": 502, "message": "Upstream error"}}\n\n')
+                break
+            content = " ".join(words[i:i + self.chunk_tokens]) + " "
+            chunk = {"choices": [{"index": 0, "delta": {"content": content}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def latency_for(self, messages: List[Dict]) -> float:
+        if self.prefix_cache_latency is None:
+            return self.latency
+        marked = [
+            i for i, message in enumerate(messages)
+            if isinstance(message.get("content"), list)
+            and any("cache_control" in part for part in message["content"])
+        ]
+        if not marked:
+            return self.latency
+        prefix = json.dumps(messages[:marked[-1] + 1], sort_keys=True)
+        key = hashlib.sha256(prefix.encode()).hexdigest()
+        if key in self._cached_prefixes:
+            self.prefix_cache_hits += 1
+            return self.prefix_cache_latency
+        self._cached_prefixes.add(key)
+        return self.latency
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(args):
+    stub = StubLLMServer(
+        latency=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        chunk_tokens=args.chunk_tokens,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        stream_error_rate=args.stream_error_rate,
+        rate_limit_ratio=args.rate_limit_ratio,
+        capacity=args.capacity,
+    )
+    base_url = await stub.start(args.host, args.port)
+    print(f"Stub LLM serving on {base_url}, use it as the llm base_url")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.0, help="seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="words per stream chunk")
+    parser.add_argument("--response-tokens", type=int, default=None, help="words per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of 500s")
+    parser.add_argument("--stream-error-rate", type=float, default=0.0,
+                        help="ratio of streams failing midway")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="ratio of 429s")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="concurrent requests served before 429s")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
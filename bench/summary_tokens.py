@@ -0,0 +1,121 @@
+"""
+Prompt tokens per turn as a debate grows, whole history vs rolling summaries
+
+    python -m bench.summary_tokens --turns 80 --every 10
+    python -m bench.summary_tokens --threshold 16 --tail 4 --context-tokens 4000
+
+Each debate runs its turns one after the other against a stub llm, building
+the prompt the way /chat/ does: ChatService history, then the persona's
+context window (--context-tokens, large by default so only the summaries cut
+the prompt). With summaries, refreshes are queued after each turn and run in
+the background on the same stub. Token counts use the context window's
+estimate, summary calls are reported separately since they are off the
+request path
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+from collections import defaultdict
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from api.personas.context_window import ContextWindow
+from api.personas.debate_persona import DebatePersona
+from api.services import http_client
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from api.services.llm_service import LLMService
+from api.services.summarizer import ConversationSummarizer
+from bench.stub_llm import StubLLMServer
+from db.database import Base, create_engine
+
+ARGUMENT = (
+    "Satellite photos, circumnavigation and the shadow the Earth casts on the "
+    "moon during an eclipse all show the planet is round, point {turn} stands."
+)
+
+
+async def run(args, summaries: bool):
+    engine = create_engine(
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    stub = StubLLMServer(latency=args.latency, response_tokens=args.response_words)
+    llm = LLMService(
+        api_key="stub", base_url=await stub.start(), model="stub",
+        temperature=0.1, max_tokens=500, flights=None,
+    )
+    window = ContextWindow(max_tokens=args.context_tokens)
+    persona = DebatePersona(llm, window, prompt_cache_hints=False, response_cache=None)
+    summarizer = None
+    if summaries:
+        summarizer = ConversationSummarizer(threshold=args.threshold, tail=args.tail)
+        summarizer.start(engine)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    # turn -> prompt tokens of each debate
+    tokens = defaultdict(list)
+
+    async def debate(i: int):
+        async with session_factory() as session:
+            service = ChatService(session, history_cache=HistoryCache(), journal=None)
+            conversation_id, summary, history = None, None, []
+            for turn in range(1, args.turns + 1):
+                if conversation_id is not None:
+                    if summarizer:
+                        summary, history = await service.format_summarized_messages(
+                            conversation_id)
+                    else:
+                        history = await service.format_messages_for_llm(conversation_id)
+                message = (
+                    f"Argue that debate {i} proves the Earth is flat" if turn == 1
+                    else ARGUMENT.format(turn=turn))
+                history.append({"role": "user", "content": message})
+                messages = persona.format_debate_messages(history, summary)
+                tokens[turn].append(sum(window.message_tokens(m) for m in messages))
+                response = await llm.chat_completion(messages=messages)
+                user_message, _ = await service.add_turn(
+                    conversation_id, message, response["choices"][0]["message"]["content"])
+                conversation_id = user_message.conversation_id
+                if summarizer:
+                    summarizer.schedule(conversation_id, len(history), llm)
+
+    await asyncio.gather(*(debate(i) for i in range(args.debates)))
+    if summarizer:
+        await summarizer.stop()
+    summary_calls = stub.requests - args.debates * args.turns
+    await stub.stop()
+    await engine.dispose()
+    return tokens, summary_calls
+
+
+async def main(args):
+    print(f"{args.debates} debates of {args.turns} turns, {args.response_words} word replies, "
+          f"summary threshold {args.threshold} tail {args.tail}, "
+          f"context window {args.context_tokens} tokens")
+    full, _ = await run(args, summaries=False)
+    summarized, summary_calls = await run(args, summaries=True)
+    print(f"{'turn':>5} {'full tokens':>12} {'summarized tokens':>18} {'saved':>7}")
+    for turn in [1, *range(args.every, args.turns + 1, args.every)]:
+        before = statistics.mean(full[turn])
+        after = statistics.mean(summarized[turn])
+        print(f"{turn:>5} {before:>12.0f} {after:>18.0f} {1 - after / before:>7.0%}")
+    total_full = sum(map(sum, full.values()))
+    total_summarized = sum(map(sum, summarized.values()))
+    print(f"total prompt tokens {total_full} vs {total_summarized}, "
+          f"{summary_calls} summary calls off the request path")
+    await http_client.close_session()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--debates", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--every", type=int, default=10, help="report every N turns")
+    parser.add_argument("--threshold", type=int, default=24)
+    parser.add_argument("--tail", type=int, default=8)
+    parser.add_argument("--context-tokens", type=int, default=1_000_000)
+    parser.add_argument("--response-words", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.01, help="stub time to first token")
+    asyncio.run(main(parser.parse_args()))
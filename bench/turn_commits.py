@@ -0,0 +1,86 @@
+"""
+Compares database work per /chat/ turn between the per-message path
+(create_conversation + add_message per message) and ChatService.add_turn
+
+    python -m bench.turn_commits --turns 200
+
+On SQLite every commit is a journal sync, so commits per turn is the number of
+fsync-bound round trips a turn pays
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.services.chat_service import ChatService
+from api.services.history_cache import HistoryCache
+from db.database import Base
+
+
+async def per_message_turn(service: ChatService, conversation_id):
+    if conversation_id is None:
+        conversation_id = (await service.create_conversation()).id
+    await service.add_message(conversation_id, "Earth is flat", "user")
+    await service.add_message(conversation_id, "It is not", "bot")
+    return conversation_id
+
+
+async def unit_of_work_turn(service: ChatService, conversation_id):
+    user_message, _ = await service.add_turn(
+        conversation_id, "Earth is flat", "It is not")
+    return user_message.conversation_id
+
+
+async def measure(name: str, turn, turns: int, turns_per_conversation: int):
+    db_dir = tempfile.mkdtemp()
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{os.path.join(db_dir, 'bench.db')}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    counts = {"commits": 0, "statements": 0}
+
+    def on_commit(conn):
+        counts["commits"] += 1
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        counts["statements"] += 1
+
+    event.listen(engine.sync_engine, "commit", on_commit)
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    started = time.perf_counter()
+    async with session_factory() as session:
+        service = ChatService(session, history_cache=HistoryCache())
+        conversation_id = None
+        for i in range(turns):
+            if i % turns_per_conversation == 0:
+                conversation_id = None
+            conversation_id = await turn(service, conversation_id)
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    print(
+        f"{name:>14} {counts['commits'] / turns:>13.2f} "
+        f"{counts['statements'] / turns:>16.2f} {turns / elapsed:>10.1f}"
+    )
+
+
+async def main(turns: int, turns_per_conversation: int):
+    print(f"{turns} turns, new conversation every {turns_per_conversation} turns")
+    print(f"{'path':>14} {'commits/turn':>13} {'statements/turn':>16} {'turns/s':>10}")
+    await measure("per-message", per_message_turn, turns, turns_per_conversation)
+    await measure("add_turn", unit_of_work_turn, turns, turns_per_conversation)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--turns-per-conversation", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.turns, args.turns_per_conversation))
@@ -0,0 +1,106 @@
+"""
+Load test of LLMService against a stub provider that rate limits: it accepts
+--capacity concurrent requests and answers 429 with Retry-After above that,
+plus a random --rate-limit-ratio of 429s
+
+    python -m bench.upstream_overload --clients 256 --capacity 32 --duration 10
+
+Compares an unbounded client (every caller hits the provider, backing off on
+429s) with the adaptive concurrency limit, queue and circuit breaker. The
+connection pool is sized for all clients so it doesn't act as a limit itself
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from api.services.http_client import HTTPClientPool
+from api.services.llm_service import LLMService
+from api.services.overload import AdaptiveLimiter, CircuitBreaker, Overloaded
+from bench.stub_llm import StubLLMServer
+
+UNBOUNDED = 10 ** 9
+
+
+async def run(name: str, args, limiter: AdaptiveLimiter, breaker: CircuitBreaker):
+    stub = StubLLMServer(
+        latency=args.latency,
+        capacity=args.capacity,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+    )
+    base_url = await stub.start()
+    pool = HTTPClientPool(limit=args.clients, limit_per_host=args.clients)
+    llm = LLMService(
+        api_key="stub",
+        base_url=base_url,
+        model="stub",
+        temperature=0.1,
+        max_tokens=50,
+        flights=None,
+        limiter=limiter,
+        session=pool.open(),
+        breaker=breaker,
+    )
+    latencies = []
+    rejected = 0
+    failed = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def client(i: int):
+        nonlocal rejected, failed
+        n = 0
+        while time.perf_counter() < deadline:
+            n += 1
+            started = time.perf_counter()
+            try:
+                await llm.chat_completion(
+                    [{"role": "user", "content": f"client {i} request {n}"}])
+                latencies.append(time.perf_counter() - started)
+            except Overloaded as e:
+                rejected += 1
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    await pool.close()
+    await stub.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    print(f"{name:>10} {len(latencies) / elapsed:>8.1f} {quantiles[49] * 1000:>8.0f} "
+          f"{quantiles[98] * 1000:>8.0f} {rejected:>9} {failed:>7} "
+          f"{stub.rate_limited:>7} {stub.max_in_flight:>7} "
+          f"{int(limiter.limit) if limiter.limit < UNBOUNDED else '-':>7}")
+
+
+async def main(args):
+    print(f"{args.clients} clients, stub capacity {args.capacity}, "
+          f"latency {args.latency * 1000:.0f} ms, {args.duration:.0f}s per run")
+    print(f"{'':>10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'rejected':>9} "
+          f"{'failed':>7} {'429s':>7} {'max in':>7} {'limit':>7}")
+    await run(
+        "unbounded",
+        args,
+        AdaptiveLimiter(
+            initial_limit=UNBOUNDED,
+            max_limit=UNBOUNDED,
+            max_queue=UNBOUNDED,
+            backoff_ratio=1.0,
+        ),
+        CircuitBreaker(failure_threshold=UNBOUNDED),
+    )
+    await run("adaptive", args, AdaptiveLimiter(), CircuitBreaker())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=256)
+    parser.add_argument("--capacity", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.01)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
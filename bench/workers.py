@@ -0,0 +1,129 @@
+"""
+/chat/ throughput against gunicorn with 1, 2, 4... uvicorn workers
+
+    python -m bench.workers --workers 1 2 4 --clients 64 --duration 10
+
+Each run starts the stub LLM and gunicorn as separate processes on a fresh
+SQLite database, then keeps --clients requests in flight for --duration
+seconds. Every worker runs the startup migrations, so the runs also check
+that concurrent worker startup leaves one schema behind. Workers only add
+throughput up to the number of cores, and SQLite serializes the writes of
+all of them
+"""
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.loadgen import percentiles
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args[:3]} exited with {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+@asynccontextmanager
+async def running(command, ready_url: str, env=None):
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        await wait_ready(ready_url, process)
+        yield process
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+async def run(workers: int, args, llm_url: str):
+    port = free_port()
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY": str(workers),
+        "BIND": f"127.0.0.1:{port}",
+        "DATABASE_URL": (
+            f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'workers.db')}"),
+        "LLM_BACKENDS": json.dumps([
+            {"base_url": llm_url, "model": "stub", "api_key_env": "STUB_API_KEY"}]),
+        "STUB_API_KEY": "stub",
+    }
+    url = f"http://127.0.0.1:{port}"
+    command = [sys.executable, "-m", "gunicorn", "api.main:app", "-c", "gunicorn.conf.py"]
+    async with running(command, f"{url}/docs", env):
+        latencies = []
+        errors = 0
+        async with httpx.AsyncClient(
+            base_url=url,
+            timeout=60,
+            limits=httpx.Limits(max_connections=args.clients),
+        ) as client:
+            deadline = time.perf_counter() + args.duration
+
+            async def one(i: int):
+                nonlocal errors
+                n = 0
+                while time.perf_counter() < deadline:
+                    n += 1
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post(
+                            "/chat/", json={"message": f"Argue that claim {i}.{n} is true"})
+                        response.raise_for_status()
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.clients)))
+            elapsed = time.perf_counter() - started
+
+    latency = percentiles(latencies) or {"p50": 0, "p99": 0}
+    print(f"{workers:>8} {len(latencies) / elapsed:>8.1f} {latency['p50']:>8.0f} "
+          f"{latency['p99']:>8.0f} {errors:>7}")
+
+
+async def main(args):
+    llm_port = free_port()
+    llm_url = f"http://127.0.0.1:{llm_port}"
+    stub = [
+        sys.executable, "-m", "bench.stub_llm",
+        "--port", str(llm_port), "--ttft", str(args.stub_ttft),
+    ]
+    async with running(stub, llm_url):
+        print(f"{os.cpu_count()} cores, {args.clients} clients, "
+              f"stub ttft {args.stub_ttft * 1000:.0f} ms, {args.duration:.0f}s per run")
+        print(f"{'workers':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for workers in args.workers:
+            await run(workers, args, llm_url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--stub-ttft", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -1,14 +1,103 @@
 from contextlib import asynccontextmanager
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncAttrs
+import sqlite3
+import time
+from typing import Dict, Optional
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncAttrs
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 
-DATABASE_URL = "sqlite+aiosqlite:///./chat.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./chat.db")
 
-engine = create_async_engine(DATABASE_URL, connect_args={
-                             "check_same_thread": False})
-SessionLocal = async_sessionmaker(engine)
+"""
+Connect-time pragmas for SQLite in production: WAL lets readers run alongside
+the writer, synchronous=NORMAL only syncs the WAL on checkpoints, and
+busy_timeout waits for the write lock instead of failing with
+"database is locked". auto_vacuum only takes effect on new database files,
+it lets the retention job return freed pages to the filesystem
+"""
+SQLITE_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative values are KiB
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+# Pragmas that write the database header. While another connection converts
+# a new file, SQLite answers them with "database is locked" without waiting
+# for busy_timeout, so they are retried for that long
+HEADER_PRAGMAS = ("auto_vacuum", "journal_mode")
+PRAGMA_RETRY_INTERVAL = 0.01
+
+
+def sqlite_pragmas_from_env() -> Dict[str, object]:
+    """
+    SQLITE_TUNING=0 keeps SQLite defaults, each pragma can be overridden with
+    SQLITE_<PRAGMA>, e.g. SQLITE_MMAP_SIZE=0
+    """
+    if os.getenv("SQLITE_TUNING", "1") == "0":
+        return {}
+    return {
+        name: os.getenv(f"SQLITE_{name.upper()}", value)
+        for name, value in SQLITE_PRAGMAS.items()
+    }
+
+
+def apply_pragma(cursor, name: str, value, retry_for: float = 5.0):
+    """
+    Sets a pragma, retrying header pragmas on "database is locked" for up to
+    retry_for seconds
+    """
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            cursor.execute(f"PRAGMA {name}={value}")
+            return
+        except sqlite3.OperationalError as e:
+            if (
+                name not in HEADER_PRAGMAS
+                or "locked" not in str(e)
+                or time.monotonic() >= deadline
+            ):
+                raise
+        # Only reached while several processes open a new file at once
+        time.sleep(PRAGMA_RETRY_INTERVAL)
+
+
+def create_engine(
+    url: str = DATABASE_URL,
+    sqlite_pragmas: Optional[Dict[str, object]] = None,
+) -> AsyncEngine:
+    if not url.startswith("sqlite"):
+        return create_async_engine(
+            url,
+            pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+            pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "1") == "1",
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        )
+
+    engine = create_async_engine(url, connect_args={"check_same_thread": False})
+    pragmas = sqlite_pragmas_from_env() if sqlite_pragmas is None else sqlite_pragmas
+    if pragmas:
+        retry_for = int(pragmas.get("busy_timeout", 5000)) / 1000
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # busy_timeout first, so the other pragmas wait for locks
+            for name, value in sorted(pragmas.items(), key=lambda item: item[0] != "busy_timeout"):
+                apply_pragma(cursor, name, value, retry_for)
+            cursor.close()
+
+    return engine
+
+
+engine = create_engine()
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -18,8 +107,9 @@ class Base(AsyncAttrs, DeclarativeBase):
 @asynccontextmanager
 async def db_lifespan():
     if not os.getenv("TESTING"):
+        from db.migrations import migrate
         async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate)
 
     yield
     await engine.dispose()
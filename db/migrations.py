@@ -0,0 +1,133 @@
+"""
+Versioned schema migrations for the Conversation/Message tables
+
+Each migration is applied once and recorded in `schema_migrations`, so a
+database created by any earlier release (or a fresh one) is brought up to the
+current models on startup, on SQLite as well as on Postgres. Under gunicorn
+the master migrates once before forking (`migrate_database`, called from
+gunicorn.conf.py), which also converts a new SQLite file to WAL. Workers
+still migrate on startup, e.g. under uvicorn --workers: they take a database
+lock first, so migrations run in one of them and the others find nothing
+pending
+"""
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, Connection, DateTime, Integer, MetaData, String
+from sqlalchemy import Table, inspect, insert, select, text
+
+from db.database import DATABASE_URL, Base, create_engine
+import db.models  # noqa: F401 registers the tables on Base.metadata
+
+# Postgres advisory lock key held while migrating
+MIGRATION_LOCK_KEY = 0x63686174
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def create_tables(conn: Connection):
+    """
+    Creates missing tables from the current models, existing ones are kept
+    """
+    Base.metadata.create_all(conn)
+
+
+def add_message_seq(conn: Connection):
+    """
+    Adds Message.seq to databases created before it existed, numbering each
+    conversation's messages by timestamp, plus the conversation indexes
+    """
+    columns = {column["name"] for column in inspect(conn).get_columns("messages")}
+    if "seq" in columns:
+        return
+    conn.execute(text("ALTER TABLE messages ADD COLUMN seq INTEGER"))
+    conn.execute(text(
+        "UPDATE messages SET seq = numbered.rn FROM ("
+        " SELECT id, ROW_NUMBER() OVER ("
+        "  PARTITION BY conversation_id ORDER BY timestamp, id) AS rn"
+        " FROM messages) AS numbered "
+        "WHERE numbered.id = messages.id"
+    ))
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE messages ALTER COLUMN seq SET NOT NULL"))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX uq_messages_conversation_seq "
+        "ON messages (conversation_id, seq)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX ix_messages_conversation_timestamp "
+        "ON messages (conversation_id, timestamp, seq)"
+    ))
+
+
+def add_conversation_archives(conn: Connection):
+    """
+    Archive table of the retention job, already there on databases created
+    from the current models
+    """
+    db.models.ConversationArchive.__table__.create(conn, checkfirst=True)
+
+
+def add_conversation_summaries(conn: Connection):
+    """
+    Rolling summary table, already there on databases created from the
+    current models
+    """
+    db.models.ConversationSummary.__table__.create(conn, checkfirst=True)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create tables", create_tables),
+    (2, "message seq and conversation index", add_message_seq),
+    (3, "conversation archives", add_conversation_archives),
+    (4, "conversation summaries", add_conversation_summaries),
+]
+
+
+def lock_migrations(conn: Connection):
+    """
+    Blocks until no other process is migrating, the lock is released when
+    the transaction ends
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    elif conn.dialect.name == "sqlite":
+        # Takes the write lock upfront, waiting up to busy_timeout for it
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def migrate(conn: Connection) -> List[int]:
+    """
+    Applies pending migrations in order, returns the versions applied. Meant
+    to run first in a new transaction, e.g. `await conn.run_sync(migrate)`
+    """
+    lock_migrations(conn)
+    migration_metadata.create_all(conn)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+    pending = [m for m in MIGRATIONS if m[0] not in applied]
+    for version, name, migration in pending:
+        migration(conn)
+        conn.execute(insert(schema_migrations).values(
+            version=version, name=name, applied_at=datetime.now()))
+    return [version for version, _, _ in pending]
+
+
+async def migrate_database(url: str = DATABASE_URL) -> List[int]:
+    """
+    Migrates the database at url through an engine of its own, disposed
+    before returning so no connection is inherited by forked workers
+    """
+    engine = create_engine(url)
+    try:
+        async with engine.begin() as conn:
+            return await conn.run_sync(migrate)
+    finally:
+        await engine.dispose()
@@ -2,9 +2,8 @@ from datetime import datetime
 import uuid
 from typing import List
 
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import ForeignKey, Index, LargeBinary, String, Text, UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.dialects.sqlite import TEXT
 from db.database import Base
 
 
@@ -21,12 +20,18 @@ class Conversation(Base):
         "Message",
         back_populates="conversation",
         cascade="all, delete-orphan",
-        lazy="selectin"  # Recommended for async
+        lazy="raise"  # Opt in with selectinload() where needed
     )
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_conversation_timestamp",
+              "conversation_id", "timestamp", "seq"),
+        UniqueConstraint("conversation_id", "seq",
+                         name="uq_messages_conversation_seq"),
+    )
 
     id: Mapped[str] = mapped_column(
         String(36),
@@ -39,7 +44,7 @@ class Message(Base):
         nullable=False,
     )
     content: Mapped[str] = mapped_column(
-        TEXT,
+        Text,
         nullable=False
     )
     role: Mapped[str] = mapped_column(
@@ -50,9 +55,51 @@ class Message(Base):
         default=datetime.utcnow,
         nullable=False
     )
+    # Monotonic per conversation, tie-breaker for equal timestamps and
+    # keyset pagination cursor
+    seq: Mapped[int] = mapped_column(
+        nullable=False
+    )
 
     conversation: Mapped["Conversation"] = relationship(
         "Conversation",
         back_populates="messages",
-        lazy="selectin"  # Recommended for async
+        lazy="raise"  # Opt in with selectinload() where needed
     )
+
+
+class ConversationArchive(Base):
+    """
+    Messages moved out of the messages table by the retention job, as gzip
+    compressed NDJSON in the export format. A conversation has one row per
+    archived range of seqs
+    """
+    __tablename__ = "conversation_archives"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # No foreign key, fully archived conversations are deleted
+    conversation_id: Mapped[str] = mapped_column(String(36), nullable=False, index=True)
+    first_seq: Mapped[int] = mapped_column(nullable=False)
+    last_seq: Mapped[int] = mapped_column(nullable=False)
+    message_count: Mapped[int] = mapped_column(nullable=False)
+    archived_at: Mapped[datetime] = mapped_column(nullable=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class ConversationSummary(Base):
+    """
+    Rolling llm summary of the older turns of a long conversation, written
+    off the request path. It covers the messages after the opening one up to
+    the high-water mark last_message_id / last_seq, prompts send it with the
+    messages after that
+    """
+    __tablename__ = "conversation_summaries"
+
+    # No foreign key, like the archives, rows of archived conversations are
+    # deleted by the retention job
+    conversation_id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    summary: Mapped[str] = mapped_column(Text, nullable=False)
+    last_message_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    last_seq: Mapped[int] = mapped_column(nullable=False)
+    message_count: Mapped[int] = mapped_column(nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(nullable=False)
@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+
+from db.database import apply_pragma, create_engine
+
+
+async def read_pragmas(engine):
+    async with engine.connect() as conn:
+        return {
+            name: (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+            for name in ("journal_mode", "synchronous", "busy_timeout", "temp_store")
+        }
+
+
+@pytest.mark.asyncio
+async def test_create_engine_applies_sqlite_pragmas(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / 'tuned.db'}", {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 1234,
+        "temp_store": "MEMORY",
+    })
+    assert await read_pragmas(engine) == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "busy_timeout": 1234,
+        "temp_store": 2,
+    }
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_create_engine_without_tuning_keeps_defaults(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / 'default.db'}", {})
+    pragmas = await read_pragmas(engine)
+    assert pragmas["journal_mode"] == "delete"
+    assert pragmas["synchronous"] == 2
+    await engine.dispose()
+
+
+class LockedCursor:
+    """
+    Fails its first `locked` executes the way SQLite answers header pragmas
+    while another connection converts a new file
+    """
+
+    def __init__(self, locked: int):
+        self.locked = locked
+        self.executed = []
+
+    def execute(self, statement):
+        self.executed.append(statement)
+        if len(self.executed) <= self.locked:
+            raise sqlite3.OperationalError("database is locked")
+
+
+def test_header_pragmas_are_retried_while_locked():
+    cursor = LockedCursor(locked=3)
+    apply_pragma(cursor, "journal_mode", "WAL", retry_for=1)
+    assert cursor.executed == ["PRAGMA journal_mode=WAL"] * 4
+
+    with pytest.raises(sqlite3.OperationalError):
+        apply_pragma(LockedCursor(locked=1), "cache_size", -1024, retry_for=1)
+    with pytest.raises(sqlite3.OperationalError):
+        apply_pragma(LockedCursor(locked=1000), "auto_vacuum", "INCREMENTAL", retry_for=0.05)
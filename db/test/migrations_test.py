@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from sqlalchemy import inspect, text
+
+from db.database import create_engine
+from db.migrations import migrate, migrate_database
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE conversations (id VARCHAR(36) NOT NULL PRIMARY KEY)",
+    "CREATE TABLE messages ("
+    " id VARCHAR(36) NOT NULL PRIMARY KEY,"
+    " conversation_id VARCHAR(36) NOT NULL REFERENCES conversations (id),"
+    " content TEXT NOT NULL, role VARCHAR(10) NOT NULL,"
+    " timestamp DATETIME NOT NULL)",
+    "INSERT INTO conversations VALUES ('a'), ('b')",
+    "INSERT INTO messages VALUES"
+    " ('m1', 'a', 'first', 'user', '2025-01-01 00:00:01'),"
+    " ('m2', 'b', 'other', 'user', '2025-01-01 00:00:02'),"
+    " ('m3', 'a', 'reply', 'bot', '2025-01-01 00:00:03')",
+]
+
+
+@pytest.mark.asyncio
+async def test_migrate_fresh_database(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / 'fresh.db'}", {})
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrate) == [1, 2, 3, 4]
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrate) == []
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_migrate_backfills_message_seq(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}", {})
+    async with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            await conn.execute(text(statement))
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrate) == [1, 2, 3, 4]
+        rows = await conn.execute(text("SELECT id, seq FROM messages ORDER BY id"))
+        assert rows.all() == [("m1", 1), ("m2", 1), ("m3", 2)]
+        indexes = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).get_indexes("messages"))
+        assert {"ix_messages_conversation_timestamp", "uq_messages_conversation_seq"} <= {
+            index["name"] for index in indexes}
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_migrations_run_once(tmp_path):
+    # Workers booting at once on a new file, all switching it to WAL
+    url = f"sqlite+aiosqlite:///{tmp_path / 'workers.db'}"
+    engines = [create_engine(url) for _ in range(4)]
+
+    async def start_worker(engine):
+        async with engine.begin() as conn:
+            return await conn.run_sync(migrate)
+
+    applied = await asyncio.gather(*(start_worker(engine) for engine in engines))
+    assert sorted(applied) == [[], [], [], [1, 2, 3, 4]]
+    for engine in engines:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_migrate_database_before_workers_start(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'chat.db'}"
+    assert await migrate_database(url) == [1, 2, 3, 4]
+    engine = create_engine(url, {})
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+    async with engine.begin() as conn:
+        assert await conn.run_sync(migrate) == []
+    await engine.dispose()
@@ -0,0 +1,39 @@
+"""
+Multi-worker deployment, one uvicorn event loop per core
+
+    gunicorn api.main:app -c gunicorn.conf.py
+
+Workers default to the number of cores, WEB_CONCURRENCY overrides it. The
+master applies pending migrations before forking, which also switches a new
+SQLite file to WAL, so workers booting together don't race to convert it.
+Each worker still checks for pending migrations on startup and finds none.
+Set STATE_BACKEND=redis so workers share the response cache.
+
+Everything else stays per worker: /metrics and /stats describe the worker
+that served the request, and the upstream concurrency limit, circuit
+breaker and single-flight each apply to one worker's calls, so the
+deployment allows up to workers times LLM_CONCURRENCY_MAX calls. Scrape each
+worker or run WEB_CONCURRENCY=1 when exact totals matter
+"""
+import asyncio
+import multiprocessing
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Read by api.services.state in each worker
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Streams stay open for the whole llm answer
+timeout = int(os.getenv("WORKER_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    from db.migrations import migrate_database
+
+    applied = asyncio.run(migrate_database())
+    if applied:
+        server.log.info(f"Applied migrations {applied}")